@@ -7,6 +7,8 @@ import logging
 import azure.functions as func
 import psycopg2
 import time
+import math
+import re
 import socket
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from azure.keyvault.secrets import SecretClient
@@ -22,6 +24,23 @@ STAGE = os.environ.get('STAGE')
 MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 5))
 RETRY_DELAY = int(os.environ.get('RETRY_DELAY', 10))  # seconds
 
+# Vector index settings
+VECTOR_INDEX_TYPE = os.environ.get('VECTOR_INDEX_TYPE', 'hnsw').lower()  # hnsw or ivfflat
+HNSW_M = int(os.environ.get('HNSW_M', 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get('HNSW_EF_CONSTRUCTION', 64))
+IVFFLAT_LISTS = int(os.environ.get('IVFFLAT_LISTS', 0))  # 0 derives lists from the row count
+IVFFLAT_REBUILD_RATIO = float(os.environ.get('IVFFLAT_REBUILD_RATIO', 2))  # rebuild derived lists once this far off
+VECTOR_INDEX_NAME = 'idx_chunks_embedding'
+
+# Full-text search configuration for hybrid retrieval (must match the query processor)
+TEXT_SEARCH_CONFIG = os.environ.get('TEXT_SEARCH_CONFIG', 'english').lower()
+TEXT_SEARCH_CONFIGS = (
+    'simple', 'arabic', 'armenian', 'basque', 'catalan', 'danish', 'dutch', 'english', 'finnish',
+    'french', 'german', 'greek', 'hindi', 'hungarian', 'indonesian', 'irish', 'italian', 'lithuanian',
+    'nepali', 'norwegian', 'portuguese', 'romanian', 'russian', 'serbian', 'spanish', 'swedish',
+    'tamil', 'turkish', 'yiddish'
+)  # built-in PostgreSQL configurations
+
 
 def get_postgres_credentials():
     """
@@ -63,6 +82,210 @@ def check_dns_resolution(host):
         return False
 
 
+def get_pgvector_version(cursor):
+    """
+    Get the installed pgvector extension version.
+    
+    Args:
+        cursor: PostgreSQL cursor
+        
+    Returns:
+        tuple: Version as a tuple of ints, or None if it cannot be determined
+    """
+    try:
+        cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = cursor.fetchone()
+        return tuple(int(part) for part in row[0].split('.'))
+    except Exception as e:
+        logger.warning(f"Could not determine pgvector version: {str(e)}")
+        return None
+
+
+def ivfflat_lists_for_rows(row_count):
+    """
+    Derive the number of IVFFlat lists from the table size.
+    
+    Follows the pgvector guidance of rows / 1000 up to 1M rows and sqrt(rows) above.
+    
+    Args:
+        row_count (int): Number of rows in the chunks table
+        
+    Returns:
+        int: Number of lists
+    """
+    if row_count <= 1000000:
+        return max(1, row_count // 1000)
+    return int(math.sqrt(row_count))
+
+
+def explicit_index_options(index_type):
+    """
+    Get the configured options for an embedding index type.
+    
+    IVFFlat lists derived from the row count are not included; see
+    derived_lists_match for how an existing index with derived lists is checked.
+    
+    Args:
+        index_type (str): 'hnsw' or 'ivfflat'
+        
+    Returns:
+        dict: Index options an existing index must match
+    """
+    if index_type == 'hnsw':
+        return {'m': HNSW_M, 'ef_construction': HNSW_EF_CONSTRUCTION}
+    return {'lists': IVFFLAT_LISTS} if IVFFLAT_LISTS > 0 else {}
+
+
+def derived_lists_match(indexdef, lists):
+    """
+    Check whether an existing IVFFlat index has close enough to the derived lists.
+    
+    Small drift in the row count is tolerated so an index is not rebuilt on
+    every run, but it is rebuilt once the derived value is IVFFLAT_REBUILD_RATIO
+    times larger or smaller than the one it was built with.
+    
+    Args:
+        indexdef (str): Definition of the existing index from pg_indexes
+        lists (int): Lists derived from the current row count
+        
+    Returns:
+        bool: True if the existing index can be kept
+    """
+    match = re.search(r"lists='(\d+)'", indexdef)
+    if not match:
+        return False
+    existing = int(match.group(1))
+    return max(existing, lists) < IVFFLAT_REBUILD_RATIO * min(existing, lists)
+
+
+def build_vector_index_sql(index_type, options, index_name=VECTOR_INDEX_NAME, concurrently=False):
+    """
+    Build the CREATE INDEX statement for the embedding index.
+    
+    Args:
+        index_type (str): 'hnsw' or 'ivfflat'
+        options (dict): Index options for the WITH clause
+        index_name (str): Name of the index to create
+        concurrently (bool): Build without blocking writes to chunks
+        
+    Returns:
+        str: CREATE INDEX statement
+    """
+    with_clause = ', '.join(f"{name} = {value}" for name, value in options.items())
+    return f"""
+            CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index_name} ON chunks
+            USING {index_type} (embedding vector_cosine_ops)
+            WITH ({with_clause})
+            """
+
+
+def create_vector_index(cursor):
+    """
+    Create the embedding index, HNSW by default when pgvector supports it.
+    
+    An existing index is kept unless its access method or configured options
+    differ, or its derived IVFFlat lists are far off the current row count;
+    it is then rebuilt concurrently under a temporary name and swapped in, so
+    searches keep using the old index until the new one is ready.
+    If HNSW cannot be created the index falls back to IVFFlat. An IVFFlat
+    index with derived lists is not built while chunks is empty, since its
+    lists would be trained on no data; a later run creates it.
+    
+    Args:
+        cursor: PostgreSQL cursor on an autocommit connection
+        
+    Returns:
+        str: Type of the index in place, or None if no index could be created
+    """
+    index_type = VECTOR_INDEX_TYPE if VECTOR_INDEX_TYPE in ('hnsw', 'ivfflat') else 'hnsw'
+    
+    # HNSW is available from pgvector 0.5.0
+    version = get_pgvector_version(cursor)
+    if index_type == 'hnsw' and version is not None and version < (0, 5, 0):
+        logger.warning(f"pgvector {'.'.join(map(str, version))} does not support HNSW, using IVFFlat")
+        index_type = 'ivfflat'
+    
+    cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s", (VECTOR_INDEX_NAME,))
+    existing = cursor.fetchone()
+    indexdef = existing[0] if existing else None
+    
+    candidates = [index_type] if index_type == 'ivfflat' else ['hnsw', 'ivfflat']
+    for candidate in candidates:
+        try:
+            options = explicit_index_options(candidate)
+            derived = candidate == 'ivfflat' and not options
+            if derived:
+                cursor.execute("SELECT COUNT(*) FROM chunks")
+                row_count = cursor.fetchone()[0]
+                if row_count == 0:
+                    logger.info(f"Deferring ivfflat vector index {VECTOR_INDEX_NAME} until chunks has rows")
+                    return None
+                options = {'lists': ivfflat_lists_for_rows(row_count)}
+            
+            if indexdef is None:
+                logger.info(f"Creating {candidate} vector index with {options}...")
+                cursor.execute(build_vector_index_sql(candidate, options))
+                return candidate
+            
+            # Keep an existing index that already matches the configuration
+            if derived:
+                matches = f"USING {candidate} " in indexdef and derived_lists_match(indexdef, options['lists'])
+            else:
+                matches = f"USING {candidate} " in indexdef and all(
+                    f"{name}='{value}'" in indexdef for name, value in options.items()
+                )
+            if matches:
+                logger.info(f"Vector index {VECTOR_INDEX_NAME} already exists: {indexdef}")
+                return candidate
+            
+            # Build the replacement alongside the old index, then swap it in
+            replacement = f"{VECTOR_INDEX_NAME}_new"
+            logger.info(f"Rebuilding vector index {VECTOR_INDEX_NAME} as {candidate} with {options} (was: {indexdef})")
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {replacement}")  # left invalid by an interrupted rebuild
+            cursor.execute(build_vector_index_sql(candidate, options, replacement, concurrently=True))
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {VECTOR_INDEX_NAME}")
+            cursor.execute(f"ALTER INDEX {replacement} RENAME TO {VECTOR_INDEX_NAME}")
+            return candidate
+        except Exception as e:
+            logger.warning(f"Failed to create {candidate} vector index: {str(e)}")
+    
+    return None
+
+
+def create_text_search_index(cursor):
+    """
+    Add the generated full-text search column and its GIN index to chunks.
+    
+    The configuration is checked against the built-in PostgreSQL ones, since
+    it is interpolated into the column definition. A failure is logged and
+    leaves the rest of the schema in place; only hybrid retrieval needs it.
+    
+    Args:
+        cursor: PostgreSQL cursor on an autocommit connection
+        
+    Returns:
+        bool: True if the column and index are in place, False otherwise
+    """
+    config = TEXT_SEARCH_CONFIG
+    if config not in TEXT_SEARCH_CONFIGS:
+        logger.warning(f"Unknown text search configuration '{config}', using 'english'")
+        config = 'english'
+    
+    try:
+        logger.info(f"Creating full-text search column and index ({config})...")
+        cursor.execute(f"""
+        ALTER TABLE chunks ADD COLUMN IF NOT EXISTS content_tsv TSVECTOR
+        GENERATED ALWAYS AS (to_tsvector('{config}'::regconfig, content)) STORED
+        """)
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chunks_content_tsv ON chunks USING GIN (content_tsv)
+        """)
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to create full-text search column: {str(e)}")
+        return False
+
+
 def create_database_if_not_exists(credentials, dbname, retry_count=0):
     """
     Create the database if it doesn't exist.
@@ -207,6 +430,7 @@ def initialize_database(credentials, retry_count=0):
             document_id TEXT NOT NULL,
             user_id TEXT NOT NULL,
             content TEXT NOT NULL,
+            content_hash TEXT,
             metadata JSONB,
             embedding VECTOR(768),
             created_at TIMESTAMP NOT NULL DEFAULT NOW(),
@@ -224,25 +448,53 @@ def initialize_database(credentials, retry_count=0):
         CREATE INDEX IF NOT EXISTS idx_chunks_user_id ON chunks (user_id)
         """)
         
-        # Create vector index on embedding - wrap in try/except as this could fail
-        # if pgvector doesn't fully support the version of Postgres
-        try:
-            cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_chunks_embedding ON chunks
-            USING ivfflat (embedding vector_cosine_ops)
-            WITH (lists = 100)
-            """)
-        except Exception as e:
-            logger.warning(f"Failed to create vector index (this is OK if using older PostgreSQL): {str(e)}")
-            # Try creating a simpler index without IVF
-            try:
-                cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_chunks_embedding ON chunks
-                USING btree (embedding)
-                """)
-                logger.info("Created fallback BTree index on embedding column")
-            except Exception as e2:
-                logger.warning(f"Failed to create fallback index: {str(e2)}")
+        # Add content hash for incremental re-ingest to existing tables
+        cursor.execute("""
+        ALTER TABLE chunks ADD COLUMN IF NOT EXISTS content_hash TEXT
+        """)
+        
+        # Create index on document_id and content_hash for re-ingest diffs
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chunks_document_hash ON chunks (document_id, content_hash)
+        """)
+        
+        # Add the logical document key shared by all uploaded versions of a document
+        cursor.execute("""
+        ALTER TABLE documents ADD COLUMN IF NOT EXISTS logical_key TEXT
+        """)
+        
+        # Create index on user_id and logical_key to find earlier versions of a document
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_documents_user_logical_key ON documents (user_id, logical_key)
+        """)
+        
+        # Versions used to be matched on the file name, then on the object key
+        cursor.execute("""
+        DROP INDEX IF EXISTS idx_documents_user_file
+        """)
+        cursor.execute("""
+        DROP INDEX IF EXISTS idx_documents_bucket_key
+        """)
+        
+        # Create vector index on embedding (HNSW by default, IVFFlat as fallback/option)
+        if not create_vector_index(cursor):
+            logger.warning("No vector index created, similarity search will use sequential scans")
+        
+        # Create content-addressed embedding cache shared by ingest and query
+        logger.info("Creating embedding cache table...")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            task_type TEXT NOT NULL,
+            embedding VECTOR(768) NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """)
+        
+        # Add generated full-text search column for hybrid lexical + vector retrieval
+        if not create_text_search_index(cursor):
+            logger.warning("No full-text search column, hybrid retrieval is unavailable")
         
         logger.info("Database initialization completed successfully")
         cursor.close()
@@ -316,4 +568,27 @@ def handler(event, context):
             'body': json.dumps({
                 'message': f"Error in database initialization: {str(e)}"
             })
-        }
\ No newline at end of file
+        }
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Azure Function to initialize the PostgreSQL database.
+    
+    Args:
+        req (func.HttpRequest): HTTP request, optionally {"action": "healthcheck"}
+        
+    Returns:
+        func.HttpResponse: HTTP response
+    """
+    try:
+        req_body = req.get_json()
+    except ValueError:
+        req_body = {}
+    
+    result = handler(req_body, None)
+    return func.HttpResponse(
+        result['body'],
+        mimetype="application/json",
+        status_code=result['statusCode']
+    )
@@ -3,14 +3,29 @@ Azure Function to process documents uploaded to Blob Storage.
 Extracts text from documents, chunks it, creates embeddings, and stores in PostgreSQL.
 """
 import os
+import io
+import csv
 import json
+import re
 import logging
-import tempfile
+import multiprocessing
+import queue
 import psycopg2
+from psycopg2.extras import execute_values
 import uuid
+import urllib.parse
+import time
+import hashlib
+import random
+import threading
+import boto3
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import azure.functions as func
 from datetime import datetime
-from typing import List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from azure.storage.blob import BlobServiceClient
 from azure.cosmos import CosmosClient
@@ -19,26 +34,28 @@ from azure.identity import DefaultAzureCredential
 
 # Import LangChain components
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, CSVLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
+from pypdf import PdfReader
 
 from google import genai
 from google.genai import types
 
+# Ranged S3 reads and PDF page extraction, kept free of import-time setup for spawned workers
+from .pdf_extraction import S3RangeReader, extract_pdf_pages, get_s3_client, open_s3_object
+
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Initialize AWS clients
-s3_client = boto3.client('s3')
+s3_client = get_s3_client()
 dynamodb = boto3.resource('dynamodb')
-secretsmanager = boto3.client('secretsmanager')
 
 # Get environment variables
 DOCUMENTS_BUCKET = os.environ.get('DOCUMENTS_BUCKET')
 METADATA_TABLE = os.environ.get('METADATA_TABLE')
-DB_SECRET_ARN = os.environ.get('DB_SECRET_ARN')
-GEMINI_SECRET_ARN = os.environ.get('GEMINI_SECRET_ARN')
+DB_SECRET_URI = os.environ.get('DB_SECRET_URI')
+GEMINI_SECRET_URI = os.environ.get('GEMINI_SECRET_URI')
 STAGE = os.environ.get('STAGE')
 
 GEMINI_EMBEDDING_MODEL = os.environ.get('GEMINI_EMBEDDING_MODEL')
@@ -48,38 +65,559 @@ TOP_K = int(os.environ.get('TOP_K'))
 TOP_P = float(os.environ.get('TOP_P'))
 SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD'))
 
+# Embedding batching (Gemini accepts up to 100 texts per embed_content call)
+EMBEDDING_TASK_TYPE = "SEMANTIC_SIMILARITY"
+EMBEDDING_DIMENSION = 768
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 100))
+EMBEDDING_BATCH_TOKEN_LIMIT = int(os.environ.get('EMBEDDING_BATCH_TOKEN_LIMIT', 20000))
+
+# Concurrent embedding and rate limiting
+EMBEDDING_CONCURRENCY = int(os.environ.get('EMBEDDING_CONCURRENCY', 4))
+EMBEDDING_RPM_LIMIT = int(os.environ.get('EMBEDDING_RPM_LIMIT', 1500))
+EMBEDDING_TPM_LIMIT = int(os.environ.get('EMBEDDING_TPM_LIMIT', 1000000))
+EMBEDDING_MAX_RETRIES = int(os.environ.get('EMBEDDING_MAX_RETRIES', 6))
+EMBEDDING_BACKOFF_BASE = float(os.environ.get('EMBEDDING_BACKOFF_BASE', 1.0))  # seconds
+EMBEDDING_BACKOFF_MAX = float(os.environ.get('EMBEDDING_BACKOFF_MAX', 60.0))  # seconds
+
+# Content-addressed embedding cache
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', 10000))
+EMBEDDING_CACHE_PERSISTENT = os.environ.get('EMBEDDING_CACHE_PERSISTENT', 'true').lower() == 'true'
+
+# PostgreSQL connection pool
+POSTGRES_POOL_MIN_SIZE = int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 1))
+POSTGRES_POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10))
+POSTGRES_POOL_MAX_LIFETIME = int(os.environ.get('POSTGRES_POOL_MAX_LIFETIME', 1800))  # seconds
+POSTGRES_POOL_HEALTHCHECK_INTERVAL = int(os.environ.get('POSTGRES_POOL_HEALTHCHECK_INTERVAL', 30))  # seconds
+POSTGRES_POOL_TIMEOUT = float(os.environ.get('POSTGRES_POOL_TIMEOUT', 30))  # seconds
+
+# Streaming loaders (ranged read sizes are configured in pdf_extraction)
+TEXT_SEGMENT_SIZE = int(os.environ.get('TEXT_SEGMENT_SIZE', 1024 * 1024))  # characters per streamed text document
+
+# Parallel PDF extraction
+PDF_PARALLEL_PAGE_THRESHOLD = int(os.environ.get('PDF_PARALLEL_PAGE_THRESHOLD', 100))  # 0 disables
+PDF_EXTRACTION_WORKERS = int(os.environ.get('PDF_EXTRACTION_WORKERS', os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', 25))
+
+# Chunking
+CHUNK_TOKENS = int(os.environ.get('CHUNK_TOKENS', 256))  # tokens per chunk
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 50))  # tokens shared by consecutive chunks
+CHUNK_SEPARATORS = ("\n\n", "\n", ". ", " ")  # preferred break points, best first
+
+# Approximates subword tokenization: words are counted in pieces of up to 8
+# characters and each punctuation character is its own token.
+TOKEN_PATTERN = re.compile(r"\w{1,8}|[^\w\s]")
+
+# Streaming ingest pipeline
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', EMBEDDING_BATCH_SIZE * EMBEDDING_CONCURRENCY))  # chunks per embed/write batch
+INGEST_QUEUE_DEPTH = int(os.environ.get('INGEST_QUEUE_DEPTH', 2))  # batches buffered between stages
+
+# S3 key resolution
+KEY_RESOLUTION_CACHE_SIZE = int(os.environ.get('KEY_RESOLUTION_CACHE_SIZE', 1024))
+KEY_RESOLUTION_LIST_PAGE_SIZE = int(os.environ.get('KEY_RESOLUTION_LIST_PAGE_SIZE', 100))
+KEY_RESOLUTION_LIST_MAX_PAGES = int(os.environ.get('KEY_RESOLUTION_LIST_MAX_PAGES', 1))
+
+# Event records processed concurrently per invocation
+RECORD_CONCURRENCY = int(os.environ.get('RECORD_CONCURRENCY', 4))
+
+# Incremental re-ingest of re-uploaded documents
+INCREMENTAL_REINGEST = os.environ.get('INCREMENTAL_REINGEST', 'true').lower() == 'true'
+
+# Secret cache
+SECRET_CACHE_TTL = int(os.environ.get('SECRET_CACHE_TTL', 900))  # seconds
+SECRET_CACHE_REFRESH_AHEAD = int(os.environ.get('SECRET_CACHE_REFRESH_AHEAD', 60))  # seconds
+
+
+class SecretCache:
+    """
+    TTL cache for secrets with single-flight refresh.
+    
+    Concurrent callers that miss the cache wait for a single fetch. Entries
+    close to expiry are served while one background thread refreshes them.
+    """
+
+    def __init__(self, ttl: float, refresh_ahead: float):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._entries = {}  # name -> (value, fetched_at)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _name_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _fetch(self, name: str, fetch):
+        value = fetch()
+        self._entries[name] = (value, time.monotonic())
+        return value
+
+    def _refresh_in_background(self, name: str, fetch, lock: threading.Lock):
+        try:
+            self._fetch(name, fetch)
+        except Exception as e:
+            logger.warning(f"Background refresh of secret {name} failed: {str(e)}")
+        finally:
+            lock.release()
+
+    def get(self, name: str, fetch, force_refresh: bool = False):
+        """
+        Get a secret value, calling fetch() when it is missing, expired or force_refresh is set.
+        """
+        requested_at = time.monotonic()
+        entry = self._entries.get(name)
+        if entry is not None and not force_refresh:
+            value, fetched_at = entry
+            age = requested_at - fetched_at
+            if age < self.ttl:
+                if age >= self.ttl - self.refresh_ahead:
+                    lock = self._name_lock(name)
+                    if lock.acquire(blocking=False):
+                        threading.Thread(
+                            target=self._refresh_in_background, args=(name, fetch, lock), daemon=True
+                        ).start()
+                return value
+        
+        with self._name_lock(name):
+            # Another caller may have fetched the secret while we waited
+            entry = self._entries.get(name)
+            if entry is not None:
+                value, fetched_at = entry
+                fresh = time.monotonic() - fetched_at < self.ttl
+                if fresh and (not force_refresh or fetched_at >= requested_at):
+                    return value
+            return self._fetch(name, fetch)
+
+    def clear(self):
+        self._entries.clear()
+
+
+secret_cache = SecretCache(SECRET_CACHE_TTL, SECRET_CACHE_REFRESH_AHEAD)
+
+
+def fetch_secret_json(secret_uri: str) -> dict:
+    """
+    Fetch a JSON secret from Azure Key Vault.
+    """
+    # Parse URI to get Key Vault name and secret name
+    parts = secret_uri.replace("https://", "").split('/')
+    key_vault_name = parts[0].split('.')[0]
+    secret_name = parts[-1]
+    
+    # Create a SecretClient using DefaultAzureCredential
+    credential = DefaultAzureCredential()
+    secret_client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
+    
+    # Get the secret
+    secret = secret_client.get_secret(secret_name)
+    return json.loads(secret.value)
 
-def get_gemini_api_key():
+
+def get_gemini_api_key(force_refresh: bool = False):
     """
-    Get Gemini API key from Secrets Manager.
+    Get Gemini API key from Azure Key Vault (cached).
     """
     try:
-        secret_response = secretsmanager.get_secret_value(
-            SecretId=GEMINI_SECRET_ARN
-        )
-        secret = json.loads(secret_response['SecretString'])
+        secret = secret_cache.get(GEMINI_SECRET_URI, lambda: fetch_secret_json(GEMINI_SECRET_URI), force_refresh)
         return secret['GEMINI_API_KEY']
     except Exception as e:
         logger.error(f"Error getting Gemini API key: {str(e)}")
         raise e
 
-# Set up Gemini API key from Secrets Manager
+
+client = None
+client_api_key = None
+_client_lock = threading.Lock()
+
+
+def get_gemini_client(force_refresh: bool = False):
+    """
+    Get a Gemini client for the current API key.
+    
+    The key is read from the secret cache on every call and the client is
+    rebuilt when it changes, so a rotated key is picked up once the cached
+    secret expires. If the key cannot be read, the current client is kept.
+    """
+    global client, client_api_key
+    try:
+        api_key = get_gemini_api_key(force_refresh)
+    except Exception:
+        if client is None:
+            raise
+        return client
+    
+    with _client_lock:
+        if client is None or api_key != client_api_key:
+            client = genai.Client(api_key=api_key)
+            client_api_key = api_key
+        return client
+
+
+def is_api_key_error(error: Exception) -> bool:
+    """
+    Check whether a Gemini API error means the API key was rejected (401/403).
+    """
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    return code in (401, 403)
+
+
+def call_gemini(request: Callable):
+    """
+    Make a Gemini API call, retrying once with a freshly fetched API key if the
+    current key is rejected (e.g. after it was rotated in Key Vault).
+    
+    Args:
+        request (Callable): Function making the call with the client it is given
+    """
+    try:
+        return request(get_gemini_client())
+    except Exception as e:
+        if not is_api_key_error(e):
+            raise
+        logger.warning(f"Gemini API key rejected, refreshing it from Key Vault: {str(e)}")
+        return request(get_gemini_client(force_refresh=True))
+
+# Set up the Gemini client from Azure Key Vault
 try:
-    GEMINI_API_KEY = get_gemini_api_key()
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    get_gemini_client()
 except Exception as e:
     logger.error(f"Error configuring Gemini API: {str(e)}")
 
 
-def embed_documents(texts: List[str]) -> List[List[float]]:
+def estimate_tokens(text: str) -> int:
     """
-    Embed a list of documents
+    Roughly estimate the number of tokens in a text (about 4 characters per token).
     """
-    embeddings = []
+    return max(1, len(text) // 4)
+
+
+def batch_texts(texts: List[str], batch_size: int = None, token_limit: int = None) -> Iterator[List[str]]:
+    """
+    Group texts into consecutive batches bounded by item count and token budget.
+    
+    Args:
+        texts (List[str]): Texts to group, order is preserved
+        batch_size (int): Maximum number of texts per batch
+        token_limit (int): Maximum estimated tokens per batch
+        
+    Yields:
+        List[str]: Next batch of texts
+    """
+    batch_size = batch_size or EMBEDDING_BATCH_SIZE
+    token_limit = token_limit or EMBEDDING_BATCH_TOKEN_LIMIT
+    
+    batch = []
+    batch_tokens = 0
     for text in texts:
-        embedding = embed_query(text)
-        embeddings.append(embedding)
-    return embeddings
+        tokens = estimate_tokens(text)
+        # A single oversized text still goes out on its own
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > token_limit):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    
+    if batch:
+        yield batch
+
+
+class RateLimiter:
+    """
+    Sliding-window limiter for requests per minute and tokens per minute.
+    
+    Shared by all embedding workers so that the combined request rate stays
+    within quota. A 429 from the API pauses every worker via penalize().
+    """
+    WINDOW = 60.0  # seconds
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._events = deque()  # (timestamp, tokens)
+        self._tokens_in_window = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._events and now - self._events[0][0] >= self.WINDOW:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    def acquire(self, tokens: int):
+        """
+        Block until a request of the given token size fits in the budget.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._prune(now)
+                
+                wait = self._paused_until - now
+                if wait <= 0:
+                    fits_requests = len(self._events) < self.requests_per_minute
+                    # Oversized requests are let through once the window is empty
+                    fits_tokens = (self._tokens_in_window + tokens <= self.tokens_per_minute
+                                   or not self._events)
+                    if fits_requests and fits_tokens:
+                        self._events.append((now, tokens))
+                        self._tokens_in_window += tokens
+                        return
+                    wait = self._events[0][0] + self.WINDOW - now
+            
+            time.sleep(max(wait, 0.01))
+
+    def penalize(self, delay: float):
+        """
+        Pause all callers for at least the given number of seconds.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+
+embedding_rate_limiter = RateLimiter(EMBEDDING_RPM_LIMIT, EMBEDDING_TPM_LIMIT)
+_embedding_executor = None
+_embedding_executor_lock = threading.Lock()
+
+
+def get_embedding_executor() -> ThreadPoolExecutor:
+    """
+    Get the process-wide embedding worker pool, creating it on first use.
+    """
+    global _embedding_executor
+    if _embedding_executor is None:
+        with _embedding_executor_lock:
+            if _embedding_executor is None:
+                _embedding_executor = ThreadPoolExecutor(
+                    max_workers=EMBEDDING_CONCURRENCY,
+                    thread_name_prefix='embedding'
+                )
+    return _embedding_executor
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Check whether an API error is a rate-limit (429) or transient overload error.
+    """
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if code in (429, 503):
+        return True
+    message = str(error)
+    return '429' in message or 'RESOURCE_EXHAUSTED' in message or 'UNAVAILABLE' in message
+
+
+def embed_batch(texts: List[str]) -> List[List[float]]:
+    """
+    Embed a batch of texts with a single Gemini embed_content call.
+    
+    Waits for rate-limit budget before each attempt and retries rate-limit
+    errors with exponential backoff.
+    
+    Args:
+        texts (List[str]): Texts to embed
+        
+    Returns:
+        List[List[float]]: One embedding per text, in input order
+        
+    Raises:
+        Exception: If the batch cannot be embedded
+    """
+    tokens = sum(estimate_tokens(text) for text in texts)
+    
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        embedding_rate_limiter.acquire(tokens)
+        try:
+            result = call_gemini(lambda gemini: gemini.models.embed_content(
+                model=GEMINI_EMBEDDING_MODEL,
+                contents=texts,
+                config=types.EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE)
+            ))
+            if len(result.embeddings) != len(texts):
+                raise ValueError(f"Expected {len(texts)} embeddings, got {len(result.embeddings)}")
+            return [list(embedding.values) for embedding in result.embeddings]
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == EMBEDDING_MAX_RETRIES:
+                logger.error(f"Error creating batch embedding for {len(texts)} texts: {str(e)}")
+                raise
+            
+            # Full jitter backoff, applied to every worker sharing the limiter
+            delay = min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * (2 ** attempt))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            logger.warning(f"Embedding rate limited, backing off {delay:.1f}s ({attempt + 1}/{EMBEDDING_MAX_RETRIES}): {str(e)}")
+            embedding_rate_limiter.penalize(delay)
+
+
+class EmbeddingLRUCache:
+    """
+    Thread-safe in-process LRU cache of embeddings keyed by content hash.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+            return embedding
+
+    def put(self, key: str, embedding: List[float]):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+embedding_cache = EmbeddingLRUCache(EMBEDDING_CACHE_SIZE)
+
+
+def embedding_cache_key(text: str, model: str = None, task_type: str = EMBEDDING_TASK_TYPE) -> str:
+    """
+    Build the content-addressed cache key for an embedding.
+    
+    Args:
+        text (str): Embedded text
+        model (str): Embedding model name
+        task_type (str): Embedding task type
+        
+    Returns:
+        str: Key of the form "{model}:{task_type}:{sha256 of text}"
+    """
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return f"{model or GEMINI_EMBEDDING_MODEL}:{task_type}:{text_hash}"
+
+
+def lookup_cached_embeddings(conn, keys: List[str]) -> Dict[str, List[float]]:
+    """
+    Look up embeddings in the persistent PostgreSQL cache tier.
+    
+    Runs inside a savepoint so that a failure never aborts the caller's transaction.
+    
+    Args:
+        conn: PostgreSQL connection
+        keys (List[str]): Cache keys to look up
+        
+    Returns:
+        Dict[str, List[float]]: Embeddings found, by cache key
+    """
+    if not keys:
+        return {}
+    
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SAVEPOINT embedding_cache_lookup")
+        cursor.execute("""
+        SELECT cache_key, embedding::real[]
+        FROM embedding_cache
+        WHERE cache_key = ANY(%s)
+        """, (keys,))
+        found = {cache_key: list(embedding) for cache_key, embedding in cursor.fetchall()}
+        cursor.execute("RELEASE SAVEPOINT embedding_cache_lookup")
+        return found
+    except Exception as e:
+        logger.warning(f"Error reading embedding cache: {str(e)}")
+        cursor.execute("ROLLBACK TO SAVEPOINT embedding_cache_lookup")
+        return {}
+    finally:
+        cursor.close()
+
+
+def store_cached_embeddings(conn, entries: Dict[str, List[float]], model: str = None,
+                            task_type: str = EMBEDDING_TASK_TYPE):
+    """
+    Write embeddings to the persistent PostgreSQL cache tier.
+    
+    Args:
+        conn: PostgreSQL connection
+        entries (Dict[str, List[float]]): Embeddings by cache key
+        model (str): Embedding model name
+        task_type (str): Embedding task type
+    """
+    if not entries:
+        return
+    
+    model = model or GEMINI_EMBEDDING_MODEL
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SAVEPOINT embedding_cache_store")
+        execute_values(cursor, """
+        INSERT INTO embedding_cache (cache_key, model, task_type, embedding)
+        VALUES %s
+        ON CONFLICT (cache_key) DO NOTHING
+        """, [(cache_key, model, task_type, embedding) for cache_key, embedding in entries.items()])
+        cursor.execute("RELEASE SAVEPOINT embedding_cache_store")
+    except Exception as e:
+        logger.warning(f"Error writing embedding cache: {str(e)}")
+        cursor.execute("ROLLBACK TO SAVEPOINT embedding_cache_store")
+    finally:
+        cursor.close()
+
+
+def embed_documents(texts: List[str], batch_size: int = None, token_limit: int = None,
+                    conn=None) -> List[List[float]]:
+    """
+    Embed a list of documents using batched embed_content calls.
+    
+    Embeddings are looked up by content hash in the in-process LRU cache and,
+    when a connection is given, in the persistent PostgreSQL cache. Only the
+    remaining distinct texts are embedded, concurrently on the shared
+    embedding worker pool.
+    
+    Args:
+        texts (List[str]): Texts to embed
+        batch_size (int): Maximum number of texts per request
+        token_limit (int): Maximum estimated tokens per request
+        conn: Optional PostgreSQL connection for the persistent cache tier
+        
+    Returns:
+        List[List[float]]: One embedding per text, in input order
+    """
+    keys = [embedding_cache_key(text) for text in texts]
+    found = {}
+    for cache_key in set(keys):
+        embedding = embedding_cache.get(cache_key)
+        if embedding is not None:
+            found[cache_key] = embedding
+    
+    if conn is not None and EMBEDDING_CACHE_PERSISTENT:
+        persisted = lookup_cached_embeddings(conn, [k for k in set(keys) if k not in found])
+        for cache_key, embedding in persisted.items():
+            embedding_cache.put(cache_key, embedding)
+        found.update(persisted)
+    
+    # Embed each distinct uncached text once
+    missing = {}
+    for cache_key, text in zip(keys, texts):
+        if cache_key not in found and cache_key not in missing:
+            missing[cache_key] = text
+    
+    logger.info(f"Embedding cache: {len(texts) - len(missing)} of {len(texts)} texts served from cache")
+    
+    if missing:
+        executor = get_embedding_executor()
+        missing_keys = list(missing.keys())
+        futures = [executor.submit(embed_batch, batch)
+                   for batch in batch_texts(list(missing.values()), batch_size, token_limit)]
+        
+        computed = []
+        for future in futures:
+            computed.extend(future.result())
+        
+        new_entries = dict(zip(missing_keys, computed))
+        for cache_key, embedding in new_entries.items():
+            embedding_cache.put(cache_key, embedding)
+        if conn is not None and EMBEDDING_CACHE_PERSISTENT:
+            store_cached_embeddings(conn, new_entries)
+        found.update(new_entries)
+    
+    return [found[cache_key] for cache_key in keys]
 
 
 def embed_query(text: str) -> List[float]:
@@ -87,28 +625,24 @@ def embed_query(text: str) -> List[float]:
     Embed text using Gemini and return a flat list of floats for pgvector.
     """
     try:
-        result = client.models.embed_content(
+        result = call_gemini(lambda gemini: gemini.models.embed_content(
             model=GEMINI_EMBEDDING_MODEL,
             contents=text,
-            config=types.EmbedContentConfig(task_type="SEMANTIC_SIMILARITY")
-        )
+            config=types.EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE)
+        ))
         # Access the first embedding object and return its .values
         return list(result.embeddings[0].values)
     except Exception as e:
         logger.error(f"Error creating embedding: {str(e)}")
-        return [0.0] * 768
+        return [0.0] * EMBEDDING_DIMENSION
 
 
-def get_postgres_credentials():
+def get_postgres_credentials(force_refresh: bool = False):
     """
-    Get PostgreSQL credentials from Secrets Manager.
+    Get PostgreSQL credentials from Azure Key Vault (cached).
     """
     try:
-        secret_response = secretsmanager.get_secret_value(
-            SecretId=DB_SECRET_ARN
-        )
-        secret = json.loads(secret_response['SecretString'])
-        return secret
+        return secret_cache.get(DB_SECRET_URI, lambda: fetch_secret_json(DB_SECRET_URI), force_refresh)
     except Exception as e:
         logger.error(f"Error getting PostgreSQL credentials: {str(e)}")
         raise e
@@ -128,17 +662,534 @@ def get_postgres_connection(credentials):
     return conn
 
 
-def get_document_loader(file_path, mime_type):
+def is_auth_error(error: Exception) -> bool:
+    """
+    Check whether a connection error means the credentials were rejected.
+    """
+    if getattr(error, 'pgcode', None) in ('28P01', '28000'):
+        return True
+    return 'password authentication failed' in str(error)
+
+
+def connect_postgres():
+    """
+    Open a new PostgreSQL connection, refreshing cached credentials once if they are rejected.
+    """
+    try:
+        return get_postgres_connection(get_postgres_credentials())
+    except Exception as e:
+        if not is_auth_error(e):
+            raise
+        logger.warning("PostgreSQL rejected cached credentials, refreshing from Key Vault")
+        return get_postgres_connection(get_postgres_credentials(force_refresh=True))
+
+
+class PostgresConnectionPool:
+    """
+    Thread-safe PostgreSQL connection pool reused across warm invocations.
+    
+    Connections are health checked on checkout when they have been idle for a
+    while, and replaced once they exceed their maximum lifetime or break.
+    """
+
+    def __init__(self, connect, min_size: int, max_size: int, max_lifetime: float,
+                 healthcheck_interval: float, timeout: float):
+        self._connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.healthcheck_interval = healthcheck_interval
+        self.timeout = timeout
+        self._idle = deque()  # (conn, last_used)
+        self._created_at = {}  # id(conn) -> creation time
+        self._size = 0
+        self._cond = threading.Condition()
+        
+        for _ in range(min(min_size, max_size)):
+            self._size += 1
+            try:
+                conn = self._open()
+            except Exception as e:
+                logger.warning(f"Error pre-opening pooled PostgreSQL connection: {str(e)}")
+                break
+            self._idle.append((conn, time.monotonic()))
+
+    def _open(self):
+        # The caller has already reserved a slot by incrementing _size
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_usable(self, conn, last_used: float) -> bool:
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if now - self._created_at.get(id(conn), now) > self.max_lifetime:
+            return False
+        if now - last_used > self.healthcheck_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"Pooled PostgreSQL connection failed health check: {str(e)}")
+                return False
+        return True
+
+    def getconn(self):
+        """
+        Check out a healthy connection, opening a new one if the pool has room.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"Timed out waiting for a PostgreSQL connection after {self.timeout}s")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    entry = None
+                    self._size += 1
+            
+            if entry is None:
+                return self._open()
+            
+            conn, last_used = entry
+            if self._is_usable(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, discard: bool = False):
+        """
+        Return a connection to the pool, rolling back any open transaction.
+        """
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """
+        Close all idle connections.
+        """
+        while True:
+            with self._cond:
+                if not self._idle:
+                    return
+                conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool() -> PostgresConnectionPool:
+    """
+    Get the process-wide PostgreSQL connection pool, creating it on first use.
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = PostgresConnectionPool(
+                    connect=connect_postgres,
+                    min_size=POSTGRES_POOL_MIN_SIZE,
+                    max_size=POSTGRES_POOL_MAX_SIZE,
+                    max_lifetime=POSTGRES_POOL_MAX_LIFETIME,
+                    healthcheck_interval=POSTGRES_POOL_HEALTHCHECK_INTERVAL,
+                    timeout=POSTGRES_POOL_TIMEOUT
+                )
+    return _connection_pool
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Check out a pooled PostgreSQL connection for the duration of a with block.
+    
+    Uncommitted work is rolled back when the connection is returned. The
+    connection is returned even when the block is abandoned (for example a
+    generator holding it is closed), and is discarded if the block raised.
+    """
+    pool = get_connection_pool()
+    conn = pool.getconn()
+    failed = True
+    try:
+        yield conn
+        failed = False
+    finally:
+        pool.putconn(conn, discard=failed)
+
+
+# Escapes for PostgreSQL COPY text format
+_COPY_TEXT_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r'
+})
+
+
+def to_pgvector_literal(embedding: List[float]) -> str:
+    """
+    Encode an embedding in pgvector's text format, e.g. "[0.1,0.2,0.3]".
+    
+    Nine significant digits round-trip the float4 values pgvector stores.
+    """
+    return '[' + ','.join(format(value, '.9g') for value in embedding) + ']'
+
+
+def copy_chunks(cursor, rows: List[Tuple]) -> int:
+    """
+    Bulk write chunk rows with COPY ... FROM STDIN.
+    
+    Args:
+        cursor: PostgreSQL cursor
+        rows (List[Tuple]): (chunk_id, document_id, user_id, content, content_hash,
+            metadata_json, embedding, created_at, updated_at) tuples
+            
+    Returns:
+        int: Number of rows written
+    """
+    if not rows:
+        return 0
+    
+    buffer = io.StringIO()
+    for chunk_id, document_id, user_id, content, content_hash, metadata, embedding, created_at, updated_at in rows:
+        buffer.write('\t'.join((
+            str(chunk_id).translate(_COPY_TEXT_ESCAPES),
+            str(document_id).translate(_COPY_TEXT_ESCAPES),
+            str(user_id).translate(_COPY_TEXT_ESCAPES),
+            content.translate(_COPY_TEXT_ESCAPES),
+            content_hash,
+            metadata.translate(_COPY_TEXT_ESCAPES),
+            to_pgvector_literal(embedding),
+            created_at.isoformat(),
+            updated_at.isoformat()
+        )))
+        buffer.write('\n')
+    
+    buffer.seek(0)
+    cursor.copy_expert(
+        "COPY chunks (chunk_id, document_id, user_id, content, content_hash, metadata, embedding, created_at, updated_at) "
+        "FROM STDIN",
+        buffer
+    )
+    return len(rows)
+
+
+def content_hash(text: str) -> str:
+    """
+    Hash chunk content for matching unchanged chunks across re-uploads.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def get_logical_key(cursor, document_id: str) -> str:
+    """
+    Look up the logical document an upload belongs to.
+    
+    upload_handler records the logical key when the upload is registered: an
+    upload that replaces an earlier document inherits that document's key,
+    any other upload starts a new logical document keyed by its own ID.
+    
+    Args:
+        cursor: PostgreSQL cursor
+        document_id (str): Document ID of the upload
+        
+    Returns:
+        str: Logical key of the upload, its document ID if none was recorded
+    """
+    cursor.execute("""
+    SELECT logical_key FROM documents
+    WHERE document_id = %s AND logical_key IS NOT NULL
+    LIMIT 1
+    """, (document_id,))
+    row = cursor.fetchone()
+    return row[0] if row else document_id
+
+
+def find_previous_document(cursor, user_id: str, logical_key: str, document_id: str) -> Optional[str]:
+    """
+    Find the latest processed version of the same logical document by the same user.
+    
+    Every upload is stored under a fresh document ID and object key, so
+    versions are matched on the logical key recorded at upload time rather
+    than on the key or file name; unrelated files that share a name are never
+    diffed against each other.
+    
+    Args:
+        cursor: PostgreSQL cursor
+        user_id (str): User ID
+        logical_key (str): Logical key of the new upload
+        document_id (str): Document ID of the new upload, excluded from the search
+        
+    Returns:
+        Optional[str]: Document ID of the previous version, if any
+    """
+    cursor.execute("""
+    SELECT document_id FROM documents
+    WHERE user_id = %s AND logical_key = %s AND document_id <> %s AND status = 'processed'
+    ORDER BY updated_at DESC
+    LIMIT 1
+    """, (user_id, logical_key, document_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def load_chunk_hashes(cursor, document_id: str) -> Dict[str, deque]:
+    """
+    Load stored chunk IDs of a document grouped by content hash.
+    
+    Rows written before content_hash existed are hashed in the database.
+    
+    Returns:
+        Dict[str, deque]: content hash -> chunk IDs with that content
+    """
+    cursor.execute("""
+    SELECT chunk_id, COALESCE(content_hash, encode(sha256(convert_to(content, 'UTF8')), 'hex'))
+    FROM chunks
+    WHERE document_id = %s
+    ORDER BY id
+    """, (document_id,))
+    
+    existing = {}
+    for chunk_id, chunk_hash in cursor.fetchall():
+        existing.setdefault(chunk_hash, deque()).append(chunk_id)
+    return existing
+
+
+def reassign_chunks(cursor, document_id: str, rows: List[Tuple[str, str]]) -> int:
+    """
+    Move unchanged chunks to a new document version, refreshing their metadata.
+    
+    Args:
+        cursor: PostgreSQL cursor
+        document_id (str): Document ID of the new version
+        rows (List[Tuple[str, str]]): (chunk_id, metadata_json) pairs
+        
+    Returns:
+        int: Number of chunks reassigned
+    """
+    if not rows:
+        return 0
+    
+    now = datetime.now()
+    execute_values(cursor, """
+    UPDATE chunks AS c
+    SET document_id = v.document_id, metadata = v.metadata::jsonb, updated_at = v.updated_at
+    FROM (VALUES %s) AS v (chunk_id, document_id, metadata, updated_at)
+    WHERE c.chunk_id = v.chunk_id
+    """, [(chunk_id, document_id, metadata, now) for chunk_id, metadata in rows])
+    return len(rows)
+
+
+class StreamingTextLoader:
+    """
+    Load a text stream as documents of at most TEXT_SEGMENT_SIZE characters.
+    
+    Segments end on line boundaries where possible and record their character
+    offset in the source as start_index.
+    """
+
+    def __init__(self, stream, source: str, segment_size: int = None):
+        self.stream = stream
+        self.source = source
+        self.segment_size = segment_size or TEXT_SEGMENT_SIZE
+
+    def lazy_load(self) -> Iterator[Document]:
+        text_stream = io.TextIOWrapper(self.stream, encoding='utf-8', errors='replace')
+        segment = []
+        segment_length = 0
+        segment_start = 0
+        for line in text_stream:
+            segment.append(line)
+            segment_length += len(line)
+            if segment_length >= self.segment_size:
+                yield Document(page_content=''.join(segment),
+                               metadata={'source': self.source, 'start_index': segment_start})
+                segment_start += segment_length
+                segment = []
+                segment_length = 0
+        
+        if segment:
+            yield Document(page_content=''.join(segment),
+                           metadata={'source': self.source, 'start_index': segment_start})
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+class StreamingCSVLoader:
+    """
+    Load a CSV stream as one document per row, matching LangChain's CSVLoader output.
+    """
+
+    def __init__(self, stream, source: str):
+        self.stream = stream
+        self.source = source
+
+    def lazy_load(self) -> Iterator[Document]:
+        text_stream = io.TextIOWrapper(self.stream, encoding='utf-8', errors='replace', newline='')
+        for row_number, row in enumerate(csv.DictReader(text_stream)):
+            content = '\n'.join(
+                f"{(name or '').strip()}: {(value if isinstance(value, str) else ','.join(value or [])).strip()}"
+                for name, value in row.items()
+            )
+            yield Document(page_content=content, metadata={'source': self.source, 'row': row_number})
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+class StreamingPDFLoader:
+    """
+    Load a seekable PDF stream as one document per page, matching PyPDFLoader output.
+    """
+
+    def __init__(self, stream, source: str, reader: PdfReader = None):
+        self.stream = stream
+        self.source = source
+        self.reader = reader
+
+    def lazy_load(self) -> Iterator[Document]:
+        reader = self.reader or PdfReader(self.stream)
+        for page_number, page in enumerate(reader.pages):
+            yield Document(page_content=page.extract_text() or '',
+                           metadata={'source': self.source, 'page': page_number})
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+def pdf_page_ranges(page_count: int, pages_per_task: int = None) -> List[Tuple[int, int]]:
+    """
+    Split a PDF's pages into contiguous [start, end) ranges for extraction tasks.
+    """
+    pages_per_task = max(1, pages_per_task or PDF_PAGES_PER_TASK)
+    return [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+
+class ParallelPDFLoader:
+    """
+    Load a large PDF from S3 by extracting page ranges across a process pool.
+    
+    Documents are yielded in page order with the same metadata as
+    StreamingPDFLoader. Workers are spawned rather than forked, since the
+    parent runs the embedding and database threads and a forked child could
+    inherit locks held by them. They run extract_pdf_pages from pdf_extraction,
+    so a spawned worker only imports that module and does not repeat this
+    module's Key Vault, Gemini and AWS setup. If a process pool cannot be
+    started (for example on hosts without /dev/shm), pages are extracted
+    serially instead.
+    """
+
+    def __init__(self, bucket: str, key: str, source: str, page_count: int,
+                 workers: int = None, pages_per_task: int = None, size: int = None):
+        self.bucket = bucket
+        self.key = key
+        self.source = source
+        self.page_count = page_count
+        self.size = size
+        self.workers = max(1, workers or PDF_EXTRACTION_WORKERS)
+        self.pages_per_task = pages_per_task or PDF_PAGES_PER_TASK
+
+    def _documents(self, start: int, texts: List[str]) -> Iterator[Document]:
+        for offset, text in enumerate(texts):
+            yield Document(page_content=text, metadata={'source': self.source, 'page': start + offset})
+
+    def lazy_load(self) -> Iterator[Document]:
+        ranges = pdf_page_ranges(self.page_count, self.pages_per_task)
+        workers = min(self.workers, len(ranges))
+        try:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        except (OSError, NotImplementedError) as e:
+            logger.warning(f"Process pool unavailable, extracting PDF pages serially: {str(e)}")
+            for start, end in ranges:
+                yield from self._documents(start, extract_pdf_pages(self.bucket, self.key, start, end, self.size))
+            return
+        
+        logger.info(f"Extracting {self.page_count} PDF pages in {len(ranges)} tasks across {workers} processes")
+        with executor:
+            # map() yields results in submission order, so pages stay in order
+            results = executor.map(
+                extract_pdf_pages,
+                [self.bucket] * len(ranges), [self.key] * len(ranges),
+                [start for start, _ in ranges], [end for _, end in ranges], [self.size] * len(ranges)
+            )
+            for (start, _), texts in zip(ranges, results):
+                yield from self._documents(start, texts)
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+def get_pdf_loader(stream, source: str):
+    """
+    Choose serial or parallel extraction for a PDF stream based on its page count.
+    
+    Parallel extraction is only used for S3-backed streams, since worker
+    processes re-open the object by bucket and key.
+    """
+    raw = getattr(stream, 'raw', None)
+    reader = PdfReader(stream)
+    if PDF_PARALLEL_PAGE_THRESHOLD > 0 and isinstance(raw, S3RangeReader):
+        page_count = len(reader.pages)
+        if page_count >= PDF_PARALLEL_PAGE_THRESHOLD:
+            return ParallelPDFLoader(raw.bucket, raw.key, source, page_count, size=raw.size)
+    return StreamingPDFLoader(stream, source, reader=reader)
+
+
+def get_document_loader(file_path, mime_type, source: str = None):
     """
     Get the appropriate document loader based on file type.
     
     Args:
-        file_path (str): Path to the file
+        file_path (str or file object): Path to the file, or a readable stream
         mime_type (str): MIME type of the file
+        source (str): Source recorded in document metadata for streams
         
     Returns:
-        LangChain document loader
+        Document loader with load() (and lazy_load() for streams)
     """
+    if not isinstance(file_path, str):
+        # Streaming loaders for file objects
+        stream = file_path
+        if mime_type == 'application/pdf':
+            return get_pdf_loader(stream, source)
+        elif mime_type in ['text/csv', 'application/csv']:
+            return StreamingCSVLoader(stream, source)
+        else:
+            return StreamingTextLoader(stream, source)
+    
     if mime_type == 'application/pdf':
         return PyPDFLoader(file_path)
     elif mime_type == 'text/plain':
@@ -150,27 +1201,226 @@ def get_document_loader(file_path, mime_type):
         return TextLoader(file_path)
 
 
-def chunk_documents(documents: List[Document]) -> List[Document]:
+def split_text_offsets(text: str, chunk_tokens: int = None, overlap_tokens: int = None) -> Iterator[Tuple[int, int]]:
     """
-    Split documents into chunks.
+    Split text into token-budgeted chunks in a single pass, yielding (start, end) offsets.
+    
+    Token positions are found once with TOKEN_PATTERN. Each chunk takes up to
+    chunk_tokens tokens and ends at the best separator in the second half of
+    its window, and the next chunk starts overlap_tokens tokens earlier. No
+    substrings are built; callers slice text only for the chunks they emit.
+    
+    Args:
+        text (str): Text to split
+        chunk_tokens (int): Maximum tokens per chunk
+        overlap_tokens (int): Tokens repeated at the start of the next chunk
+        
+    Yields:
+        Tuple[int, int]: Start and end character offsets of each chunk
+    """
+    chunk_tokens = max(1, chunk_tokens or CHUNK_TOKENS)
+    overlap_tokens = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    overlap_tokens = max(0, min(overlap_tokens, chunk_tokens - 1))
+    
+    starts = [match.start() for match in TOKEN_PATTERN.finditer(text)]
+    token_count = len(starts)
+    
+    first = 0
+    while first < token_count:
+        last = min(first + chunk_tokens, token_count)  # exclusive token index
+        if last < token_count:
+            end = starts[last]
+            # Prefer a natural break in the second half of the window
+            search_from = starts[first + max(1, (last - first) // 2)]
+            for separator in CHUNK_SEPARATORS:
+                position = text.rfind(separator, search_from, end)
+                if position != -1:
+                    end = position + len(separator)
+                    last = bisect_left(starts, end, first + 1, last)
+                    break
+        else:
+            end = len(text)
+        
+        start = starts[first]
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        yield start, end
+        
+        if last >= token_count:
+            break
+        first = max(first + 1, last - overlap_tokens)
+
+
+def chunk_documents(documents: List[Document], chunk_tokens: int = None, overlap_tokens: int = None) -> List[Document]:
+    """
+    Split documents into token-budgeted chunks.
+    
+    Each chunk keeps its document's metadata and records its character
+    offsets in the source as start_index and end_index.
     
     Args:
         documents (List[Document]): List of LangChain documents
+        chunk_tokens (int): Maximum tokens per chunk
+        overlap_tokens (int): Tokens shared by consecutive chunks
         
     Returns:
         List[Document]: List of chunked documents
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-        separators=["\n\n", "\n", " ", ""]
-    )
-    
-    chunks = text_splitter.split_documents(documents)
+    chunks = []
+    for document in documents:
+        text = document.page_content
+        # Streamed text segments carry their own offset in the source
+        base = document.metadata.get('start_index', 0)
+        for start, end in split_text_offsets(text, chunk_tokens, overlap_tokens):
+            metadata = dict(document.metadata)
+            metadata['start_index'] = base + start
+            metadata['end_index'] = base + end
+            chunks.append(Document(page_content=text[start:end], metadata=metadata))
     return chunks
 
 
+def iter_chunks(documents: Iterable[Document]) -> Iterator[Document]:
+    """
+    Chunk documents one at a time as they are loaded.
+    
+    The splitter never merges text across documents, so this yields the same
+    chunks as chunk_documents over the full list.
+    """
+    for document in documents:
+        yield from chunk_documents([document])
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[List]:
+    """
+    Group an iterable into lists of at most batch_size items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class PipelineStage(threading.Thread):
+    """
+    Run one stage of the ingest pipeline in a background thread.
+    
+    The stage applies fn to an input iterator and puts each result on a
+    bounded queue, so a slow consumer applies backpressure to the stages
+    before it. Iterating the stage yields its results and re-raises any
+    exception raised inside it.
+    """
+
+    _DONE = object()
+
+    def __init__(self, name: str, fn: Callable[[Iterator], Iterator], items: Iterable, maxsize: int = None):
+        super().__init__(name=f"ingest-{name}", daemon=True)
+        self.fn = fn
+        self.items = items
+        self.output = queue.Queue(maxsize=max(1, maxsize or INGEST_QUEUE_DEPTH))
+        self.error = None
+        self._cancelled = threading.Event()
+
+    def _put(self, item) -> bool:
+        while not self._cancelled.is_set():
+            try:
+                self.output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        results = None
+        try:
+            results = self.fn(iter(self.items))
+            for result in results:
+                if not self._put(result):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            # Close the stage's generator so resources it holds are released now
+            if hasattr(results, 'close'):
+                results.close()
+            self._put(self._DONE)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def __iter__(self) -> Iterator:
+        while True:
+            item = self.output.get()
+            if item is self._DONE:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+
+def embed_chunk_batches(batches: Iterator[List[Document]],
+                        existing: Dict[str, deque] = None) -> Iterator[List[Tuple]]:
+    """
+    Embed each batch of chunks as it arrives, using a pooled connection for the persistent cache.
+    
+    Chunks whose content hash matches a stored chunk in existing are matched
+    to that chunk instead of being embedded; matched IDs are removed from
+    existing, so what remains afterwards are chunks no longer present.
+    
+    Yields:
+        List[Tuple]: (chunk, content_hash, existing_chunk_id, embedding) per chunk,
+            with embedding None for matched chunks
+    """
+    with pooled_connection() as conn:
+        for batch in batches:
+            entries = []
+            for chunk in batch:
+                chunk_hash = content_hash(chunk.page_content)
+                matches = existing.get(chunk_hash) if existing else None
+                entries.append((chunk, chunk_hash, matches.popleft() if matches else None))
+            
+            new_texts = [chunk.page_content for chunk, _, existing_id in entries if existing_id is None]
+            embeddings = iter(embed_documents(new_texts, conn=conn) if new_texts else [])
+            conn.commit()
+            
+            yield [
+                (chunk, chunk_hash, existing_id, None if existing_id is not None else next(embeddings))
+                for chunk, chunk_hash, existing_id in entries
+            ]
+
+
+# Encoding variants of an object key, in the order they are tried. The key
+# as produced by upload_handler always comes first; the variant that last
+# resolved a key is tried next, since one deployment tends to see one form.
+KEY_VARIANTS = {
+    'exact': lambda key: key,
+    'unquote_plus': lambda key: urllib.parse.unquote_plus(key),
+    'quote_plus': lambda key: urllib.parse.quote_plus(urllib.parse.unquote_plus(key), safe='/'),
+    'quote': lambda key: urllib.parse.quote(urllib.parse.unquote_plus(key), safe='/'),
+}
+_key_variant_order = list(KEY_VARIANTS)
+_resolved_keys = OrderedDict()  # (bucket, key) -> (resolved key, object size)
+_resolved_keys_lock = threading.Lock()
+
+
+def _remember_resolved_key(bucket: str, key: str, resolved_key: str, size: Optional[int], variant: str = None):
+    with _resolved_keys_lock:
+        _resolved_keys[(bucket, key)] = (resolved_key, size)
+        _resolved_keys.move_to_end((bucket, key))
+        while len(_resolved_keys) > KEY_RESOLUTION_CACHE_SIZE:
+            _resolved_keys.popitem(last=False)
+        if variant is not None and variant != 'exact' and _key_variant_order[1] != variant:
+            _key_variant_order.remove(variant)
+            _key_variant_order.insert(1, variant)
+
+
+def _normalize_file_name(name: str) -> str:
+    return urllib.parse.unquote_plus(name)
+
+
 def get_s3_object_with_various_encoding(bucket: str, key: str) -> str:
     """
     Try to access an S3 object with different URL encoding methods.
@@ -182,76 +1432,103 @@ def get_s3_object_with_various_encoding(bucket: str, key: str) -> str:
         
     Returns:
         str: The correct S3 key that works
+    """
+    return resolve_s3_object(bucket, key)[0]
+
+
+def resolve_s3_object(bucket: str, key: str) -> Tuple[str, Optional[int]]:
+    """
+    Find the key an S3 object is stored under, trying different URL encodings,
+    and return it with the object's size.
+    
+    Keys resolved earlier are returned from an in-process cache without any
+    request. Otherwise the encoding variants are probed with HEAD, the exact key
+    first and then the variant that worked last, and as a last resort the object's
+    directory is listed in bounded pages, starting at the file name. The size
+    comes from the HEAD or listing that found the object and is cached with the
+    key, so opening the object does not need another HEAD.
+    
+    Args:
+        bucket (str): S3 bucket name
+        key (str): S3 object key to try
+        
+    Returns:
+        Tuple[str, Optional[int]]: The correct S3 key and the object's size in bytes, if known
     
     Raises:
         Exception: If object cannot be found with any encoding approach
     """
+    with _resolved_keys_lock:
+        cached = _resolved_keys.get((bucket, key))
+        if cached is not None:
+            _resolved_keys.move_to_end((bucket, key))
+            variant_order = None
+        else:
+            variant_order = list(_key_variant_order)
+    if cached is not None:
+        logger.info(f"Using cached S3 key resolution: {cached[0]}")
+        return cached
+    
     logger.info(f"Trying to access S3 object with various encodings: s3://{bucket}/{key}")
     
-    # List of keys to try
+    # Distinct keys to try, in the current preferred order
     keys_to_try = []
-    
-    # Original key
-    keys_to_try.append(key)
-    
-    # URL decoded key 
-    decoded_key = urllib.parse.unquote_plus(key)
-    if decoded_key != key:
-        keys_to_try.append(decoded_key)
-    
-    # URL encoded key (convert spaces to +)
-    encoded_key = urllib.parse.quote_plus(decoded_key)
-    if encoded_key != key and encoded_key != decoded_key:
-        keys_to_try.append(encoded_key)
-    
-    # URL encoded key (convert spaces to %20)
-    encoded_key_alt = urllib.parse.quote(decoded_key, safe='/')
-    if encoded_key_alt != key and encoded_key_alt not in keys_to_try:
-        keys_to_try.append(encoded_key_alt)
+    for variant in variant_order:
+        attempt_key = KEY_VARIANTS[variant](key)
+        if all(attempt_key != tried for _, tried in keys_to_try):
+            keys_to_try.append((variant, attempt_key))
     
     # Try all possible keys
-    for attempt_key in keys_to_try:
+    for variant, attempt_key in keys_to_try:
         try:
             logger.info(f"Trying key: {attempt_key}")
-            s3_client.head_object(Bucket=bucket, Key=attempt_key)
+            response = s3_client.head_object(Bucket=bucket, Key=attempt_key)
             logger.info(f"Successfully found S3 object with key: {attempt_key}")
-            return attempt_key
+            size = response.get('ContentLength')
+            _remember_resolved_key(bucket, key, attempt_key, size, variant)
+            return attempt_key, size
         except Exception as e:
             logger.warning(f"Failed to access S3 object with key: {attempt_key}, error: {str(e)}")
     
-    # If we get here, try listing objects with the same prefix
+    # If we get here, list objects next to the file, starting at its name
     try:
-        prefix = '/'.join(key.split('/')[:-1]) + '/'
+        directory, _, file_name = key.rpartition('/')
+        directory = f"{directory}/" if directory else ''
+        expected_filename = _normalize_file_name(file_name)
+        
+        # Characters before the first one that encodings may change are safe to filter on
+        stable_length = next((i for i, c in enumerate(expected_filename) if c in ' +%'), len(expected_filename))
+        prefix = directory + expected_filename[:stable_length]
         logger.info(f"Listing objects with prefix: {prefix}")
-        response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
         
-        if 'Contents' in response:
+        list_kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': KEY_RESOLUTION_LIST_PAGE_SIZE}
+        checked = 0
+        for _ in range(KEY_RESOLUTION_LIST_MAX_PAGES):
+            response = s3_client.list_objects_v2(**list_kwargs)
             for obj in response.get('Contents', []):
                 actual_key = obj['Key']
-                logger.info(f"Found object in bucket: {actual_key}")
+                checked += 1
                 
                 # Check if the filename part matches (ignoring encoding differences)
-                expected_filename = key.split('/')[-1].replace('+', ' ').replace('%20', ' ')
-                actual_filename = actual_key.split('/')[-1].replace('+', ' ').replace('%20', ' ')
-                
-                if expected_filename == actual_filename:
+                actual_filename = actual_key.rpartition('/')[2]
+                if _normalize_file_name(actual_filename) == expected_filename or actual_filename == file_name:
+                    # Listing proves the object exists, so no HEAD is needed
                     logger.info(f"Found matching object: {actual_key}")
-                    # Test if we can access this object
-                    try:
-                        s3_client.head_object(Bucket=bucket, Key=actual_key)
-                        logger.info(f"Successfully accessed matching object: {actual_key}")
-                        return actual_key
-                    except Exception as e:
-                        logger.warning(f"Found matching object but can't access it: {actual_key}, error: {str(e)}")
-                
-            logger.warning(f"No matching object found after checking {len(response.get('Contents', []))} objects with prefix {prefix}")
-        else:
-            logger.warning(f"No objects found with prefix: {prefix}")
+                    size = obj.get('Size')
+                    _remember_resolved_key(bucket, key, actual_key, size)
+                    return actual_key, size
+            
+            if not response.get('IsTruncated'):
+                break
+            list_kwargs['ContinuationToken'] = response['NextContinuationToken']
+        
+        logger.warning(f"No matching object found after checking {checked} objects with prefix {prefix}")
     except Exception as e:
         logger.error(f"Error listing objects in bucket: {str(e)}")
     
     # If we still can't find the object, raise exception with details
-    raise Exception(f"Could not find S3 object in bucket '{bucket}' with key '{key}' or any variation. Tried keys: {keys_to_try}")
+    raise Exception(f"Could not find S3 object in bucket '{bucket}' with key '{key}' or any variation. "
+                    f"Tried keys: {[attempt_key for _, attempt_key in keys_to_try]}")
 
 
 def process_document(bucket: str, key: str, document_id: str, user_id: str, mime_type: str) -> Tuple[int, List[str]]:
@@ -270,7 +1547,7 @@ def process_document(bucket: str, key: str, document_id: str, user_id: str, mime
     """
     # Find the correct key encoding
     try:
-        working_key = get_s3_object_with_various_encoding(bucket, key)
+        working_key, size = resolve_s3_object(bucket, key)
         logger.info(f"Using corrected S3 key: {working_key}")
         
         if working_key != key:
@@ -280,97 +1557,266 @@ def process_document(bucket: str, key: str, document_id: str, user_id: str, mime
         logger.error(f"Failed to find S3 object with any encoding variation: {str(e)}")
         raise
     
-    # Download the file to a temporary location
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        logger.info(f"Downloading S3 object from s3://{bucket}/{key} to {temp_file.name}")
-        s3_client.download_file(bucket, key, temp_file.name)
-        file_path = temp_file.name
+    # Stream the object with ranged reads instead of downloading it
+    logger.info(f"Streaming S3 object from s3://{bucket}/{key}")
+    stream = open_s3_object(bucket, key, size=size)
     
+    stages = []
     try:
-        # Load document using appropriate loader
-        loader = get_document_loader(file_path, mime_type)
-        documents = loader.load()
-        
-        logger.info(f"Loaded {len(documents)} document(s)")
-        
-        # Chunk documents
-        chunks = chunk_documents(documents)
-        
-        logger.info(f"Created {len(chunks)} chunks")
-        
-        # Get PostgreSQL credentials
-        credentials = get_postgres_credentials()
-        conn = get_postgres_connection(credentials)
-        cursor = conn.cursor()
-        
-        # Get file name from key (handle encoding)
-        file_name = key.split('/')[-1]
-        
-        # Store document in PostgreSQL
-        cursor.execute("""
-        INSERT INTO documents (document_id, user_id, file_name, mime_type, status, bucket, key, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-        """, (
-            document_id,
-            user_id,
-            file_name,
-            mime_type,
-            'processed',
-            bucket,
-            key,
-            datetime.now(),
-            datetime.now()
-        ))
-        
-        # Commit the transaction
-        conn.commit()
-        
-        # Store chunks with embeddings in PostgreSQL
-        chunk_ids = []
-        for chunk in chunks:
-            chunk_id = str(uuid.uuid4())
-            chunk_ids.append(chunk_id)
+        # Store document and chunks using a pooled PostgreSQL connection
+        with pooled_connection() as conn:
+            cursor = conn.cursor()
             
-            # Create embedding
-            embedding = embed_query(chunk.page_content)
+            # Get file name from key (handle encoding)
+            file_name = key.split('/')[-1]
             
-            # Prepare metadata
-            metadata = {
-                "source": key,
-                "page": chunk.metadata.get("page", 0) if hasattr(chunk, "metadata") else 0
-            }
+            # Logical document this upload is a version of
+            logical_key = get_logical_key(cursor, document_id)
             
-            # Store in PostgreSQL
+            # Store document in PostgreSQL
             cursor.execute("""
-            INSERT INTO chunks (chunk_id, document_id, user_id, content, metadata, embedding, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO documents (document_id, user_id, file_name, mime_type, status, bucket, key, logical_key, created_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
             """, (
-                chunk_id,
                 document_id,
                 user_id,
-                chunk.page_content,
-                json.dumps(metadata),
-                embedding,
+                file_name,
+                mime_type,
+                'processing',
+                bucket,
+                key,
+                logical_key,
                 datetime.now(),
                 datetime.now()
             ))
-        
-        # Commit the transaction
-        conn.commit()
-        
-        return len(chunks), chunk_ids
+            
+            # Find an earlier version of this document to diff against
+            previous_document_id = None
+            existing = None
+            if INCREMENTAL_REINGEST:
+                previous_document_id = find_previous_document(cursor, user_id, logical_key, document_id)
+                if previous_document_id:
+                    existing = load_chunk_hashes(cursor, previous_document_id)
+                    logger.info(f"Re-ingesting against previous version {previous_document_id} "
+                                f"with {sum(len(ids) for ids in existing.values())} stored chunks")
+            
+            # Commit the transaction
+            conn.commit()
+            
+            # Build the streaming pipeline: load -> chunk -> embed, with the write stage below
+            loader = get_document_loader(stream, mime_type, source=key)
+            documents = loader.lazy_load() if hasattr(loader, 'lazy_load') else loader.load()
+            
+            chunk_stage = PipelineStage(
+                'chunk', lambda docs: iter_batches(iter_chunks(docs), INGEST_BATCH_SIZE), documents
+            )
+            embed_stage = PipelineStage('embed', lambda batches: embed_chunk_batches(batches, existing), chunk_stage)
+            stages = [chunk_stage, embed_stage]
+            for stage in stages:
+                stage.start()
+            
+            # Flush each embedded batch of new chunks to PostgreSQL as it arrives.
+            # Unchanged chunks are moved over from the previous version at the end,
+            # so a failure part way through leaves that version intact.
+            chunk_ids = []
+            kept_rows = []
+            try:
+                for entries in embed_stage:
+                    chunk_rows = []
+                    for chunk, chunk_hash, existing_id, embedding in entries:
+                        # Prepare metadata
+                        chunk_metadata = chunk.metadata if hasattr(chunk, "metadata") else {}
+                        metadata = {
+                            "source": key,
+                            "page": chunk_metadata.get("page", 0),
+                            "row": chunk_metadata.get("row"),
+                            "start_index": chunk_metadata.get("start_index"),
+                            "end_index": chunk_metadata.get("end_index")
+                        }
+                        
+                        if existing_id is not None:
+                            chunk_ids.append(existing_id)
+                            kept_rows.append((existing_id, json.dumps(metadata)))
+                            continue
+                        
+                        chunk_id = str(uuid.uuid4())
+                        chunk_ids.append(chunk_id)
+                        chunk_rows.append((
+                            chunk_id,
+                            document_id,
+                            user_id,
+                            chunk.page_content,
+                            chunk_hash,
+                            json.dumps(metadata),
+                            embedding,
+                            datetime.now(),
+                            datetime.now()
+                        ))
+                    
+                    copy_chunks(cursor, chunk_rows)
+                    conn.commit()
+                    logger.info(f"Stored {len(chunk_ids) - len(kept_rows)} new chunks so far")
+                
+                if previous_document_id:
+                    # Keep unchanged rows, drop chunks that are gone, and retire the old version
+                    reassign_chunks(cursor, document_id, kept_rows)
+                    removed_ids = [chunk_id for ids in existing.values() for chunk_id in ids]
+                    if removed_ids:
+                        cursor.execute("DELETE FROM chunks WHERE chunk_id = ANY(%s)", (removed_ids,))
+                    cursor.execute(
+                        "UPDATE documents SET status = %s, updated_at = %s WHERE document_id = %s",
+                        ('superseded', datetime.now(), previous_document_id)
+                    )
+                    logger.info(f"Re-ingest kept {len(kept_rows)} chunks, added {len(chunk_ids) - len(kept_rows)}, "
+                                f"removed {len(removed_ids)}")
+                
+                cursor.execute(
+                    "UPDATE documents SET status = %s, updated_at = %s WHERE document_id = %s",
+                    ('processed', datetime.now(), document_id)
+                )
+                conn.commit()
+            except Exception:
+                # Remove partially written chunks so a retry starts clean
+                try:
+                    conn.rollback()
+                    cursor.execute("DELETE FROM chunks WHERE document_id = %s", (document_id,))
+                    cursor.execute(
+                        "UPDATE documents SET status = %s, updated_at = %s WHERE document_id = %s",
+                        ('failed', datetime.now(), document_id)
+                    )
+                    conn.commit()
+                except Exception as cleanup_error:
+                    logger.error(f"Error cleaning up partially processed document: {str(cleanup_error)}")
+                raise
+            
+            logger.info(f"Created {len(chunk_ids)} chunks")
+            
+            return len(chunk_ids), chunk_ids
         
     except Exception as e:
         logger.error(f"Error processing document: {str(e)}")
         raise e
     finally:
-        # Clean up temporary file
+        for stage in stages:
+            stage.cancel()
+        for stage in stages:
+            if stage.is_alive():
+                stage.join(timeout=5)
+        stream.close()
+
+
+def mime_type_for_file(file_name: str) -> str:
+    """
+    Determine the MIME type of a document from its file extension.
+    """
+    file_extension = file_name.split('.')[-1].lower()
+    if file_extension == 'pdf':
+        return 'application/pdf'
+    elif file_extension == 'txt':
+        return 'text/plain'
+    elif file_extension == 'csv':
+        return 'text/csv'
+    return 'application/octet-stream'
+
+
+def process_record(record: dict) -> dict:
+    """
+    Process one S3 event record and store its metadata in DynamoDB.
+    
+    Args:
+        record (dict): S3 event notification record
+        
+    Returns:
+        dict: Per-record result with the document ID and number of chunks
+    """
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
+    
+    # URL decode the key to handle potential encoding issues
+    try:
+        decoded_key = urllib.parse.unquote_plus(key)
+        if decoded_key != key:
+            logger.info(f"URL decoded key from '{key}' to '{decoded_key}'")
+            key = decoded_key
+    except Exception as e:
+        logger.warning(f"Error decoding key: {str(e)}")
+    
+    # Process the document
+    logger.info(f"Processing document: {key} from bucket: {bucket}")
+    
+    # Extract document ID and user ID from key
+    # Format: uploads/{user_id}/{document_id}/{file_name}
+    parts = key.split('/')
+    if len(parts) >= 4:
+        user_id = parts[1]
+        document_id = parts[2]
+        file_name = parts[3]
+    else:
+        # Fallback if key format is different
+        document_id = key.split('/')[-1].split('.')[0]
+        user_id = 'system'
+        file_name = key.split('/')[-1]
+    
+    # Determine MIME type from file extension
+    mime_type = mime_type_for_file(file_name)
+    
+    # Process the document
+    num_chunks, chunk_ids = process_document(bucket, key, document_id, user_id, mime_type)
+    
+    # Store metadata in DynamoDB
+    metadata_table = dynamodb.Table(METADATA_TABLE)
+    metadata_table.put_item(
+        Item={
+            'id': f"doc#{document_id}",
+            'document_id': document_id,
+            'user_id': user_id,
+            'status': 'processed',
+            'bucket': bucket,
+            'key': key,
+            'num_chunks': num_chunks,
+            'chunk_ids': chunk_ids,
+            'created_at': int(datetime.now().timestamp() * 1000),
+            'updated_at': int(datetime.now().timestamp() * 1000)
+        }
+    )
+    
+    return {
+        'document_id': document_id,
+        'key': key,
+        'status': 'processed',
+        'num_chunks': num_chunks
+    }
+
+
+def process_records(records: List[dict]) -> List[dict]:
+    """
+    Process all records of an event on a bounded worker pool.
+    
+    Workers share the module's PostgreSQL connection pool and embedding
+    executor. A failing record does not stop the others.
+    
+    Args:
+        records (List[dict]): S3 event notification records
+        
+    Returns:
+        List[dict]: One result per record, in record order
+    """
+    def run(index_record):
+        index, record = index_record
         try:
-            os.unlink(file_path)
-            logger.info(f"Temporary file {file_path} cleaned up")
+            return process_record(record)
         except Exception as e:
-            logger.warning(f"Error cleaning up temporary file {file_path}: {str(e)}")
+            logger.error(f"Error processing record {index}: {str(e)}")
+            key = record.get('s3', {}).get('object', {}).get('key')
+            return {'key': key, 'status': 'failed', 'error': str(e)}
+    
+    if len(records) == 1:
+        return [run((0, records[0]))]
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(RECORD_CONCURRENCY, len(records))),
+                            thread_name_prefix="record") as executor:
+        return list(executor.map(run, enumerate(records)))
 
 
 def handler(event, context):
@@ -430,73 +1876,29 @@ def handler(event, context):
             
         # Extract bucket and key from the S3 event
         if 'Records' in event:
-            # This is an S3 event notification
-            bucket = event['Records'][0]['s3']['bucket']['name']
-            key = event['Records'][0]['s3']['object']['key']
+            # This is an S3 event notification, possibly with several records
+            results = process_records(event['Records'])
+            failed = [result for result in results if result['status'] == 'failed']
             
-            # URL decode the key to handle potential encoding issues
-            try:
-                decoded_key = urllib.parse.unquote_plus(key)
-                if decoded_key != key:
-                    logger.info(f"URL decoded key from '{key}' to '{decoded_key}'")
-                    key = decoded_key
-            except Exception as e:
-                logger.warning(f"Error decoding key: {str(e)}")
-            
-            # Process the document
-            logger.info(f"Processing document: {key} from bucket: {bucket}")
-            
-            # Extract document ID and user ID from key
-            # Format: uploads/{user_id}/{document_id}/{file_name}
-            parts = key.split('/')
-            if len(parts) >= 4:
-                user_id = parts[1]
-                document_id = parts[2]
-                file_name = parts[3]
+            if not failed:
+                status_code = 200
+            elif len(failed) == len(results):
+                status_code = 500
             else:
-                # Fallback if key format is different
-                document_id = key.split('/')[-1].split('.')[0]
-                user_id = 'system'
-                file_name = key.split('/')[-1]
-            
-            # Determine MIME type from file extension
-            file_extension = file_name.split('.')[-1].lower()
-            if file_extension == 'pdf':
-                mime_type = 'application/pdf'
-            elif file_extension == 'txt':
-                mime_type = 'text/plain'
-            elif file_extension == 'csv':
-                mime_type = 'text/csv'
-            else:
-                mime_type = 'application/octet-stream'
-            
-            # Process the document
-            num_chunks, chunk_ids = process_document(bucket, key, document_id, user_id, mime_type)
+                status_code = 207
             
-            # Store metadata in DynamoDB
-            metadata_table = dynamodb.Table(METADATA_TABLE)
-            metadata_table.put_item(
-                Item={
-                    'id': f"doc#{document_id}",
-                    'document_id': document_id,
-                    'user_id': user_id,
-                    'status': 'processed',
-                    'bucket': bucket,
-                    'key': key,
-                    'num_chunks': num_chunks,
-                    'chunk_ids': chunk_ids,
-                    'created_at': int(datetime.now().timestamp() * 1000),
-                    'updated_at': int(datetime.now().timestamp() * 1000)
-                }
-            )
+            response_body = {
+                'message': f"Processed {len(results) - len(failed)} of {len(results)} document(s)",
+                'results': results
+            }
+            if len(results) == 1 and not failed:
+                response_body['message'] = f"Successfully processed document: {results[0]['document_id']}"
+                response_body['document_id'] = results[0]['document_id']
+                response_body['num_chunks'] = results[0]['num_chunks']
             
             return {
-                'statusCode': 200,
-                'body': json.dumps({
-                    'message': f"Successfully processed document: {document_id}",
-                    'document_id': document_id,
-                    'num_chunks': num_chunks
-                })
+                'statusCode': status_code,
+                'body': json.dumps(response_body)
             }
         else:
             # This is a direct invocation
@@ -514,4 +1916,70 @@ def handler(event, context):
             'body': json.dumps({
                 'message': f"Error processing document: {str(e)}"
             })
-        }
\ No newline at end of file
+        }
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Azure Function to process one uploaded document.
+    
+    Args:
+        req (func.HttpRequest): HTTP request with container, blob_path, document_id,
+            user_id and mime_type
+        
+    Returns:
+        func.HttpResponse: HTTP response
+    """
+    logger.info('Document processor function processed a request.')
+    
+    try:
+        # Parse request body
+        req_body = req.get_json()
+        
+        # Check if this is a health check request
+        if req_body.get('action') == 'healthcheck':
+            return func.HttpResponse(
+                json.dumps({
+                    'message': 'Document processor is healthy',
+                    'stage': STAGE
+                }),
+                mimetype="application/json",
+                status_code=200
+            )
+        
+        container = req_body.get('container', DOCUMENTS_BUCKET)
+        blob_path = req_body.get('blob_path')
+        document_id = req_body.get('document_id')
+        user_id = req_body.get('user_id', 'system')
+        
+        if not blob_path or not document_id:
+            return func.HttpResponse(
+                json.dumps({
+                    'message': 'blob_path and document_id are required'
+                }),
+                mimetype="application/json",
+                status_code=400
+            )
+        
+        mime_type = req_body.get('mime_type') or mime_type_for_file(blob_path)
+        num_chunks, chunk_ids = process_document(container, blob_path, document_id, user_id, mime_type)
+        
+        return func.HttpResponse(
+            json.dumps({
+                'message': f"Successfully processed document: {document_id}",
+                'document_id': document_id,
+                'num_chunks': num_chunks
+            }),
+            mimetype="application/json",
+            status_code=200
+        )
+        
+    except Exception as e:
+        logger.error(f"Error processing document: {str(e)}")
+        return func.HttpResponse(
+            json.dumps({
+                'message': f"Error processing document: {str(e)}"
+            }),
+            mimetype="application/json",
+            status_code=500
+        )
@@ -0,0 +1,130 @@
+"""
+Ranged S3 reads and PDF page extraction for the document processor.
+
+PDF pages are extracted in spawned worker processes that import this module
+rather than document_processor, so it does no I/O at import time: the S3
+client is only created when it is first used, and no secrets or API clients
+are loaded.
+"""
+import os
+import io
+import threading
+import boto3
+from collections import OrderedDict
+from typing import List
+
+from pypdf import PdfReader
+
+# Streaming S3 reads
+BLOB_RANGE_SIZE = int(os.environ.get('BLOB_RANGE_SIZE', 4 * 1024 * 1024))  # bytes per ranged GET
+BLOB_RANGE_CACHE_BLOCKS = int(os.environ.get('BLOB_RANGE_CACHE_BLOCKS', 8))  # ranges kept in memory
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Get the process-wide S3 client, creating it on first use.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client('s3')
+    return _s3_client
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Seekable read-only file object backed by ranged GETs of an S3 object.
+    
+    Reads are served from block-aligned ranges of BLOB_RANGE_SIZE bytes, and
+    only the most recently used BLOB_RANGE_CACHE_BLOCKS ranges are kept, so
+    memory stays bounded regardless of object size.
+    """
+
+    def __init__(self, bucket: str, key: str, size: int = None,
+                 block_size: int = None, max_blocks: int = None):
+        self.bucket = bucket
+        self.key = key
+        self.size = size if size is not None else get_s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.block_size = block_size or BLOB_RANGE_SIZE
+        self.max_blocks = max_blocks or BLOB_RANGE_CACHE_BLOCKS
+        self._blocks = OrderedDict()
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def _block(self, index: int) -> bytes:
+        block = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+        
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        response = get_s3_client().get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")
+        block = response['Body'].read()
+        
+        self._blocks[index] = block
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self._position < self.size:
+            index, offset = divmod(self._position, self.block_size)
+            data = self._block(index)[offset:offset + len(view) - filled]
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            self._position += len(data)
+        return filled
+
+
+def open_s3_object(bucket: str, key: str, size: int = None) -> io.BufferedReader:
+    """
+    Open an S3 object as a buffered, seekable stream without downloading it.
+    
+    The object's size is looked up with a HEAD request unless it is given.
+    """
+    return io.BufferedReader(S3RangeReader(bucket, key, size=size), buffer_size=64 * 1024)
+
+
+def extract_pdf_pages(bucket: str, key: str, start: int, end: int, size: int = None) -> List[str]:
+    """
+    Extract the text of pages [start, end) of a PDF stored in S3.
+    
+    Runs in a worker process, so it opens its own ranged reader over the
+    object instead of receiving the parent's stream; passing the object's
+    size saves each worker a HEAD request.
+    """
+    stream = open_s3_object(bucket, key, size=size)
+    try:
+        reader = PdfReader(stream)
+        return [reader.pages[page_number].extract_text() or '' for page_number in range(start, end)]
+    finally:
+        stream.close()
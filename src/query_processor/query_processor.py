@@ -4,10 +4,23 @@
 Azure Function to process queries and retrieve relevant documents using RAG.
 """
 import os
+import re
+import asyncio
 import json
 import logging
+import time
+import math
+import operator
+import hashlib
+import threading
+import weakref
+import unicodedata
+import numpy as np
 import azure.functions as func
-from typing import List, Dict, Any
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
 from decimal import Decimal
 
 # Azure SDK imports
@@ -16,6 +29,13 @@ from azure.keyvault.secrets import SecretClient
 from azure.storage.blob import BlobServiceClient
 from azure.cosmos import CosmosClient, PartitionKey
 import psycopg2
+from psycopg2.extras import execute_values
+
+# orjson encodes responses several times faster; the standard library is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Gemini AI imports
 from google import genai
@@ -40,33 +60,203 @@ TEMPERATURE = float(os.environ.get('TEMPERATURE', 0.2))
 MAX_OUTPUT_TOKENS = int(os.environ.get('MAX_OUTPUT_TOKENS', 1024))
 TOP_K = int(os.environ.get('TOP_K', 40))
 TOP_P = float(os.environ.get('TOP_P', 0.8))
+EMBEDDING_TASK_TYPE = "SEMANTIC_SIMILARITY"
+EMBEDDING_DIMENSION = 768
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 100))  # texts per embed_content call
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', 1000))
+EMBEDDING_CACHE_TTL = int(os.environ.get('EMBEDDING_CACHE_TTL', 3600))  # seconds, 0 disables expiry
+EMBEDDING_CACHE_STATS_INTERVAL = int(os.environ.get('EMBEDDING_CACHE_STATS_INTERVAL', 100))  # lookups between stats log lines
+EMBEDDING_CACHE_PERSISTENT = os.environ.get('EMBEDDING_CACHE_PERSISTENT', 'true').lower() == 'true'
+POSTGRES_POOL_MIN_SIZE = int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 1))
+POSTGRES_POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10))
+POSTGRES_POOL_MAX_LIFETIME = int(os.environ.get('POSTGRES_POOL_MAX_LIFETIME', 1800))  # seconds
+POSTGRES_POOL_HEALTHCHECK_INTERVAL = int(os.environ.get('POSTGRES_POOL_HEALTHCHECK_INTERVAL', 30))  # seconds
+POSTGRES_POOL_TIMEOUT = float(os.environ.get('POSTGRES_POOL_TIMEOUT', 30))  # seconds
+SECRET_CACHE_TTL = int(os.environ.get('SECRET_CACHE_TTL', 900))  # seconds
+SECRET_CACHE_REFRESH_AHEAD = int(os.environ.get('SECRET_CACHE_REFRESH_AHEAD', 60))  # seconds
+SEARCH_QUALITY = os.environ.get('SEARCH_QUALITY', 'balanced')
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'vector')  # vector or hybrid (needs db_init's content_tsv)
+RETRIEVAL_MODES = ('vector', 'hybrid')
+TEXT_SEARCH_CONFIG = os.environ.get('TEXT_SEARCH_CONFIG', 'english').lower()  # must match db_init
+TEXT_SEARCH_CONFIGS = (
+    'simple', 'arabic', 'armenian', 'basque', 'catalan', 'danish', 'dutch', 'english', 'finnish',
+    'french', 'german', 'greek', 'hindi', 'hungarian', 'indonesian', 'irish', 'italian', 'lithuanian',
+    'nepali', 'norwegian', 'portuguese', 'romanian', 'russian', 'serbian', 'spanish', 'swedish',
+    'tamil', 'turkish', 'yiddish'
+)  # built-in PostgreSQL configurations, the only ones interpolated into SQL
+if TEXT_SEARCH_CONFIG not in TEXT_SEARCH_CONFIGS:
+    logger.warning(f"Unknown text search configuration '{TEXT_SEARCH_CONFIG}', using 'english'")
+    TEXT_SEARCH_CONFIG = 'english'
+HYBRID_CANDIDATES = int(os.environ.get('HYBRID_CANDIDATES', 40))  # candidates per retriever
+RRF_K = int(os.environ.get('RRF_K', 60))  # reciprocal rank fusion constant
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1000))  # 0 disables the response cache
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 600))  # seconds
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', 0.95))  # cosine similarity
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 3000))  # prompt context tokens
+CONTEXT_DUPLICATE_THRESHOLD = float(os.environ.get('CONTEXT_DUPLICATE_THRESHOLD', 0.9))  # shingle Jaccard similarity
+WORD_PATTERN = re.compile(r"\w+")
+MMR_LAMBDA = float(os.environ.get('MMR_LAMBDA', 0.7))  # 1.0 ranks by relevance only
+MMR_FETCH_MULTIPLIER = int(os.environ.get('MMR_FETCH_MULTIPLIER', 4))  # candidates fetched per result
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', 100))  # queries per batch request
+RESULT_CITATION_FIELDS = ('chunk_id', 'document_id', 'file_name', 'similarity_score')  # always returned
+RESULT_OPTIONAL_FIELDS = ('content', 'metadata', 'user_id')  # selectable with 'include'
+RESPONSE_INCLUDE = [field.strip() for field in os.environ.get('RESPONSE_INCLUDE', ','.join(RESULT_OPTIONAL_FIELDS)).split(',') if field.strip()]
+RESPONSE_SNIPPET_LENGTH = int(os.environ.get('RESPONSE_SNIPPET_LENGTH', 0))  # characters of content per result, 0 for all
+BATCH_GENERATION_CONCURRENCY = int(os.environ.get('BATCH_GENERATION_CONCURRENCY', 4))  # answers generated at once
+
+# Index scan settings per search quality level ('exact' disables the vector index)
+SEARCH_QUALITY_SETTINGS = {
+    'fast': {
+        'hnsw.ef_search': int(os.environ.get('HNSW_EF_SEARCH_FAST', 20)),
+        'ivfflat.probes': int(os.environ.get('IVFFLAT_PROBES_FAST', 1))
+    },
+    'balanced': {
+        'hnsw.ef_search': int(os.environ.get('HNSW_EF_SEARCH_BALANCED', 64)),
+        'ivfflat.probes': int(os.environ.get('IVFFLAT_PROBES_BALANCED', 10))
+    },
+    'exact': {
+        'enable_indexscan': 'off'
+    }
+}
 
 # Initialize Azure clients
 credential = DefaultAzureCredential()
 
-# Get Gemini API key from Key Vault
-def get_gemini_api_key():
-    try:
-        # Parse URI to get Key Vault name and secret name
-        parts = GEMINI_SECRET_URI.replace("https://", "").split('/')
-        key_vault_name = parts[0].split('.')[0]
-        secret_name = parts[-1]
-        
-        # Create a SecretClient
-        secret_client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
+# TTL cache for secrets with single-flight refresh. Concurrent callers that miss
+# the cache wait for a single fetch. Entries close to expiry are served while one
+# background thread refreshes them.
+class SecretCache:
+    def __init__(self, ttl: float, refresh_ahead: float):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._entries = {}  # name -> (value, fetched_at)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _name_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _fetch(self, name: str, fetch):
+        value = fetch()
+        self._entries[name] = (value, time.monotonic())
+        return value
+
+    def _refresh_in_background(self, name: str, fetch, lock: threading.Lock):
+        try:
+            self._fetch(name, fetch)
+        except Exception as e:
+            logger.warning(f"Background refresh of secret {name} failed: {str(e)}")
+        finally:
+            lock.release()
+
+    # Get a secret value, calling fetch() when it is missing, expired or force_refresh is set
+    def get(self, name: str, fetch, force_refresh: bool = False):
+        requested_at = time.monotonic()
+        entry = self._entries.get(name)
+        if entry is not None and not force_refresh:
+            value, fetched_at = entry
+            age = requested_at - fetched_at
+            if age < self.ttl:
+                if age >= self.ttl - self.refresh_ahead:
+                    lock = self._name_lock(name)
+                    if lock.acquire(blocking=False):
+                        threading.Thread(
+                            target=self._refresh_in_background, args=(name, fetch, lock), daemon=True
+                        ).start()
+                return value
         
-        # Get the secret
-        secret = secret_client.get_secret(secret_name)
-        credentials = json.loads(secret.value)
+        with self._name_lock(name):
+            # Another caller may have fetched the secret while we waited
+            entry = self._entries.get(name)
+            if entry is not None:
+                value, fetched_at = entry
+                fresh = time.monotonic() - fetched_at < self.ttl
+                if fresh and (not force_refresh or fetched_at >= requested_at):
+                    return value
+            return self._fetch(name, fetch)
+
+    def clear(self):
+        self._entries.clear()
+
+secret_cache = SecretCache(SECRET_CACHE_TTL, SECRET_CACHE_REFRESH_AHEAD)
+
+# Fetch a JSON secret from Key Vault
+def fetch_secret_json(secret_uri: str) -> Dict[str, Any]:
+    # Parse URI to get Key Vault name and secret name
+    parts = secret_uri.replace("https://", "").split('/')
+    key_vault_name = parts[0].split('.')[0]
+    secret_name = parts[-1]
+    
+    # Create a SecretClient
+    secret_client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
+    
+    # Get the secret
+    secret = secret_client.get_secret(secret_name)
+    return json.loads(secret.value)
+
+# Get Gemini API key from Key Vault (cached)
+def get_gemini_api_key(force_refresh: bool = False):
+    try:
+        credentials = secret_cache.get(
+            GEMINI_SECRET_URI, lambda: fetch_secret_json(GEMINI_SECRET_URI), force_refresh
+        )
         return credentials['GEMINI_API_KEY']
     except Exception as e:
         logger.error(f"Error getting Gemini API key: {str(e)}")
         raise e
 
+client = None
+client_api_key = None
+_client_lock = threading.Lock()
+
+# Get a Gemini client for the current API key. The key is read from the secret cache
+# on every call and the client is rebuilt when it changes, so a rotated key is picked
+# up once the cached secret expires. If the key cannot be read, the current client is kept.
+def get_gemini_client(force_refresh: bool = False):
+    global client, client_api_key
+    try:
+        api_key = get_gemini_api_key(force_refresh)
+    except Exception:
+        if client is None:
+            raise
+        return client
+
+    with _client_lock:
+        if client is None or api_key != client_api_key:
+            client = genai.Client(api_key=api_key)
+            client_api_key = api_key
+        return client
+
+# Check whether a Gemini API error means the API key was rejected (401/403)
+def is_api_key_error(error: Exception) -> bool:
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    return code in (401, 403)
+
+# Make a Gemini API call with request(client), retrying once with a freshly fetched
+# API key if the current key is rejected (e.g. after it was rotated in Key Vault)
+def call_gemini(request):
+    try:
+        return request(get_gemini_client())
+    except Exception as e:
+        if not is_api_key_error(e):
+            raise
+        logger.warning(f"Gemini API key rejected, refreshing it from Key Vault: {str(e)}")
+        return request(get_gemini_client(force_refresh=True))
+
+# Async variant of call_gemini for coroutine requests; the forced key refresh runs in a thread
+async def call_gemini_async(request):
+    try:
+        return await request(get_gemini_client())
+    except Exception as e:
+        if not is_api_key_error(e):
+            raise
+        logger.warning(f"Gemini API key rejected, refreshing it from Key Vault: {str(e)}")
+        return await request(await asyncio.to_thread(get_gemini_client, True))
+
 # Initialize Gemini client
 try:
-    GEMINI_API_KEY = get_gemini_api_key()
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    get_gemini_client()
 except Exception as e:
     logger.error(f"Error configuring Gemini API client: {str(e)}")
     raise
@@ -78,37 +268,261 @@ class DecimalEncoder(json.JSONEncoder):
             return float(o)
         return super().default(o)
 
-# Embed a query using Gemini embedding model
-def embed_query(text: str) -> List[float]:
+# Fallback conversion for values orjson does not serialize natively
+def _orjson_default(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+# Encode a response body as compact JSON, with orjson when it is installed
+def encode_json(data: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(data, default=_orjson_default, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    return json.dumps(data, cls=DecimalEncoder, separators=(',', ':'))
+
+# Reduce results to the citation fields plus the requested optional fields,
+# truncating content to snippet_length characters when set
+def shape_results(results: List[Dict[str, Any]], include: List[str] = None,
+                  snippet_length: int = None) -> List[Dict[str, Any]]:
+    include = RESPONSE_INCLUDE if include is None else include
+    snippet_length = RESPONSE_SNIPPET_LENGTH if snippet_length is None else snippet_length
+    fields = RESULT_CITATION_FIELDS + tuple(field for field in RESULT_OPTIONAL_FIELDS if field in include)
+
+    shaped = []
+    for result in results:
+        item = {field: result[field] for field in fields if field in result}
+        if snippet_length and isinstance(item.get('content'), str) and len(item['content']) > snippet_length:
+            item['content'] = item['content'][:snippet_length]
+        shaped.append(item)
+    return shaped
+
+# Thread-safe in-process LRU cache of embeddings keyed by content hash. Entries expire
+# after ttl seconds (0 keeps them until evicted). Hits and misses are counted and
+# logged every stats_interval lookups.
+class EmbeddingLRUCache:
+    def __init__(self, max_size: int, ttl: float = 0, stats_interval: int = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats_interval = stats_interval
+        self._entries = OrderedDict()  # key -> (embedding, expires_at)
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self._hits += 1
+            lookups = self._hits + self._misses
+
+        if self.stats_interval > 0 and lookups % self.stats_interval == 0:
+            self.log_stats()
+        return entry[0] if entry is not None else None
+
+    def put(self, key: str, embedding: List[float]):
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            self._entries[key] = (embedding, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'size': len(self._entries)}
+
+    def log_stats(self):
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups if lookups else 0.0
+        logger.info(f"Query embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                    f"({hit_rate:.1%} hit rate), {stats['size']} entries")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+
+embedding_cache = EmbeddingLRUCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL, EMBEDDING_CACHE_STATS_INTERVAL)
+
+# Normalize query text so that repeats differing only in Unicode form or whitespace
+# share one cache entry; the normalized text is also what gets embedded
+def normalize_query(text: str) -> str:
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+# Content-addressed cache key: model + task type + SHA-256 of the text
+def embedding_cache_key(text: str, model: str = None, task_type: str = EMBEDDING_TASK_TYPE) -> str:
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return f"{model or GEMINI_EMBEDDING_MODEL}:{task_type}:{text_hash}"
+
+# Read an embedding from the persistent PostgreSQL cache tier
+def lookup_cached_embedding(conn, cache_key: str) -> Optional[List[float]]:
     try:
-        result = client.models.embed_content(
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT embedding::real[] FROM embedding_cache WHERE cache_key = %s",
+                (cache_key,)
+            )
+            row = cursor.fetchone()
+        conn.commit()
+        return list(row[0]) if row else None
+    except Exception as e:
+        logger.warning(f"Error reading embedding cache: {str(e)}")
+        conn.rollback()
+        return None
+
+# Write an embedding to the persistent PostgreSQL cache tier
+def store_cached_embedding(conn, cache_key: str, embedding: List[float]):
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO embedding_cache (cache_key, model, task_type, embedding)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO NOTHING
+            """, (cache_key, GEMINI_EMBEDDING_MODEL, EMBEDDING_TASK_TYPE, embedding))
+        conn.commit()
+    except Exception as e:
+        logger.warning(f"Error writing embedding cache: {str(e)}")
+        conn.rollback()
+
+# Run a persistent cache operation on the given connection or a pooled one.
+# Cache failures are logged and never fail the query.
+def _run_cache_operation(conn, operation, *args):
+    if conn is not None:
+        return operation(conn, *args)
+    try:
+        with pooled_connection() as pooled_conn:
+            return operation(pooled_conn, *args)
+    except Exception as e:
+        logger.warning(f"Embedding cache unavailable: {str(e)}")
+        return None
+
+# Embed a query using Gemini embedding model, consulting the embedding cache first.
+# persistent=False skips the PostgreSQL tier, for callers that must not check out
+# a second pooled connection.
+def embed_query(text: str, conn=None, persistent: bool = None) -> List[float]:
+    persistent = EMBEDDING_CACHE_PERSISTENT if persistent is None else persistent
+    text = normalize_query(text)
+    cache_key = embedding_cache_key(text)
+    embedding = embedding_cache.get(cache_key)
+    if embedding is not None:
+        return embedding
+
+    if persistent:
+        embedding = _run_cache_operation(conn, lookup_cached_embedding, cache_key)
+        if embedding is not None:
+            embedding_cache.put(cache_key, embedding)
+            return embedding
+
+    try:
+        result = call_gemini(lambda gemini: gemini.models.embed_content(
             model=GEMINI_EMBEDDING_MODEL,
             contents=text,
-            config=types.EmbedContentConfig(task_type="SEMANTIC_SIMILARITY")
-        )
-        return list(result.embeddings[0].values)
+            config=types.EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE)
+        ))
+        embedding = list(result.embeddings[0].values)
     except Exception as e:
         logger.error(f"Error generating embedding: {str(e)}")
-        return [0.0] * 768
+        return [0.0] * EMBEDDING_DIMENSION
+
+    embedding_cache.put(cache_key, embedding)
+    if persistent:
+        _run_cache_operation(conn, store_cached_embedding, cache_key, embedding)
+    return embedding
 
 # Embed a list of documents
 def embed_documents(texts: List[str]) -> List[List[float]]:
     return [embed_query(text) for text in texts]
 
-# Get PostgreSQL credentials from Key Vault
-def get_postgres_credentials():
+# Read many embeddings from the persistent PostgreSQL cache tier in one query
+def lookup_cached_embeddings(conn, cache_keys: List[str]) -> Dict[str, List[float]]:
     try:
-        # Parse URI to get Key Vault name and secret name
-        parts = DB_SECRET_URI.replace("https://", "").split('/')
-        key_vault_name = parts[0].split('.')[0]
-        secret_name = parts[-1]
-        
-        # Create a SecretClient
-        secret_client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
-        
-        # Get the secret
-        secret = secret_client.get_secret(secret_name)
-        return json.loads(secret.value)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT cache_key, embedding::real[] FROM embedding_cache WHERE cache_key = ANY(%s)",
+                (cache_keys,)
+            )
+            rows = cursor.fetchall()
+        conn.commit()
+        return {cache_key: list(embedding) for cache_key, embedding in rows}
+    except Exception as e:
+        logger.warning(f"Error reading embedding cache: {str(e)}")
+        conn.rollback()
+        return {}
+
+# Write many embeddings to the persistent PostgreSQL cache tier in one statement
+def store_cached_embeddings(conn, entries: Dict[str, List[float]]):
+    try:
+        with conn.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO embedding_cache (cache_key, model, task_type, embedding)
+                VALUES %s
+                ON CONFLICT (cache_key) DO NOTHING
+            """, [(cache_key, GEMINI_EMBEDDING_MODEL, EMBEDDING_TASK_TYPE, embedding)
+                  for cache_key, embedding in entries.items()])
+        conn.commit()
+    except Exception as e:
+        logger.warning(f"Error writing embedding cache: {str(e)}")
+        conn.rollback()
+
+# Embed many queries at once. Cached embeddings are reused and the remaining distinct
+# texts are embedded with batched embed_content calls of up to EMBEDDING_BATCH_SIZE texts.
+def embed_queries(texts: List[str], conn=None) -> List[List[float]]:
+    texts = [normalize_query(text) for text in texts]
+    cache_keys = [embedding_cache_key(text) for text in texts]
+    texts_by_key = dict(zip(cache_keys, texts))
+    embeddings = {}
+    for cache_key in texts_by_key:
+        embedding = embedding_cache.get(cache_key)
+        if embedding is not None:
+            embeddings[cache_key] = embedding
+
+    missing = [cache_key for cache_key in texts_by_key if cache_key not in embeddings]
+    if missing and EMBEDDING_CACHE_PERSISTENT:
+        found = _run_cache_operation(conn, lookup_cached_embeddings, missing) or {}
+        for cache_key, embedding in found.items():
+            embedding_cache.put(cache_key, embedding)
+        embeddings.update(found)
+        missing = [cache_key for cache_key in missing if cache_key not in embeddings]
+
+    generated = {}
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+        try:
+            result = call_gemini(lambda gemini: gemini.models.embed_content(
+                model=GEMINI_EMBEDDING_MODEL,
+                contents=[texts_by_key[cache_key] for cache_key in batch],
+                config=types.EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE)
+            ))
+            if len(result.embeddings) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(result.embeddings)}")
+        except Exception as e:
+            logger.error(f"Error generating embeddings: {str(e)}")
+            for cache_key in batch:
+                embeddings[cache_key] = [0.0] * EMBEDDING_DIMENSION
+            continue
+        for cache_key, result_embedding in zip(batch, result.embeddings):
+            generated[cache_key] = list(result_embedding.values)
+            embedding_cache.put(cache_key, generated[cache_key])
+
+    embeddings.update(generated)
+    if generated and EMBEDDING_CACHE_PERSISTENT:
+        _run_cache_operation(conn, store_cached_embeddings, generated)
+    return [embeddings[cache_key] for cache_key in cache_keys]
+
+# Get PostgreSQL credentials from Key Vault (cached)
+def get_postgres_credentials(force_refresh: bool = False):
+    try:
+        return secret_cache.get(DB_SECRET_URI, lambda: fetch_secret_json(DB_SECRET_URI), force_refresh)
     except Exception as e:
         logger.error(f"Error getting PostgreSQL credentials: {str(e)}")
         raise e
@@ -123,18 +537,273 @@ def get_postgres_connection(creds):
         dbname=creds['dbname']
     )
 
-# Vector similarity search using pgvector
-def similarity_search(query_embedding: List[float], user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
-    credentials = get_postgres_credentials()
-    conn = get_postgres_connection(credentials)
+# Check whether a connection error means the credentials were rejected
+def is_auth_error(error: Exception) -> bool:
+    if getattr(error, 'pgcode', None) in ('28P01', '28000'):
+        return True
+    return 'password authentication failed' in str(error)
+
+# Open a new PostgreSQL connection, refreshing cached credentials once if they are rejected
+def connect_postgres():
+    try:
+        return get_postgres_connection(get_postgres_credentials())
+    except Exception as e:
+        if not is_auth_error(e):
+            raise
+        logger.warning("PostgreSQL rejected cached credentials, refreshing from Key Vault")
+        return get_postgres_connection(get_postgres_credentials(force_refresh=True))
+
+# Thread-safe PostgreSQL connection pool reused across warm invocations.
+# Connections are health checked on checkout when they have been idle for a
+# while, and replaced once they exceed their maximum lifetime or break.
+class PostgresConnectionPool:
+    def __init__(self, connect, min_size: int, max_size: int, max_lifetime: float,
+                 healthcheck_interval: float, timeout: float):
+        self._connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.healthcheck_interval = healthcheck_interval
+        self.timeout = timeout
+        self._idle = deque()  # (conn, last_used)
+        self._created_at = {}  # id(conn) -> creation time
+        self._size = 0
+        self._cond = threading.Condition()
+        
+        for _ in range(min(min_size, max_size)):
+            self._size += 1
+            try:
+                conn = self._open()
+            except Exception as e:
+                logger.warning(f"Error pre-opening pooled PostgreSQL connection: {str(e)}")
+                break
+            self._idle.append((conn, time.monotonic()))
+
+    def _open(self):
+        # The caller has already reserved a slot by incrementing _size
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_usable(self, conn, last_used: float) -> bool:
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if now - self._created_at.get(id(conn), now) > self.max_lifetime:
+            return False
+        if now - last_used > self.healthcheck_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"Pooled PostgreSQL connection failed health check: {str(e)}")
+                return False
+        return True
+
+    # Check out a healthy connection, opening a new one if the pool has room
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"Timed out waiting for a PostgreSQL connection after {self.timeout}s")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    entry = None
+                    self._size += 1
+            
+            if entry is None:
+                return self._open()
+            
+            conn, last_used = entry
+            if self._is_usable(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    # Return a connection to the pool, rolling back any open transaction
+    def putconn(self, conn, discard: bool = False):
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    # Close all idle connections
+    def closeall(self):
+        while True:
+            with self._cond:
+                if not self._idle:
+                    return
+                conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+# Get the process-wide PostgreSQL connection pool, creating it on first use
+def get_connection_pool() -> PostgresConnectionPool:
+    global _connection_pool
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = PostgresConnectionPool(
+                    connect=connect_postgres,
+                    min_size=POSTGRES_POOL_MIN_SIZE,
+                    max_size=POSTGRES_POOL_MAX_SIZE,
+                    max_lifetime=POSTGRES_POOL_MAX_LIFETIME,
+                    healthcheck_interval=POSTGRES_POOL_HEALTHCHECK_INTERVAL,
+                    timeout=POSTGRES_POOL_TIMEOUT
+                )
+    return _connection_pool
 
+# Check out a connection from the process-wide pool (blocking; may open a connection)
+def checkout_connection():
+    return get_connection_pool().getconn()
+
+# Return a connection checked out with checkout_connection
+def release_connection(conn, discard: bool = False):
+    get_connection_pool().putconn(conn, discard=discard)
+
+# Check out a pooled PostgreSQL connection for the duration of a with block.
+# Uncommitted work is rolled back when the connection is returned. The connection
+# is returned even when the block is abandoned, and is discarded if the block raised.
+@contextmanager
+def pooled_connection():
+    conn = checkout_connection()
+    failed = True
     try:
-        cursor = conn.cursor()
+        yield conn
+        failed = False
+    finally:
+        release_connection(conn, discard=failed)
 
-        # Manually convert the Python list to PostgreSQL vector string format
-        vector_str = '[' + ','.join([str(x) for x in query_embedding]) + ']'
+# Apply index scan settings for a search quality level to the current transaction.
+# set_config(..., true) behaves like SET LOCAL and is reset when the transaction ends.
+def apply_search_quality(cursor, search_quality: str, limit: int):
+    settings = dict(SEARCH_QUALITY_SETTINGS[search_quality])
+    if 'hnsw.ef_search' in settings:
+        # HNSW can return at most ef_search rows
+        settings['hnsw.ef_search'] = max(settings['hnsw.ef_search'], limit)
 
-        cursor.execute(f"""
+    names = list(settings.keys())
+    cursor.execute(
+        "SELECT " + ", ".join("set_config(%s, %s, true)" for _ in names),
+        [value for name in names for value in (name, str(settings[name]))]
+    )
+
+# Encode an embedding in pgvector's text format, e.g. "[0.1,0.2,0.3]".
+# Nine significant digits round-trip the float4 values pgvector stores.
+def to_pgvector_literal(embedding: List[float]) -> str:
+    return '[' + ','.join(format(value, '.9g') for value in embedding) + ']'
+
+# Server-side prepared statements, created once per pooled connection.
+# The query vector is bound once as $1 and referenced by both the score and the ORDER BY.
+SIMILARITY_SEARCH_SQL = """
+        PREPARE {name} (vector, text, int) AS
+        SELECT 
+            c.chunk_id,
+            c.document_id,
+            c.user_id,
+            c.content,
+            c.metadata,
+            d.file_name,
+            1 - (c.embedding <=> $1) AS similarity_score{embedding_column}
+        FROM 
+            chunks c
+        JOIN 
+            documents d ON c.document_id = d.document_id
+        WHERE 
+            c.user_id = $2
+        ORDER BY 
+            c.embedding <=> $1
+        LIMIT $3
+    """
+# Hybrid retrieval: vector and full-text candidates fused with reciprocal rank fusion,
+# score = sum(1 / (k + rank)) over the candidate lists a chunk appears in. The fused
+# score is returned after the similarity score for re-ranking.
+# $1 query vector, $2 user_id, $3 query text, $4 candidates per list, $5 limit, $6 k
+HYBRID_SEARCH_SQL = """
+        PREPARE {name} (vector, text, text, int, int, int) AS
+        WITH vector_candidates AS (
+            SELECT c.id, ROW_NUMBER() OVER (ORDER BY c.embedding <=> $1) AS rank
+            FROM chunks c
+            WHERE c.user_id = $2
+            ORDER BY c.embedding <=> $1
+            LIMIT $4
+        ),
+        lexical_candidates AS (
+            SELECT c.id, ROW_NUMBER() OVER (ORDER BY ts_rank_cd(c.content_tsv, q.query) DESC) AS rank
+            FROM chunks c, websearch_to_tsquery('{text_search_config}'::regconfig, $3) AS q(query)
+            WHERE c.user_id = $2 AND c.content_tsv @@ q.query
+            ORDER BY ts_rank_cd(c.content_tsv, q.query) DESC
+            LIMIT $4
+        ),
+        fused AS (
+            SELECT id, SUM(1.0 / ($6 + rank)) AS rrf_score
+            FROM (
+                SELECT id, rank FROM vector_candidates
+                UNION ALL
+                SELECT id, rank FROM lexical_candidates
+            ) candidates
+            GROUP BY id
+        )
+        SELECT 
+            c.chunk_id,
+            c.document_id,
+            c.user_id,
+            c.content,
+            c.metadata,
+            d.file_name,
+            1 - (c.embedding <=> $1) AS similarity_score,
+            f.rrf_score AS fused_score{embedding_column}
+        FROM 
+            fused f
+        JOIN 
+            chunks c ON c.id = f.id
+        JOIN 
+            documents d ON c.document_id = d.document_id
+        ORDER BY 
+            f.rrf_score DESC
+        LIMIT $5
+    """
+# Batch vector search: a LATERAL join runs the top-k search once per query vector.
+# $1 query vectors in pgvector text format, $2 user_id, $3 limit per query
+BATCH_SIMILARITY_SEARCH_SQL = """
+        PREPARE {name} (text[], text, int) AS
+        SELECT 
+            q.ordinality,
+            r.*
+        FROM 
+            unnest($1) WITH ORDINALITY AS q(embedding, ordinality)
+        CROSS JOIN LATERAL (
             SELECT 
                 c.chunk_id,
                 c.document_id,
@@ -142,45 +811,452 @@ def similarity_search(query_embedding: List[float], user_id: str, limit: int = 5
                 c.content,
                 c.metadata,
                 d.file_name,
-                1 - (c.embedding <=> '{vector_str}'::vector) AS similarity_score
+                1 - (c.embedding <=> q.embedding::vector) AS similarity_score{embedding_column}
             FROM 
                 chunks c
             JOIN 
                 documents d ON c.document_id = d.document_id
             WHERE 
-                c.user_id = %s
+                c.user_id = $2
             ORDER BY 
-                c.embedding <=> '{vector_str}'::vector
-            LIMIT %s
-        """, (user_id, limit))
-
-        rows = cursor.fetchall()
-        results = []
-        for row in rows:
-            chunk_id, document_id, user_id, content, metadata, file_name, similarity_score = row
-            results.append({
-                'chunk_id': chunk_id,
-                'document_id': document_id,
-                'user_id': user_id,
-                'content': content,
-                'metadata': metadata,
-                'file_name': file_name,
-                'similarity_score': float(similarity_score)
-            })
+                c.embedding <=> q.embedding::vector
+            LIMIT $3
+        ) r
+        ORDER BY 
+            q.ordinality, r.similarity_score DESC
+    """
+# Each search also has a variant returning candidate embeddings for re-ranking
+PREPARED_STATEMENTS = {}
+for _name, _sql in (('rag_similarity_search', SIMILARITY_SEARCH_SQL), ('rag_hybrid_search', HYBRID_SEARCH_SQL),
+                    ('rag_batch_similarity_search', BATCH_SIMILARITY_SEARCH_SQL)):
+    for _suffix, _embedding_column in (('', ''), ('_embeddings', ',\n            c.embedding')):
+        PREPARED_STATEMENTS[_name + _suffix] = _sql.format(
+            name=_name + _suffix, embedding_column=_embedding_column, text_search_config=TEXT_SEARCH_CONFIG
+        )
+_prepared_statements = weakref.WeakKeyDictionary()  # connection -> set of prepared statement names
 
-        return results
+# Prepare a statement on a connection unless it was already prepared there
+def ensure_prepared(conn, cursor, name: str):
+    prepared = _prepared_statements.setdefault(conn, set())
+    if name not in prepared:
+        cursor.execute(PREPARED_STATEMENTS[name])
+        prepared.add(name)
+
+# Errors raised when the database predates the content_tsv column or websearch_to_tsquery
+def is_missing_text_search_error(error: Exception) -> bool:
+    return getattr(error, 'pgcode', None) in ('42703', '42883')  # undefined_column, undefined_function
+
+# Vector similarity search using pgvector, optionally fused with full-text search.
+# with_embeddings adds each candidate's embedding (as a NumPy array) for re-ranking.
+def similarity_search(query_embedding: List[float], user_id: str, limit: int = 5,
+                      search_quality: str = None, query_text: str = None,
+                      retrieval_mode: str = None, with_embeddings: bool = False) -> List[Dict[str, Any]]:
+    with pooled_connection() as conn:
+        return _similarity_search(conn, query_embedding, user_id, limit, search_quality or SEARCH_QUALITY,
+                                  query_text, retrieval_mode or RETRIEVAL_MODE, with_embeddings)
+
+# Run the similarity search query on an open connection. Hybrid retrieval needs the
+# query text and falls back to vector search on databases without full-text support.
+def _similarity_search(conn, query_embedding: List[float], user_id: str, limit: int,
+                       search_quality: str, query_text: str = None,
+                       retrieval_mode: str = 'vector', with_embeddings: bool = False) -> List[Dict[str, Any]]:
+    suffix = '_embeddings' if with_embeddings else ''
+    cursor = conn.cursor()
+    try:
+        rows = None
+        parse = search_result
+        if retrieval_mode == 'hybrid' and query_text:
+            candidates = max(HYBRID_CANDIDATES, limit)
+            try:
+                apply_search_quality(cursor, search_quality, candidates)
+                ensure_prepared(conn, cursor, 'rag_hybrid_search' + suffix)
+                cursor.execute(
+                    f"EXECUTE rag_hybrid_search{suffix} (%s, %s, %s, %s, %s, %s)",
+                    (to_pgvector_literal(query_embedding), user_id, query_text, candidates, limit, RRF_K)
+                )
+                rows = cursor.fetchall()
+                parse = hybrid_search_result
+            except Exception as e:
+                if not is_missing_text_search_error(e):
+                    raise
+                logger.warning(f"Full-text search unavailable, using vector search: {str(e)}")
+                conn.rollback()
+
+        if rows is None:
+            apply_search_quality(cursor, search_quality, limit)
+            ensure_prepared(conn, cursor, 'rag_similarity_search' + suffix)
+
+            cursor.execute(
+                f"EXECUTE rag_similarity_search{suffix} (%s, %s, %s)",
+                (to_pgvector_literal(query_embedding), user_id, limit)
+            )
+            rows = cursor.fetchall()
+
+        return [parse(row) for row in rows]
 
     except Exception as e:
         logger.error(f"Similarity search failed: {str(e)}")
         raise e
     finally:
         cursor.close()
-        conn.close()
 
-# Generate a response from Gemini using relevant context
-def generate_response(query: str, relevant_chunks: List[Dict[str, Any]]) -> str:
-    context = "\n\n".join([f"Document: {c['file_name']}\nContent: {c['content']}" for c in relevant_chunks])
-    prompt = f"""
+# Run the batch vector search for several query vectors on an open connection.
+# Returns one result list per query vector, in the same order.
+def _batch_similarity_search(conn, query_embeddings: List[List[float]], user_id: str, limit: int,
+                             search_quality: str, with_embeddings: bool = False) -> List[List[Dict[str, Any]]]:
+    name = 'rag_batch_similarity_search' + ('_embeddings' if with_embeddings else '')
+    cursor = conn.cursor()
+    try:
+        apply_search_quality(cursor, search_quality, limit)
+        ensure_prepared(conn, cursor, name)
+        cursor.execute(
+            f"EXECUTE {name} (%s, %s, %s)",
+            ([to_pgvector_literal(embedding) for embedding in query_embeddings], user_id, limit)
+        )
+
+        results = [[] for _ in query_embeddings]
+        for row in cursor.fetchall():
+            results[row[0] - 1].append(search_result(row[1:]))
+        return results
+
+    except Exception as e:
+        logger.error(f"Batch similarity search failed: {str(e)}")
+        raise
+    finally:
+        cursor.close()
+
+# Convert a search result row to a dict; rows from the *_embeddings statements carry
+# the embedding, which is parsed from pgvector's text format
+def search_result(row) -> Dict[str, Any]:
+    chunk_id, document_id, user_id, content, metadata, file_name, similarity_score = row[:7]
+    result = {
+        'chunk_id': chunk_id,
+        'document_id': document_id,
+        'user_id': user_id,
+        'content': content,
+        'metadata': metadata,
+        'file_name': file_name,
+        'similarity_score': float(similarity_score)
+    }
+    if len(row) > 7:
+        embedding = row[7]
+        if isinstance(embedding, str):
+            embedding = embedding.strip('[]').split(',')
+        result['embedding'] = np.asarray(embedding, dtype=np.float32)
+    return result
+
+# Convert a hybrid search row, which carries the fused RRF score after the similarity score
+def hybrid_search_result(row) -> Dict[str, Any]:
+    result = search_result(row[:7] + row[8:])
+    result['fused_score'] = float(row[7])
+    return result
+
+# Maximal marginal relevance: pick k candidates one at a time, each maximizing
+#   mmr_lambda * relevance(c) - (1 - mmr_lambda) * max(sim(c, already selected)),
+# so a chunk that repeats an already selected one loses to a less similar but new one.
+# Relevance is the cosine similarity to the query, or for hybrid candidates the fused
+# score scaled to the best candidate's, so chunks found by full-text search alone keep
+# the rank fusion gave them. Candidates must carry 'embedding'; it is removed from the
+# returned results.
+def mmr_rerank(query_embedding: List[float], candidates: List[Dict[str, Any]], k: int,
+               mmr_lambda: float = None) -> List[Dict[str, Any]]:
+    mmr_lambda = MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+    if not candidates:
+        return []
+
+    embeddings = np.vstack([c['embedding'] for c in candidates]).astype(np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    query = np.array(query_embedding, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+
+    if all('fused_score' in c for c in candidates):
+        relevance = np.array([c['fused_score'] for c in candidates], dtype=np.float32)
+        relevance /= max(float(relevance.max()), 1e-12)
+    else:
+        relevance = embeddings @ query
+    pairwise = embeddings @ embeddings.T
+    max_redundancy = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+
+    selected = []
+    for _ in range(min(k, len(candidates))):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_redundancy = np.maximum(max_redundancy, pairwise[best])
+
+    return [{key: value for key, value in candidates[i].items() if key != 'embedding'} for i in selected]
+
+# Retrieve the chunks used to answer a query: over-fetch candidates and re-rank them
+# with MMR for diversity, or take the top results directly when MMR is disabled.
+# Runs on the given connection, or on a pooled one.
+def retrieve(query_embedding: List[float], user_id: str, query_text: str, limit: int = 5,
+             search_quality: str = None, retrieval_mode: str = None,
+             mmr_lambda: float = None, conn=None) -> List[Dict[str, Any]]:
+    mmr_lambda = MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+    use_mmr = mmr_lambda < 1 and MMR_FETCH_MULTIPLIER > 1
+    fetch_limit = limit * MMR_FETCH_MULTIPLIER if use_mmr else limit
+
+    if conn is None:
+        candidates = similarity_search(query_embedding, user_id, limit=fetch_limit, search_quality=search_quality,
+                                       query_text=query_text, retrieval_mode=retrieval_mode, with_embeddings=use_mmr)
+    else:
+        candidates = _similarity_search(conn, query_embedding, user_id, fetch_limit, search_quality or SEARCH_QUALITY,
+                                        query_text, retrieval_mode or RETRIEVAL_MODE, use_mmr)
+
+    if not use_mmr:
+        return candidates
+    return mmr_rerank(query_embedding, candidates, limit, mmr_lambda)
+
+# Embed a query (unless query_embedding is given) and retrieve its chunks on a connection
+# from checkout_connection, then return the connection to the pool, discarding it if
+# anything raised. The embedding consults the PostgreSQL cache tier on this connection.
+# Releasing in the worker thread means the connection comes back even when the task
+# awaiting the thread is cancelled.
+def retrieve_and_release(conn, query: str, query_embedding: Optional[List[float]], user_id: str,
+                         **kwargs) -> Tuple[List[float], List[Dict[str, Any]]]:
+    failed = True
+    try:
+        if query_embedding is None:
+            query_embedding = embed_query(query, conn=conn)
+        relevant_chunks = retrieve(query_embedding, user_id, query, conn=conn, **kwargs)
+        failed = False
+        return query_embedding, relevant_chunks
+    finally:
+        release_connection(conn, discard=failed)
+
+# Embed a query and retrieve its chunks without blocking the event loop. With the
+# PostgreSQL embedding cache tier enabled, the query is embedded on the connection
+# checked out for retrieval, so a miss in the in-process cache is looked up (and a new
+# embedding stored) without a second pooled connection. Without it, checking out the
+# connection (which may fetch credentials and connect) runs concurrently with embedding
+# the query, so the two round trips overlap.
+async def retrieve_async(query: str, user_id: str, search_quality: str = None, retrieval_mode: str = None,
+                         mmr_lambda: float = None) -> Tuple[List[float], List[Dict[str, Any]]]:
+    if EMBEDDING_CACHE_PERSISTENT:
+        conn = await asyncio.to_thread(checkout_connection)
+        query_embedding = None
+    else:
+        conn, query_embedding = await asyncio.gather(
+            asyncio.to_thread(checkout_connection),
+            asyncio.to_thread(embed_query, query, persistent=False),
+            return_exceptions=True
+        )
+        if isinstance(conn, BaseException):
+            raise conn
+        if isinstance(query_embedding, BaseException):
+            release_connection(conn)
+            raise query_embedding
+
+    return await asyncio.to_thread(
+        retrieve_and_release, conn, query, query_embedding, user_id, search_quality=search_quality,
+        retrieval_mode=retrieval_mode, mmr_lambda=mmr_lambda
+    )
+
+# Retrieve chunks for a batch of queries over one pooled connection. Vector retrieval
+# runs a single LATERAL statement for the whole batch; hybrid retrieval runs the hybrid
+# search per query on the same connection. Candidates are re-ranked as in retrieve().
+def batch_retrieve(query_embeddings: List[List[float]], user_id: str, query_texts: List[str],
+                   limit: int = 5, search_quality: str = None, retrieval_mode: str = None,
+                   mmr_lambda: float = None) -> List[List[Dict[str, Any]]]:
+    search_quality = search_quality or SEARCH_QUALITY
+    retrieval_mode = retrieval_mode or RETRIEVAL_MODE
+    mmr_lambda = MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+    use_mmr = mmr_lambda < 1 and MMR_FETCH_MULTIPLIER > 1
+    fetch_limit = limit * MMR_FETCH_MULTIPLIER if use_mmr else limit
+
+    with pooled_connection() as conn:
+        if retrieval_mode == 'vector':
+            candidate_lists = _batch_similarity_search(conn, query_embeddings, user_id, fetch_limit,
+                                                       search_quality, use_mmr)
+        else:
+            candidate_lists = [
+                _similarity_search(conn, query_embedding, user_id, fetch_limit, search_quality,
+                                   query_text, retrieval_mode, use_mmr)
+                for query_embedding, query_text in zip(query_embeddings, query_texts)
+            ]
+
+    if not use_mmr:
+        return candidate_lists
+    return [mmr_rerank(query_embedding, candidates, limit, mmr_lambda)
+            for query_embedding, candidates in zip(query_embeddings, candidate_lists)]
+
+# Semantic cache of generated answers. An entry is reused for a later query from the
+# same user whose embedding is within RESPONSE_CACHE_SIMILARITY (cosine) of the cached
+# query, provided retrieval returned exactly the same chunks, so answers never outlive
+# the context they were generated from. Entries expire after RESPONSE_CACHE_TTL and the
+# least recently used are evicted beyond RESPONSE_CACHE_SIZE.
+class SemanticResponseCache:
+    def __init__(self, max_size: int, ttl: float, similarity_threshold: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # entry id -> (user_id, unit embedding, chunk fingerprint, response, expires_at)
+        self._by_user = {}  # user_id -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[List[float]]:
+        norm = math.sqrt(sum(value * value for value in embedding))
+        if norm == 0:
+            return None  # e.g. the zero-vector fallback of a failed embedding
+        return [value / norm for value in embedding]
+
+    @staticmethod
+    def fingerprint(chunks: List[Dict[str, Any]]) -> str:
+        return hashlib.sha256('\n'.join(sorted(str(c['chunk_id']) for c in chunks)).encode('utf-8')).hexdigest()
+
+    def _remove(self, entry_id):
+        user_id = self._entries.pop(entry_id)[0]
+        entry_ids = self._by_user[user_id]
+        entry_ids.discard(entry_id)
+        if not entry_ids:
+            del self._by_user[user_id]
+
+    def get(self, user_id: str, embedding: List[float], chunks: List[Dict[str, Any]]) -> Optional[str]:
+        if self.max_size <= 0:
+            return None
+        unit = self._normalize(embedding)
+        if unit is None:
+            return None
+        fingerprint = self.fingerprint(chunks)
+        now = time.monotonic()
+
+        with self._lock:
+            best_id, best_similarity = None, self.similarity_threshold
+            for entry_id in list(self._by_user.get(user_id, ())):
+                _, cached_unit, cached_fingerprint, _, expires_at = self._entries[entry_id]
+                if expires_at <= now:
+                    self._remove(entry_id)
+                    continue
+                if cached_fingerprint != fingerprint:
+                    continue
+                similarity = sum(map(operator.mul, unit, cached_unit))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][3]
+
+    def put(self, user_id: str, embedding: List[float], chunks: List[Dict[str, Any]], response: str):
+        if self.max_size <= 0:
+            return
+        unit = self._normalize(embedding)
+        if unit is None:
+            return
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (user_id, unit, self.fingerprint(chunks), response, time.monotonic() + self.ttl)
+            self._by_user.setdefault(user_id, set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+response_cache = SemanticResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+
+# Rough token estimate (about four characters per token), as used for embedding batches
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+# Word 3-gram shingles used to detect near-duplicate chunks
+def shingles(text: str, size: int = 3) -> set:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+# Character offsets of a chunk in its source text, if the chunker recorded them.
+# The source is a (page, row) pair: CSV rows are chunked separately, so their
+# offsets all start at 0 and only chunks of the same row may be merged.
+def chunk_offsets(chunk: Dict[str, Any]):
+    metadata = chunk.get('metadata') or {}
+    if isinstance(metadata, str):
+        try:
+            metadata = json.loads(metadata)
+        except ValueError:
+            return None
+    start, end = metadata.get('start_index'), metadata.get('end_index')
+    if start is None or end is None:
+        return None
+    row = metadata.get('row')
+    return (metadata.get('page', 0), -1 if row is None else row), start, end
+
+# Build the generation context from retrieved chunks, which arrive best first:
+# 1. drop chunks that nearly duplicate a better-ranked one (e.g. from a re-uploaded file),
+# 2. merge overlapping chunks of the same document page (or CSV row) into one passage,
+# 3. keep the best-ranked passages that fit in the token budget, in rank order.
+def assemble_context(relevant_chunks: List[Dict[str, Any]], token_budget: int = None,
+                     duplicate_threshold: float = None) -> List[Dict[str, Any]]:
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    duplicate_threshold = CONTEXT_DUPLICATE_THRESHOLD if duplicate_threshold is None else duplicate_threshold
+
+    kept = []
+    kept_shingles = []
+    for rank, chunk in enumerate(relevant_chunks):
+        chunk_shingles = shingles(chunk['content'])
+        if any(len(chunk_shingles & other) / len(chunk_shingles | other) >= duplicate_threshold
+               for other in kept_shingles):
+            continue
+        kept.append((rank, chunk))
+        kept_shingles.append(chunk_shingles)
+
+    # Merge overlapping chunks per (document, page, row) by their source offsets
+    passages = []
+    open_passages = {}  # (document_id, (page, row)) -> passages ordered by start offset
+    for rank, chunk in sorted(kept, key=lambda item: (str(item[1].get('document_id')), chunk_offsets(item[1]) or ((0, -1), 0, 0))):
+        offsets = chunk_offsets(chunk)
+        passage = {'rank': rank, 'file_name': chunk['file_name'], 'content': chunk['content']}
+        if offsets is None:
+            passages.append(passage)
+            continue
+
+        source, start, end = offsets
+        group = open_passages.setdefault((chunk.get('document_id'), source), [])
+        previous = group[-1] if group else None
+        if previous is not None and start <= previous['end']:
+            if end > previous['end']:
+                previous['content'] += chunk['content'][previous['end'] - start:]
+                previous['end'] = end
+            previous['rank'] = min(previous['rank'], rank)
+            continue
+
+        passage['end'] = end
+        group.append(passage)
+        passages.append(passage)
+
+    # Pack the most relevant passages into the budget
+    selected = []
+    remaining = token_budget
+    for passage in sorted(passages, key=lambda p: p['rank']):
+        tokens = estimate_tokens(passage['content'])
+        if tokens <= remaining:
+            selected.append(passage)
+            remaining -= tokens
+        elif not selected:
+            # Always include the best passage, truncated to the budget
+            selected.append(dict(passage, content=passage['content'][:token_budget * 4]))
+            remaining = 0
+
+    return [{'file_name': p['file_name'], 'content': p['content']} for p in selected]
+
+GENERATION_ERROR_RESPONSE = "Sorry, I couldn't generate a response. Please try again later."
+
+# Build the grounded generation prompt from the retrieved chunks
+def build_prompt(query: str, relevant_chunks: List[Dict[str, Any]]) -> str:
+    passages = assemble_context(relevant_chunks)
+    context = "\n\n".join([f"Document: {p['file_name']}\nContent: {p['content']}" for p in passages])
+    return f"""
     Answer the following question based on the provided context.
     If the answer is not in the context, say "I don't have enough information."
 
@@ -191,26 +1267,101 @@ def generate_response(query: str, relevant_chunks: List[Dict[str, Any]]) -> str:
 
     Answer:
     """
+
+# Generation settings shared by the sync and async generation paths
+def generation_config():
+    return types.GenerateContentConfig(
+        temperature=TEMPERATURE,
+        top_p=TOP_P,
+        top_k=TOP_K,
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        response_mime_type='application/json'
+    )
+
+# Generate a response from Gemini using relevant context
+def generate_response(query: str, relevant_chunks: List[Dict[str, Any]]) -> str:
+    prompt = build_prompt(query, relevant_chunks)
     try:
-        config = types.GenerateContentConfig(
-            temperature=TEMPERATURE,
-            top_p=TOP_P,
-            top_k=TOP_K,
-            max_output_tokens=MAX_OUTPUT_TOKENS,
-            response_mime_type='application/json'
-        )
-        result = client.models.generate_content(
+        config = generation_config()
+        result = call_gemini(lambda gemini: gemini.models.generate_content(
             model=GEMINI_MODEL,
             contents=prompt,
             config=config
-        )
+        ))
         return result.text
     except Exception as e:
         logger.error(f"Failed to generate response: {str(e)}")
-        return "Sorry, I couldn't generate a response. Please try again later."
+        return GENERATION_ERROR_RESPONSE
 
-# Azure Function entry point
-def main(req: func.HttpRequest) -> func.HttpResponse:
+# Generate a response with the async Gemini client, leaving the event loop free
+# to serve other queries while waiting
+async def generate_response_async(query: str, relevant_chunks: List[Dict[str, Any]]) -> str:
+    prompt = build_prompt(query, relevant_chunks)
+    try:
+        result = await call_gemini_async(lambda gemini: gemini.aio.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=generation_config()
+        ))
+        return result.text
+    except Exception as e:
+        logger.error(f"Failed to generate response: {str(e)}")
+        return GENERATION_ERROR_RESPONSE
+
+# Answer a query from its retrieved chunks, reusing the answer to a near-identical
+# earlier question over the same chunks. Returns the answer and whether it was cached.
+def answer_query(query: str, user_id: str, query_embedding: List[float],
+                 relevant_chunks: List[Dict[str, Any]]) -> Tuple[str, bool]:
+    response = response_cache.get(user_id, query_embedding, relevant_chunks)
+    if response is not None:
+        return response, True
+
+    response = generate_response(query, relevant_chunks)
+    if response != GENERATION_ERROR_RESPONSE:
+        response_cache.put(user_id, query_embedding, relevant_chunks, response)
+    return response, False
+
+# Async variant of answer_query
+async def answer_query_async(query: str, user_id: str, query_embedding: List[float],
+                             relevant_chunks: List[Dict[str, Any]]) -> Tuple[str, bool]:
+    response = response_cache.get(user_id, query_embedding, relevant_chunks)
+    if response is not None:
+        return response, True
+
+    response = await generate_response_async(query, relevant_chunks)
+    if response != GENERATION_ERROR_RESPONSE:
+        response_cache.put(user_id, query_embedding, relevant_chunks, response)
+    return response, False
+
+# Answer a batch of queries, generating at most BATCH_GENERATION_CONCURRENCY at a time
+def answer_queries(queries: List[str], user_id: str, query_embeddings: List[List[float]],
+                   chunk_lists: List[List[Dict[str, Any]]]) -> List[Tuple[str, bool]]:
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_GENERATION_CONCURRENCY, len(queries)))) as executor:
+        return list(executor.map(answer_query, queries, [user_id] * len(queries), query_embeddings, chunk_lists))
+
+# Process a batch of queries: one batched embedding call, one retrieval round trip
+# and bounded-concurrency generation
+def process_query_batch(queries: List[str], user_id: str, search_quality: str = None,
+                        retrieval_mode: str = None, mmr_lambda: float = None) -> List[Dict[str, Any]]:
+    query_embeddings = embed_queries(queries)
+    chunk_lists = batch_retrieve(query_embeddings, user_id, queries, search_quality=search_quality,
+                                 retrieval_mode=retrieval_mode, mmr_lambda=mmr_lambda)
+    answers = answer_queries(queries, user_id, query_embeddings, chunk_lists)
+
+    return [
+        {
+            'query': query,
+            'response': response,
+            'results': relevant_chunks,
+            'count': len(relevant_chunks),
+            'cached': cached
+        }
+        for query, relevant_chunks, (response, cached) in zip(queries, chunk_lists, answers)
+    ]
+
+# Azure Function entry point. The function is async so that one worker serves many
+# concurrent queries; blocking work (database access, embedding, batches) runs in threads.
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logger.info('Query processor function processed a request.')
     
     try:
@@ -229,9 +1380,25 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
         
         query = req_body.get('query')
+        queries = req_body.get('queries')
         user_id = req_body.get('user_id', 'system')
+        search_quality = req_body.get('search_quality', SEARCH_QUALITY)
+        retrieval_mode = req_body.get('retrieval_mode', RETRIEVAL_MODE)
+        mmr_lambda = req_body.get('mmr_lambda', MMR_LAMBDA)
+        include = req_body.get('include', RESPONSE_INCLUDE)
+        snippet_length = req_body.get('snippet_length', RESPONSE_SNIPPET_LENGTH)
         
-        if not query:
+        if queries is not None:
+            if (not isinstance(queries, list) or not queries or len(queries) > BATCH_MAX_QUERIES
+                    or not all(isinstance(q, str) and q for q in queries)):
+                return func.HttpResponse(
+                    json.dumps({
+                        'message': f"queries must be a list of 1 to {BATCH_MAX_QUERIES} non-empty strings"
+                    }),
+                    mimetype="application/json",
+                    status_code=400
+                )
+        elif not query:
             return func.HttpResponse(
                 json.dumps({
                     'message': 'Query is required'
@@ -240,17 +1407,80 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
         
-        query_embedding = embed_query(query)
-        relevant_chunks = similarity_search(query_embedding, user_id)
-        response = generate_response(query, relevant_chunks)
+        if search_quality not in SEARCH_QUALITY_SETTINGS:
+            return func.HttpResponse(
+                json.dumps({
+                    'message': f"search_quality must be one of: {', '.join(SEARCH_QUALITY_SETTINGS)}"
+                }),
+                mimetype="application/json",
+                status_code=400
+            )
+        
+        if retrieval_mode not in RETRIEVAL_MODES:
+            return func.HttpResponse(
+                json.dumps({
+                    'message': f"retrieval_mode must be one of: {', '.join(RETRIEVAL_MODES)}"
+                }),
+                mimetype="application/json",
+                status_code=400
+            )
+        
+        if isinstance(mmr_lambda, bool) or not isinstance(mmr_lambda, (int, float)) or not 0 <= mmr_lambda <= 1:
+            return func.HttpResponse(
+                json.dumps({
+                    'message': 'mmr_lambda must be a number between 0 and 1'
+                }),
+                mimetype="application/json",
+                status_code=400
+            )
+        
+        if not isinstance(include, list) or any(field not in RESULT_OPTIONAL_FIELDS for field in include):
+            return func.HttpResponse(
+                json.dumps({
+                    'message': f"include must be a list of: {', '.join(RESULT_OPTIONAL_FIELDS)}"
+                }),
+                mimetype="application/json",
+                status_code=400
+            )
+        
+        if isinstance(snippet_length, bool) or not isinstance(snippet_length, int) or snippet_length < 0:
+            return func.HttpResponse(
+                json.dumps({
+                    'message': 'snippet_length must be a non-negative integer'
+                }),
+                mimetype="application/json",
+                status_code=400
+            )
+        
+        if queries is not None:
+            results = await asyncio.to_thread(process_query_batch, queries, user_id, search_quality=search_quality,
+                                              retrieval_mode=retrieval_mode, mmr_lambda=mmr_lambda)
+            for result in results:
+                result['results'] = shape_results(result['results'], include, snippet_length)
+            return func.HttpResponse(
+                encode_json({
+                    'results': results,
+                    'count': len(results)
+                }),
+                mimetype="application/json",
+                status_code=200
+            )
+        
+        query_embedding, relevant_chunks = await retrieve_async(query, user_id, search_quality=search_quality,
+                                                                retrieval_mode=retrieval_mode, mmr_lambda=mmr_lambda)
+        
+        sources = shape_results(relevant_chunks, include, snippet_length)
+        
+        response, cached = await answer_query_async(query, user_id, query_embedding, relevant_chunks)
         
         return func.HttpResponse(
-            json.dumps({
+            encode_json({
                 'query': query,
                 'response': response,
-                'results': relevant_chunks,
-                'count': len(relevant_chunks)
-            }, cls=DecimalEncoder),
+                'results': sources,
+                'count': len(sources),
+                'cached': cached
+            }),
             mimetype="application/json",
             status_code=200
         )
@@ -38,6 +38,7 @@ mock_blob_service_client = MagicMock()
 mock_cosmos_client = MagicMock()
 mock_secret_client = MagicMock()
 mock_secret_client.get_secret.return_value = mock_key_vault_secret
+mock_secret_client.return_value.get_secret.return_value = mock_key_vault_secret
 
 # Mock Azure Identity DefaultAzureCredential
 mock_default_credential = MagicMock()
@@ -55,6 +56,7 @@ mock_genai_client = MagicMock()
 mock_psycopg2 = MagicMock()
 mock_psycopg2_extensions = MagicMock()
 mock_psycopg2_extensions.ISOLATION_LEVEL_AUTOCOMMIT = 0
+mock_psycopg2_extras = MagicMock()
 
 # Mock LangChain
 mock_langchain = MagicMock()
@@ -64,6 +66,12 @@ mock_schema = MagicMock()
 mock_langchain_community = MagicMock()
 mock_langchain_community_document_loaders = MagicMock()
 
+# Mock pypdf
+mock_pypdf = MagicMock()
+
+# Mock AWS SDK (S3 access in document_processor)
+mock_boto3 = MagicMock()
+
 # ------------------------------------------------------------------------------
 # Mock Classes
 # ------------------------------------------------------------------------------
@@ -78,6 +86,9 @@ class MockDocument:
 # Module Injection into sys.modules
 # ------------------------------------------------------------------------------
 
+sys.modules['azure'] = MagicMock()
+sys.modules['azure.keyvault'] = MagicMock()
+sys.modules['azure.storage'] = MagicMock()
 sys.modules['azure.identity'] = MagicMock()
 sys.modules['azure.identity'].DefaultAzureCredential = mock_default_credential
 sys.modules['azure.keyvault.secrets'] = MagicMock()
@@ -91,6 +102,7 @@ sys.modules['azure.functions'] = mock_func
 
 sys.modules['psycopg2'] = mock_psycopg2
 sys.modules['psycopg2.extensions'] = mock_psycopg2_extensions
+sys.modules['psycopg2.extras'] = mock_psycopg2_extras
 sys.modules['google'] = mock_google
 sys.modules['google.genai'] = mock_genai
 sys.modules['google.genai.types'] = mock_genai_types
@@ -100,4 +112,6 @@ sys.modules['langchain.text_splitter'] = mock_text_splitter
 sys.modules['langchain.schema'] = mock_schema
 sys.modules['langchain.schema'].Document = MockDocument
 sys.modules['langchain_community'] = mock_langchain_community
-sys.modules['langchain_community.document_loaders'] = mock_langchain_community_document_loaders
\ No newline at end of file
+sys.modules['langchain_community.document_loaders'] = mock_langchain_community_document_loaders
+sys.modules['pypdf'] = mock_pypdf
+sys.modules['boto3'] = mock_boto3
@@ -15,7 +15,8 @@ os.environ["RETRY_DELAY"] = "1"  # Short delay for tests
 # Now import the module under test
 from db_init.db_init import (
     main, get_postgres_credentials, check_dns_resolution,
-    create_database_if_not_exists, initialize_database
+    create_database_if_not_exists, initialize_database,
+    ivfflat_lists_for_rows, create_vector_index, create_text_search_index
 )
 
 class TestDbInit(unittest.TestCase):
@@ -254,6 +255,158 @@ class TestDbInit(unittest.TestCase):
         # Check that pgvector extension is created
         mock_cursor.execute.assert_any_call("CREATE EXTENSION IF NOT EXISTS vector")
         
+    @patch("db_init.db_init.psycopg2")
+    @patch("db_init.db_init.check_dns_resolution")
+    def test_initialize_database_survives_text_search_failure(self, mock_check_dns, mock_psycopg2):
+        """Test that the full-text column is added last and its failure does not abort init."""
+        mock_check_dns.return_value = True
+        mock_cursor = MagicMock()
+        mock_psycopg2.connect.return_value.cursor.return_value = mock_cursor
+        
+        def execute(sql, params=None):
+            if "content_tsv" in sql:
+                raise Exception('text search configuration "english" does not exist')
+        mock_cursor.execute.side_effect = execute
+        
+        result = initialize_database({
+            "host": "test-host", "port": 5432, "username": "test-user",
+            "password": "test-password", "dbname": "test-db"
+        })
+        
+        self.assertTrue(result)
+        executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        cache_position = next(i for i, sql in enumerate(executed) if "embedding_cache" in sql)
+        tsv_position = next(i for i, sql in enumerate(executed) if "content_tsv" in sql)
+        self.assertLess(cache_position, tsv_position)
+
+    @patch("db_init.db_init.TEXT_SEARCH_CONFIG", "english'); DROP TABLE chunks; --")
+    def test_create_text_search_index_rejects_unknown_config(self):
+        """Test that only built-in text search configurations reach the DDL."""
+        mock_cursor = MagicMock()
+        
+        self.assertTrue(create_text_search_index(mock_cursor))
+        
+        column_sql = mock_cursor.execute.call_args_list[0][0][0]
+        self.assertIn("to_tsvector('english'::regconfig, content)", column_sql)
+        self.assertNotIn("DROP TABLE", column_sql)
+
+    def test_ivfflat_lists_for_rows(self):
+        """Test deriving IVFFlat lists from the row count."""
+        self.assertEqual(ivfflat_lists_for_rows(0), 1)
+        self.assertEqual(ivfflat_lists_for_rows(250000), 250)
+        self.assertEqual(ivfflat_lists_for_rows(4000000), 2000)
+
+    def test_create_vector_index_hnsw(self):
+        """Test creating an HNSW index when pgvector supports it."""
+        mock_cursor = MagicMock()
+        # pgvector version, then no existing index
+        mock_cursor.fetchone.side_effect = [("0.7.0",), None]
+
+        result = create_vector_index(mock_cursor)
+
+        self.assertEqual(result, "hnsw")
+        create_sql = mock_cursor.execute.call_args_list[-1][0][0]
+        self.assertIn("USING hnsw (embedding vector_cosine_ops)", create_sql)
+        self.assertIn("m = 16", create_sql)
+        self.assertIn("ef_construction = 64", create_sql)
+
+    def test_create_vector_index_keeps_matching_index(self):
+        """Test that a matching existing index is not rebuilt."""
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.side_effect = [
+            ("0.7.0",),
+            ("CREATE INDEX idx_chunks_embedding ON public.chunks USING hnsw "
+             "(embedding vector_cosine_ops) WITH (m='16', ef_construction='64')",)
+        ]
+
+        result = create_vector_index(mock_cursor)
+
+        self.assertEqual(result, "hnsw")
+        executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        self.assertFalse(any("CREATE INDEX" in sql or "DROP INDEX" in sql for sql in executed))
+
+    def test_create_vector_index_old_pgvector(self):
+        """Test falling back to IVFFlat with lists derived from the row count on old pgvector."""
+        mock_cursor = MagicMock()
+        # pgvector version, no existing index, then the row count
+        mock_cursor.fetchone.side_effect = [("0.4.4",), None, (50000,)]
+
+        result = create_vector_index(mock_cursor)
+
+        self.assertEqual(result, "ivfflat")
+        executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        self.assertIn("USING ivfflat (embedding vector_cosine_ops)", executed[-1])
+        self.assertIn("lists = 50", executed[-1])
+
+    def test_create_vector_index_ignores_row_count_drift(self):
+        """Test that an IVFFlat index with derived lists is kept as the table grows a little."""
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.side_effect = [
+            ("0.4.4",),
+            ("CREATE INDEX idx_chunks_embedding ON public.chunks USING ivfflat "
+             "(embedding vector_cosine_ops) WITH (lists='100')",),
+            (150000,)
+        ]
+
+        result = create_vector_index(mock_cursor)
+
+        self.assertEqual(result, "ivfflat")
+        executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        self.assertFalse(any("CREATE INDEX" in sql or "DROP INDEX" in sql for sql in executed))
+
+    def test_create_vector_index_rebuilds_outgrown_lists(self):
+        """Test that an IVFFlat index with derived lists is rebuilt once they are far off the row count."""
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.side_effect = [
+            ("0.4.4",),
+            ("CREATE INDEX idx_chunks_embedding ON public.chunks USING ivfflat "
+             "(embedding vector_cosine_ops) WITH (lists='1')",),
+            (50000,)
+        ]
+
+        result = create_vector_index(mock_cursor)
+
+        self.assertEqual(result, "ivfflat")
+        executed = [" ".join(c[0][0].split()) for c in mock_cursor.execute.call_args_list]
+        self.assertIn(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chunks_embedding_new ON chunks "
+            "USING ivfflat (embedding vector_cosine_ops) WITH (lists = 50)",
+            executed
+        )
+        self.assertEqual(executed[-1], "ALTER INDEX idx_chunks_embedding_new RENAME TO idx_chunks_embedding")
+
+    def test_create_vector_index_defers_ivfflat_on_empty_table(self):
+        """Test that an IVFFlat index with derived lists is not built while chunks is empty."""
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.side_effect = [("0.4.4",), None, (0,)]
+
+        result = create_vector_index(mock_cursor)
+
+        self.assertIsNone(result)
+        executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        self.assertFalse(any("CREATE INDEX" in sql for sql in executed))
+
+    def test_create_vector_index_rebuilds_concurrently(self):
+        """Test that an index of another type is replaced without dropping it first."""
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.side_effect = [
+            ("0.7.0",),
+            ("CREATE INDEX idx_chunks_embedding ON public.chunks USING ivfflat "
+             "(embedding vector_cosine_ops) WITH (lists='100')",)
+        ]
+
+        result = create_vector_index(mock_cursor)
+
+        self.assertEqual(result, "hnsw")
+        executed = [" ".join(c[0][0].split()) for c in mock_cursor.execute.call_args_list]
+        self.assertEqual(executed[-4:], [
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_chunks_embedding_new",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chunks_embedding_new ON chunks "
+            "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)",
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_chunks_embedding",
+            "ALTER INDEX idx_chunks_embedding_new RENAME TO idx_chunks_embedding"
+        ])
+
     @patch("db_init.db_init.check_dns_resolution")
     @patch("db_init.db_init.time.sleep")
     def test_initialize_database_dns_failure(self, mock_sleep, mock_check_dns):
@@ -1,8 +1,12 @@
 """Test cases for the document_processor Azure Function."""
+import io
 import json
 import os
+import time
 import unittest
 from unittest.mock import MagicMock, patch
+from concurrent.futures import ThreadPoolExecutor
+from langchain.schema import Document
 import tempfile
 
 """Set up test environment."""
@@ -25,7 +29,13 @@ os.environ["SIMILARITY_THRESHOLD"] = "0.7"
 # Now import the module under test - mocks are already in place globally from conftest
 from document_processor.document_processor import (
     main, get_gemini_api_key, get_postgres_credentials, get_postgres_connection,
-    embed_query, embed_documents, get_document_loader, chunk_documents, process_document
+    embed_query, embed_documents, get_document_loader, chunk_documents, process_document,
+    batch_texts, embed_batch, RateLimiter, embedding_cache, embedding_cache_key,
+    copy_chunks, to_pgvector_literal, secret_cache, S3RangeReader,
+    ParallelPDFLoader, pdf_page_ranges, PipelineStage, iter_batches, embed_chunk_batches,
+    PostgresConnectionPool,
+    split_text_offsets, TOKEN_PATTERN, content_hash, process_records, handler,
+    get_s3_object_with_various_encoding, resolve_s3_object, KEY_VARIANTS, _resolved_keys
 )
 
 class TestDocumentProcessor(unittest.TestCase):
@@ -55,6 +65,9 @@ class TestDocumentProcessor(unittest.TestCase):
         
         # Mock download_blob_to_file
         self.mock_blob_client.download_blob_to_file = MagicMock()
+        
+        embedding_cache.clear()
+        secret_cache.clear()
 
     def tearDown(self):
         """Clean up test environment."""
@@ -161,26 +174,132 @@ class TestDocumentProcessor(unittest.TestCase):
         self.assertEqual(result, [0.1, 0.2, 0.3])
         mock_client.models.embed_content.assert_called_once()
 
-    @patch("document_processor.document_processor.embed_query")
-    def test_embed_documents(self, mock_embed_query):
-        """Test embedding multiple documents."""
-        # Mock the embed_query function
-        mock_embed_query.side_effect = [
-            [0.1, 0.2, 0.3],
-            [0.4, 0.5, 0.6]
-        ]
+    @patch("document_processor.document_processor.client")
+    def test_embed_documents(self, mock_client):
+        """Test embedding multiple documents in batched requests."""
+        # Mock one Gemini response per batch
+        def make_response(values):
+            response = MagicMock()
+            response.embeddings = [MagicMock(values=v) for v in values]
+            return response
+
+        # Batches may run concurrently, so answer based on the request contents
+        vectors = {
+            "Document 1": [0.1, 0.2, 0.3],
+            "Document 2": [0.4, 0.5, 0.6],
+            "Document 3": [0.7, 0.8, 0.9]
+        }
+        mock_client.models.embed_content.side_effect = (
+            lambda model, contents, config: make_response([vectors[text] for text in contents])
+        )
 
         # Test documents
-        docs = ["Document 1", "Document 2"]
+        docs = ["Document 1", "Document 2", "Document 3"]
 
         # Call the function
-        result = embed_documents(docs)
+        result = embed_documents(docs, batch_size=2)
 
-        # Verify results
-        self.assertEqual(result, [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
-        self.assertEqual(mock_embed_query.call_count, 2)
-        mock_embed_query.assert_any_call("Document 1")
-        mock_embed_query.assert_any_call("Document 2")
+        # Verify results are returned in input order
+        self.assertEqual(result, [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]])
+        self.assertEqual(mock_client.models.embed_content.call_count, 2)
+        batches = sorted(c[1]["contents"] for c in mock_client.models.embed_content.call_args_list)
+        self.assertEqual(batches, [["Document 1", "Document 2"], ["Document 3"]])
+
+    @patch("document_processor.document_processor.embedding_rate_limiter")
+    @patch("document_processor.document_processor.client")
+    def test_embed_batch_retries_rate_limit(self, mock_client, mock_limiter):
+        """Test that 429 errors back off and retry instead of returning zero vectors."""
+        response = MagicMock()
+        response.embeddings = [MagicMock(values=[0.1, 0.2, 0.3])]
+        mock_client.models.embed_content.side_effect = [
+            Exception("429 RESOURCE_EXHAUSTED"),
+            response
+        ]
+
+        result = embed_batch(["Document 1"])
+
+        self.assertEqual(result, [[0.1, 0.2, 0.3]])
+        self.assertEqual(mock_client.models.embed_content.call_count, 2)
+        mock_limiter.penalize.assert_called_once()
+        self.assertEqual(mock_limiter.acquire.call_count, 2)
+
+    @patch("document_processor.document_processor.embedding_rate_limiter")
+    @patch("document_processor.document_processor.client")
+    def test_embed_batch_raises_on_error(self, mock_client, mock_limiter):
+        """Test that non rate-limit errors are raised."""
+        mock_client.models.embed_content.side_effect = Exception("Invalid argument")
+
+        with self.assertRaises(Exception):
+            embed_batch(["Document 1"])
+
+        self.assertEqual(mock_client.models.embed_content.call_count, 1)
+        mock_limiter.penalize.assert_not_called()
+
+    @patch("document_processor.document_processor.embedding_rate_limiter")
+    @patch("document_processor.document_processor.client_api_key", None)
+    @patch("document_processor.document_processor.genai")
+    @patch("document_processor.document_processor.get_gemini_api_key")
+    def test_embed_batch_refreshes_rejected_api_key(self, mock_get_key, mock_genai, mock_limiter):
+        """Test that a key rotated in Key Vault is fetched again once the old one is rejected."""
+        mock_get_key.side_effect = lambda force_refresh=False: "new-key" if force_refresh else "old-key"
+        rejected = Exception("403 PERMISSION_DENIED")
+        rejected.code = 403
+        old_client, new_client = MagicMock(), MagicMock()
+        old_client.models.embed_content.side_effect = rejected
+        new_client.models.embed_content.return_value.embeddings = [MagicMock(values=[0.1, 0.2])]
+        mock_genai.Client.side_effect = lambda api_key: {"old-key": old_client, "new-key": new_client}[api_key]
+
+        result = embed_batch(["Document 1"])
+
+        self.assertEqual(result, [[0.1, 0.2]])
+        mock_get_key.assert_called_with(True)
+        mock_limiter.penalize.assert_not_called()
+
+    @patch("document_processor.document_processor.time")
+    def test_rate_limiter_waits_for_window(self, mock_time):
+        """Test that the rate limiter blocks once the request budget is used."""
+        clock = [100.0]
+        mock_time.monotonic.side_effect = lambda: clock[0]
+        mock_time.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+
+        limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=1000)
+        limiter.acquire(10)
+        limiter.acquire(10)
+        mock_time.sleep.assert_not_called()
+
+        # Third request must wait for the first one to leave the window
+        limiter.acquire(10)
+        self.assertGreaterEqual(clock[0], 160.0)
+
+    @patch("document_processor.document_processor.store_cached_embeddings")
+    @patch("document_processor.document_processor.lookup_cached_embeddings")
+    @patch("document_processor.document_processor.embed_batch")
+    def test_embed_documents_uses_cache(self, mock_embed_batch, mock_lookup, mock_store):
+        """Test that cached and duplicate texts are not re-embedded."""
+        mock_conn = MagicMock()
+        embedding_cache.put(embedding_cache_key("Cached in memory"), [0.1])
+        mock_lookup.return_value = {embedding_cache_key("Cached in database"): [0.2]}
+        mock_embed_batch.side_effect = lambda texts: [[0.3] for _ in texts]
+
+        texts = ["Cached in memory", "Cached in database", "New text", "New text"]
+        result = embed_documents(texts, conn=mock_conn)
+
+        self.assertEqual(result, [[0.1], [0.2], [0.3], [0.3]])
+        # Only the single distinct uncached text is embedded
+        mock_embed_batch.assert_called_once_with(["New text"])
+        mock_store.assert_called_once_with(mock_conn, {embedding_cache_key("New text"): [0.3]})
+
+    def test_batch_texts(self):
+        """Test grouping texts by batch size and token budget."""
+        texts = ["a" * 40, "b" * 40, "c" * 40, "d" * 400]
+
+        # Batch size limit
+        self.assertEqual(list(batch_texts(texts[:3], batch_size=2, token_limit=1000)),
+                         [texts[:2], texts[2:3]])
+
+        # Token budget limit (~10 tokens per short text, ~100 for the long one)
+        self.assertEqual(list(batch_texts(texts, batch_size=10, token_limit=30)),
+                         [texts[:3], texts[3:]])
 
     @patch("document_processor.document_processor.PyPDFLoader")
     def test_get_document_loader_pdf(self, mock_loader_class):
@@ -226,55 +345,184 @@ class TestDocumentProcessor(unittest.TestCase):
         self.assertEqual(loader, mock_loader)
         mock_loader_class.assert_called_once_with("test.unknown")
 
-    @patch("document_processor.document_processor.RecursiveCharacterTextSplitter")
-    def test_chunk_documents(self, mock_splitter_class):
-        """Test chunking documents."""
-        # Mock the splitter
-        mock_splitter = MagicMock()
-        mock_splitter_class.return_value = mock_splitter
-        
-        # Mock the split_documents method
-        mock_chunks = ["chunk1", "chunk2"]
-        mock_splitter.split_documents.return_value = mock_chunks
-        
-        # Test documents
-        docs = ["doc1", "doc2"]
+    @patch("document_processor.pdf_extraction.get_s3_client")
+    def test_s3_range_reader(self, mock_get_s3_client):
+        """Test seeking and reading an object through ranged GETs."""
+        data = b"0123456789abcdefghij"
+        
+        def get_object(Bucket, Key, Range):
+            start, end = Range[len("bytes="):].split("-")
+            body = MagicMock()
+            body.read.return_value = data[int(start):int(end) + 1]
+            return {"Body": body}
+        
+        mock_s3 = mock_get_s3_client.return_value
+        mock_s3.get_object.side_effect = get_object
+        
+        reader = S3RangeReader("bucket", "key", size=len(data), block_size=8, max_blocks=2)
+        self.assertEqual(reader.read(), data)
+        
+        reader.seek(-5, io.SEEK_END)
+        self.assertEqual(reader.read(3), b"fgh")
+        reader.seek(2)
+        self.assertEqual(reader.read(4), b"2345")
+        self.assertEqual(reader.read(0), b"")
+        mock_s3.get_object.assert_any_call(Bucket="bucket", Key="key", Range="bytes=16-19")
+        self.assertLessEqual(len(reader._blocks), 2)
+
+    def test_streaming_text_loader(self):
+        """Test streaming a text object into line-aligned segments."""
+        stream = io.BytesIO(b"line one\nline two\nline three\n")
+        loader = get_document_loader(stream, "text/plain", source="doc.txt")
+        loader.segment_size = 10
+        
+        documents = loader.load()
+        
+        self.assertEqual([doc.page_content for doc in documents], ["line one\nline two\n", "line three\n"])
+        self.assertEqual(documents[1].metadata, {"source": "doc.txt", "start_index": 18})
+
+    def test_streaming_csv_loader(self):
+        """Test streaming a CSV object as one document per row."""
+        stream = io.BytesIO(b"name,age\nalice,30\nbob,40\n")
+        documents = get_document_loader(stream, "text/csv", source="people.csv").load()
+        
+        self.assertEqual(len(documents), 2)
+        self.assertEqual(documents[1].page_content, "name: bob\nage: 40")
+        self.assertEqual(documents[1].metadata, {"source": "people.csv", "row": 1})
+
+    @patch("document_processor.document_processor.PdfReader")
+    def test_streaming_pdf_loader(self, mock_pdf_reader):
+        """Test streaming a PDF object as one document per page."""
+        page = MagicMock()
+        page.extract_text.return_value = "Page text"
+        mock_pdf_reader.return_value.pages = [page, page]
+        stream = io.BytesIO(b"%PDF")
+        
+        documents = get_document_loader(stream, "application/pdf", source="doc.pdf").load()
+        
+        mock_pdf_reader.assert_called_once_with(stream)
+        self.assertEqual(len(documents), 2)
+        self.assertEqual(documents[1].metadata, {"source": "doc.pdf", "page": 1})
+
+    def test_pdf_page_ranges(self):
+        """Test splitting PDF pages into extraction tasks."""
+        self.assertEqual(pdf_page_ranges(7, 3), [(0, 3), (3, 6), (6, 7)])
+        self.assertEqual(pdf_page_ranges(0, 3), [])
+
+    @patch("document_processor.document_processor.PdfReader")
+    def test_get_document_loader_large_pdf_is_parallel(self, mock_pdf_reader):
+        """Test that S3-backed PDFs above the page threshold are extracted in parallel."""
+        mock_pdf_reader.return_value.pages = [MagicMock()] * 500
+        raw = S3RangeReader("bucket", "uploads/doc.pdf", size=10)
+        stream = io.BufferedReader(raw)
+        
+        loader = get_document_loader(stream, "application/pdf", source="uploads/doc.pdf")
+        
+        self.assertIsInstance(loader, ParallelPDFLoader)
+        self.assertEqual((loader.bucket, loader.key, loader.page_count), ("bucket", "uploads/doc.pdf", 500))
+        # Workers are given the size so they do not each send a HEAD request
+        self.assertEqual(loader.size, 10)
+
+    @patch("document_processor.document_processor.ProcessPoolExecutor")
+    @patch("document_processor.document_processor.extract_pdf_pages")
+    def test_parallel_pdf_loader_keeps_page_order(self, mock_extract, mock_executor):
+        """Test that parallel extraction reassembles pages in order."""
+        mock_executor.side_effect = lambda max_workers, mp_context: ThreadPoolExecutor(max_workers=max_workers)
+        def extract(bucket, key, start, end, size):
+            # Finish early ranges last to exercise reordering
+            time.sleep(0.01 * (10 - start))
+            return [f"Page {n}" for n in range(start, end)]
+        
+        mock_extract.side_effect = extract
+        
+        loader = ParallelPDFLoader("bucket", "doc.pdf", "doc.pdf", page_count=10, workers=4, pages_per_task=3)
+        documents = loader.load()
+        
+        self.assertEqual([doc.page_content for doc in documents], [f"Page {n}" for n in range(10)])
+        self.assertEqual([doc.metadata["page"] for doc in documents], list(range(10)))
+        self.assertEqual(mock_extract.call_count, 4)
+        # Workers must not be forked from the multithreaded parent
+        self.assertEqual(mock_executor.call_args.kwargs["mp_context"].get_start_method(), "spawn")
+
+    @patch("document_processor.document_processor.ProcessPoolExecutor")
+    def test_parallel_pdf_loader_submits_import_safe_function(self, mock_executor):
+        """Test that workers run the extractor from pdf_extraction, not from this module."""
+        mock_executor.return_value.map.return_value = [["Page 0"]]
+        
+        ParallelPDFLoader("bucket", "doc.pdf", "doc.pdf", page_count=1).load()
+        
+        submitted = mock_executor.return_value.map.call_args[0][0]
+        self.assertEqual(submitted.__module__, "document_processor.pdf_extraction")
+
+    @patch("document_processor.document_processor.ProcessPoolExecutor", side_effect=OSError("no /dev/shm"))
+    @patch("document_processor.document_processor.extract_pdf_pages")
+    def test_parallel_pdf_loader_falls_back_to_serial(self, mock_extract, mock_executor):
+        """Test serial extraction when a process pool cannot be started."""
+        mock_extract.side_effect = lambda bucket, key, start, end, size: [f"Page {n}" for n in range(start, end)]
+        
+        documents = ParallelPDFLoader("bucket", "doc.pdf", "doc.pdf", page_count=5, pages_per_task=2).load()
+        
+        self.assertEqual([doc.page_content for doc in documents], [f"Page {n}" for n in range(5)])
+
+    def test_chunk_documents(self):
+        """Test chunking documents by token budget with source offsets."""
+        text = "First sentence here. Second sentence here.\n\nNew paragraph starts now. " * 10
+        docs = [Document(page_content=text, metadata={"page": 3})]
         
         # Call the function
-        result = chunk_documents(docs)
+        result = chunk_documents(docs, chunk_tokens=20, overlap_tokens=5)
         
         # Verify results
-        self.assertEqual(result, mock_chunks)
-        mock_splitter_class.assert_called_once_with(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-            separators=["\n\n", "\n", " ", ""]
-        )
-        mock_splitter.split_documents.assert_called_once_with(docs)
+        self.assertGreater(len(result), 1)
+        for chunk in result:
+            self.assertLessEqual(len(TOKEN_PATTERN.findall(chunk.page_content)), 20)
+            self.assertEqual(chunk.metadata["page"], 3)
+            self.assertEqual(text[chunk.metadata["start_index"]:chunk.metadata["end_index"]], chunk.page_content)
+        
+        # Consecutive chunks overlap and cover the whole text
+        self.assertEqual(result[0].metadata["start_index"], 0)
+        self.assertEqual(result[-1].metadata["end_index"], len(text.rstrip()))
+        for previous, current in zip(result, result[1:]):
+            self.assertLess(current.metadata["start_index"], previous.metadata["end_index"])
+
+    def test_chunk_documents_offsets_streamed_segments(self):
+        """Test that chunk offsets include the segment's offset in the source."""
+        docs = [Document(page_content="alpha beta gamma", metadata={"start_index": 100})]
+        
+        result = chunk_documents(docs, chunk_tokens=2, overlap_tokens=0)
+        
+        self.assertEqual([chunk.page_content for chunk in result], ["alpha beta", "gamma"])
+        self.assertEqual([(c.metadata["start_index"], c.metadata["end_index"]) for c in result], [(100, 110), (111, 116)])
+
+    def test_split_text_offsets_breaks_at_separators(self):
+        """Test that chunks prefer paragraph breaks over mid-sentence cuts."""
+        text = "one two three four.\n\nfive six seven eight"
+        
+        offsets = list(split_text_offsets(text, chunk_tokens=6, overlap_tokens=0))
+        
+        self.assertEqual([text[start:end] for start, end in offsets], ["one two three four.", "five six seven eight"])
 
-    @patch("document_processor.document_processor.tempfile")
+    @patch("document_processor.document_processor.find_previous_document", return_value=None)
+    @patch("document_processor.document_processor.copy_chunks")
+    @patch("document_processor.document_processor.open_s3_object")
     @patch("document_processor.document_processor.get_document_loader")
     @patch("document_processor.document_processor.chunk_documents")
-    @patch("document_processor.document_processor.embed_query")
-    @patch("document_processor.document_processor.get_postgres_credentials")
-    @patch("document_processor.document_processor.get_postgres_connection")
-    @patch("document_processor.document_processor.os.unlink")
+    @patch("document_processor.document_processor.embed_documents")
+    @patch("document_processor.document_processor.pooled_connection")
     @patch("document_processor.document_processor.uuid.uuid4")
     @patch("document_processor.document_processor.datetime")
     def test_process_document(
-        self, mock_datetime, mock_uuid, mock_unlink, mock_get_conn, mock_get_creds,
-        mock_embed, mock_chunk, mock_loader, mock_tempfile
+        self, mock_datetime, mock_uuid, mock_pooled_connection,
+        mock_embed, mock_chunk, mock_loader, mock_open_s3_object, mock_copy_chunks, mock_find_previous
     ):
         """Test processing a document."""
         # Mock datetime
         mock_now = MagicMock()
         mock_datetime.now.return_value = mock_now
         
-        # Mock the temporary file
-        mock_temp_file = MagicMock()
-        mock_temp_file.name = "/tmp/test_file"
-        mock_tempfile.NamedTemporaryFile.return_value.__enter__.return_value = mock_temp_file
+        # Mock the streamed object
+        mock_stream = MagicMock()
+        mock_open_s3_object.return_value = mock_stream
         
         # Mock UUID
         mock_uuid.side_effect = ["chunk-1", "chunk-2"]
@@ -293,17 +541,15 @@ class TestDocumentProcessor(unittest.TestCase):
             MockDocument("Content 1", {"page": 1}),
             MockDocument("Content 2", {"page": 2})
         ]
-        mock_doc_loader.load.return_value = mock_documents
+        mock_doc_loader.lazy_load.return_value = iter(mock_documents)
         
-        # Mock chunking
-        mock_chunks = [
-            MockDocument("Chunk 1", {"page": 1}),
-            MockDocument("Chunk 2", {"page": 2})
+        # Mock chunking, one chunk per streamed document
+        mock_chunk.side_effect = lambda docs: [
+            MockDocument(doc.page_content.replace("Content", "Chunk"), doc.metadata) for doc in docs
         ]
-        mock_chunk.return_value = mock_chunks
         
         # Mock embedding
-        mock_embed.side_effect = [
+        mock_embed.return_value = [
             [0.1, 0.2, 0.3],
             [0.4, 0.5, 0.6]
         ]
@@ -312,10 +558,9 @@ class TestDocumentProcessor(unittest.TestCase):
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_conn.cursor.return_value = mock_cursor
-        mock_get_conn.return_value = mock_conn
-        
-        # Mock credentials
-        mock_get_creds.return_value = {"host": "test-host"}
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+        # No logical key was recorded at upload, so the document starts its own
+        mock_cursor.fetchone.return_value = None
         
         # Test parameters
         container_name = "test-container"
@@ -331,24 +576,252 @@ class TestDocumentProcessor(unittest.TestCase):
         self.assertEqual(num_chunks, 2)
         self.assertEqual(chunk_ids, ["chunk-1", "chunk-2"])
         
-        # Verify blob download
-        self.mock_blob_client.download_blob_to_file.assert_called_once()
+        # Verify the object was streamed into the loader and closed
+        mock_loader.assert_called_once_with(mock_stream, mime_type, source=unittest.mock.ANY)
+        mock_stream.close.assert_called_once()
+        
+        # Verify document insertion (compared with whitespace normalized)
+        insert_sql, insert_params = mock_cursor.execute.call_args_list[1][0]
+        self.assertEqual(
+            " ".join(insert_sql.split()),
+            "INSERT INTO documents (document_id, user_id, file_name, mime_type, status, bucket, key, logical_key, created_at, updated_at) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id"
+        )
+        self.assertEqual(
+            insert_params,
+            ("doc-1", "user-1", "test.pdf", "application/pdf", "processing", "test-container", blob_path, "doc-1",
+             mock_now, mock_now)
+        )
+        
+        # Verify chunks were embedded in one batched call
+        mock_embed.assert_called_once_with(["Chunk 1", "Chunk 2"], conn=mock_conn)
+        
+        # Verify chunks are written in a single bulk COPY and the document marked processed
+        self.assertEqual(mock_cursor.execute.call_count, 3)  # Logical key lookup, document insert and status update
+        mock_cursor.execute.assert_called_with(
+            "UPDATE documents SET status = %s, updated_at = %s WHERE document_id = %s",
+            ("processed", mock_now, document_id)
+        )
+        mock_copy_chunks.assert_called_once()
+        rows = mock_copy_chunks.call_args[0][1]
+        self.assertEqual([row[0] for row in rows], ["chunk-1", "chunk-2"])
+        self.assertEqual([row[6] for row in rows], [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
+        self.assertEqual(rows[0][4], content_hash("Chunk 1"))
+
+    @patch("document_processor.document_processor.reassign_chunks")
+    @patch("document_processor.document_processor.load_chunk_hashes")
+    @patch("document_processor.document_processor.resolve_s3_object", side_effect=lambda b, k: (k, 1024))
+    @patch("document_processor.document_processor.copy_chunks")
+    @patch("document_processor.document_processor.open_s3_object")
+    @patch("document_processor.document_processor.get_document_loader")
+    @patch("document_processor.document_processor.embed_documents")
+    @patch("document_processor.document_processor.pooled_connection")
+    def test_process_document_reingest_embeds_only_changed_chunks(
+        self, mock_pooled_connection, mock_embed, mock_loader, mock_open_s3_object, mock_copy_chunks,
+        mock_resolve_key, mock_load_hashes, mock_reassign
+    ):
+        """Test that re-uploading a document only embeds and inserts changed chunks."""
+        from collections import deque
+        mock_loader.return_value.lazy_load.return_value = iter([
+            Document(page_content="Unchanged paragraph.\n\nNew paragraph.", metadata={"page": 0})
+        ])
+        mock_load_hashes.return_value = {
+            content_hash("Unchanged paragraph."): deque(["old-chunk-1"]),
+            content_hash("Removed paragraph."): deque(["old-chunk-2"])
+        }
+        mock_embed.return_value = [[0.1, 0.2]]
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+        # doc-2 was uploaded as a replacement of doc-1, which is its processed previous version
+        mock_cursor.fetchone.side_effect = [("doc-1",), ("doc-1",)]
+        
+        with patch("document_processor.document_processor.CHUNK_TOKENS", 6), \
+                patch("document_processor.document_processor.CHUNK_OVERLAP_TOKENS", 0):
+            num_chunks, chunk_ids = process_document("bucket", "uploads/user-1/doc-2/a.txt", "doc-2", "user-1", "text/plain")
+        
+        # The object is opened with the size found while resolving its key, without another HEAD
+        mock_open_s3_object.assert_called_once_with("bucket", "uploads/user-1/doc-2/a.txt", size=1024)
+        
+        # The previous version is matched on the logical key, not the differing object keys
+        find_sql, find_params = mock_cursor.execute.call_args_list[2][0]
+        self.assertIn("logical_key = %s", find_sql)
+        self.assertEqual(find_params, ("user-1", "doc-1", "doc-2"))
+        mock_load_hashes.assert_called_once_with(mock_cursor, "doc-1")
         
-        # Verify temporary file cleanup
-        mock_unlink.assert_called_once_with("/tmp/test_file")
+        # Only the new chunk is embedded and copied
+        mock_embed.assert_called_once_with(["New paragraph."], conn=mock_conn)
+        rows = mock_copy_chunks.call_args[0][1]
+        self.assertEqual([row[3] for row in rows], ["New paragraph."])
         
-        # Verify document insertion
+        # The unchanged chunk is kept, the removed one deleted, the old version retired
+        self.assertEqual(num_chunks, 2)
+        self.assertEqual(chunk_ids[0], "old-chunk-1")
+        mock_reassign.assert_called_once()
+        self.assertEqual(mock_reassign.call_args[0][1], "doc-2")
+        self.assertEqual([row[0] for row in mock_reassign.call_args[0][2]], ["old-chunk-1"])
+        mock_cursor.execute.assert_any_call("DELETE FROM chunks WHERE chunk_id = ANY(%s)", (["old-chunk-2"],))
         mock_cursor.execute.assert_any_call(
-            """
-        INSERT INTO documents (document_id, user_id, file_name, mime_type, status, bucket, key, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-        """,
-            unittest.mock.ANY  # We don't need to check the exact values here
+            "UPDATE documents SET status = %s, updated_at = %s WHERE document_id = %s",
+            ("superseded", unittest.mock.ANY, "doc-1")
         )
+
+    def test_pipeline_stage_streams_batches(self):
+        """Test that a pipeline stage yields batches from its input in order."""
+        stage = PipelineStage("batch", lambda items: iter_batches(items, 2), range(5), maxsize=1)
+        stage.start()
+        
+        self.assertEqual(list(stage), [[0, 1], [2, 3], [4]])
+
+    def test_pipeline_stage_propagates_errors(self):
+        """Test that errors raised inside a stage surface to its consumer."""
+        def failing(items):
+            yield next(items)
+            raise ValueError("embedding failed")
+        
+        stage = PipelineStage("fail", failing, [1, 2])
+        stage.start()
+        
+        results = []
+        with self.assertRaises(ValueError):
+            for item in stage:
+                results.append(item)
+        self.assertEqual(results, [1])
+
+    @patch("document_processor.document_processor.embed_documents")
+    @patch("document_processor.document_processor.get_connection_pool")
+    def test_cancelled_embed_stage_returns_its_connection(self, mock_get_pool, mock_embed):
+        """Test that cancelling the pipeline mid-stream gives the embed stage's connection back."""
+        pool = PostgresConnectionPool(MagicMock(), min_size=0, max_size=1, max_lifetime=60,
+                                      healthcheck_interval=60, timeout=0.1)
+        mock_get_pool.return_value = pool
+        mock_embed.side_effect = lambda texts, conn=None: [[0.1] for _ in texts]
+        batches = ([Document(page_content=f"chunk {i}", metadata={})] for i in range(10))
+        
+        stage = PipelineStage("embed", embed_chunk_batches, batches, maxsize=1)
+        stage.start()
+        next(iter(stage))
+        stage.cancel()
+        stage.join(timeout=5)
+        
+        self.assertFalse(stage.is_alive())
+        # The pool is back to full: its only slot can be checked out again
+        pool.putconn(pool.getconn())
+
+    @patch("document_processor.document_processor.dynamodb")
+    @patch("document_processor.document_processor.process_document")
+    def test_process_records_reports_each_record(self, mock_process, mock_dynamodb):
+        """Test that every record in an event is processed and reported."""
+        def process(bucket, key, document_id, user_id, mime_type):
+            if document_id == "doc-2":
+                raise ValueError("corrupt file")
+            return 3, ["c1", "c2", "c3"]
+        
+        mock_process.side_effect = process
+        # Create the table mock up front so concurrent workers share one put_item
+        mock_table = mock_dynamodb.Table.return_value
+        mock_table.put_item.return_value = {}
+        records = [
+            {"s3": {"bucket": {"name": "bucket"}, "object": {"key": f"uploads/user-1/doc-{n}/file{n}.pdf"}}}
+            for n in range(1, 4)
+        ]
+        
+        results = process_records(records)
+        
+        self.assertEqual(mock_process.call_count, 3)
+        self.assertEqual([result["status"] for result in results], ["processed", "failed", "processed"])
+        self.assertEqual(results[0]["document_id"], "doc-1")
+        self.assertEqual(results[1]["error"], "corrupt file")
+        self.assertEqual(mock_table.put_item.call_count, 2)
+
+    @patch("document_processor.document_processor.process_records")
+    def test_handler_partial_failure(self, mock_process_records):
+        """Test that a partially failed batch reports per-record results."""
+        mock_process_records.return_value = [
+            {"document_id": "doc-1", "key": "k1", "status": "processed", "num_chunks": 2},
+            {"key": "k2", "status": "failed", "error": "boom"}
+        ]
+        event = {"Records": [{}, {}]}
+        
+        response = handler(event, None)
+        
+        mock_process_records.assert_called_once_with(event["Records"])
+        self.assertEqual(response["statusCode"], 207)
+        body = json.loads(response["body"])
+        self.assertEqual(body["message"], "Processed 1 of 2 document(s)")
+        self.assertEqual(len(body["results"]), 2)
+
+    @patch("document_processor.document_processor.s3_client")
+    def test_key_resolution_is_cached(self, mock_s3):
+        """Test that a resolved key and its size are served from cache on the next lookup."""
+        _resolved_keys.clear()
+        key = "uploads/user-1/doc-1/report.pdf"
+        mock_s3.head_object.return_value = {"ContentLength": 2048}
+        
+        self.assertEqual(get_s3_object_with_various_encoding("bucket", key), key)
+        self.assertEqual(resolve_s3_object("bucket", key), (key, 2048))
+        
+        mock_s3.head_object.assert_called_once_with(Bucket="bucket", Key=key)
+        mock_s3.list_objects_v2.assert_not_called()
+
+    @patch("document_processor.document_processor._key_variant_order", list(KEY_VARIANTS))
+    @patch("document_processor.document_processor.s3_client")
+    def test_key_resolution_prefers_last_working_variant(self, mock_s3):
+        """Test that the encoding variant that worked last is tried right after the exact key."""
+        _resolved_keys.clear()
+        def head_object(Bucket, Key):
+            if "+" not in Key:
+                raise Exception("Not Found")
+            return {}
+        
+        mock_s3.head_object.side_effect = head_object
+        
+        self.assertEqual(get_s3_object_with_various_encoding("bucket", "uploads/u/d/my file.pdf"), "uploads/u/d/my+file.pdf")
+        mock_s3.head_object.reset_mock()
+        
+        self.assertEqual(get_s3_object_with_various_encoding("bucket", "uploads/u/d/other file.pdf"), "uploads/u/d/other+file.pdf")
+        self.assertEqual([c.kwargs["Key"] for c in mock_s3.head_object.call_args_list],
+                         ["uploads/u/d/other file.pdf", "uploads/u/d/other+file.pdf"])
+
+    @patch("document_processor.document_processor.s3_client")
+    def test_key_resolution_lists_bounded_page(self, mock_s3):
+        """Test that listing is bounded and narrowed to the file name."""
+        _resolved_keys.clear()
+        mock_s3.head_object.side_effect = Exception("Not Found")
+        mock_s3.list_objects_v2.return_value = {
+            "Contents": [{"Key": "uploads/u/d/my%20file.pdf"}],
+            "IsTruncated": False
+        }
         
-        # Verify chunk insertions
-        self.assertEqual(mock_cursor.execute.call_count, 3)  # 1 for document + 2 for chunks
+        self.assertEqual(get_s3_object_with_various_encoding("bucket", "uploads/u/d/my file.pdf"), "uploads/u/d/my%20file.pdf")
+        mock_s3.list_objects_v2.assert_called_once_with(Bucket="bucket", Prefix="uploads/u/d/my", MaxKeys=100)
+
+    def test_to_pgvector_literal(self):
+        """Test encoding embeddings in pgvector text format."""
+        self.assertEqual(to_pgvector_literal([0.1, -2.5, 3.0]), "[0.1,-2.5,3]")
+
+    def test_copy_chunks(self):
+        """Test bulk writing chunk rows with COPY."""
+        from datetime import datetime
+        mock_cursor = MagicMock()
+        copied = {}
+        mock_cursor.copy_expert.side_effect = lambda sql, buffer: copied.update(sql=sql, data=buffer.read())
+
+        now = datetime(2024, 1, 1, 12, 0, 0)
+        rows = [
+            ("chunk-1", "doc-1", "user-1", "Line 1\nTab\there \\ slash", "abc123", '{"page": 1}', [0.5, 0.25], now, now)
+        ]
+
+        self.assertEqual(copy_chunks(mock_cursor, rows), 1)
+        self.assertTrue(copied["sql"].startswith("COPY chunks (chunk_id, document_id, user_id, content"))
+        self.assertEqual(
+            copied["data"],
+            "chunk-1\tdoc-1\tuser-1\tLine 1\\nTab\\there \\\\ slash\tabc123\t{\"page\": 1}\t[0.5,0.25]\t"
+            "2024-01-01T12:00:00\t2024-01-01T12:00:00\n"
+        )
+        self.assertEqual(copy_chunks(mock_cursor, []), 0)
+        mock_cursor.copy_expert.assert_called_once()
 
     @patch("document_processor.document_processor.func")
     def test_main_healthcheck(self, mock_func):
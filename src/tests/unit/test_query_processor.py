@@ -1,8 +1,11 @@
 """Test cases for the query_processor Azure Function."""
+import asyncio
 import json
 import os
+import threading
 import unittest
-from unittest.mock import MagicMock, patch
+import numpy as np
+from unittest.mock import AsyncMock, MagicMock, patch
 from decimal import Decimal
 
 """Set up test environment."""
@@ -25,7 +28,12 @@ os.environ["TOP_P"] = "0.8"
 # Now import the module under test - mocks are already in place globally from conftest
 from query_processor.query_processor import (
     main, get_gemini_api_key, get_postgres_credentials, get_postgres_connection,
-    embed_query, embed_documents, similarity_search, generate_response, DecimalEncoder
+    embed_query, embed_documents, similarity_search, generate_response, DecimalEncoder,
+    embedding_cache, embedding_cache_key, PostgresConnectionPool, SecretCache,
+    secret_cache, connect_postgres, SemanticResponseCache, response_cache,
+    assemble_context, mmr_rerank, search_result, retrieve,
+    embed_queries, batch_retrieve, retrieve_async, EmbeddingLRUCache,
+    encode_json, shape_results, get_gemini_client, call_gemini
 )
 
 class TestQueryProcessor(unittest.TestCase):
@@ -42,6 +50,10 @@ class TestQueryProcessor(unittest.TestCase):
         self.mock_cosmos = self.cosmos_patcher.start()
         self.mock_secret = self.secret_patcher.start()
         self.mock_credential = self.credential_patcher.start()
+        
+        embedding_cache.clear()
+        secret_cache.clear()
+        response_cache.clear()
 
     def tearDown(self):
         """Clean up test environment."""
@@ -78,6 +90,34 @@ class TestQueryProcessor(unittest.TestCase):
         self.assertEqual(api_key, "mock-api-key")
         mock_client_instance.get_secret.assert_called_once_with("gemini-api-key")
         
+    @patch("query_processor.query_processor.client_api_key", None)
+    @patch("query_processor.query_processor.client", None)
+    @patch("query_processor.query_processor.genai")
+    @patch("query_processor.query_processor.get_gemini_api_key")
+    def test_call_gemini_picks_up_rotated_key(self, mock_get_key, mock_genai):
+        """Test that a rotated key rebuilds the client and a rejected key is refreshed once."""
+        keys = {False: "old-key", True: "new-key"}
+        mock_get_key.side_effect = lambda force_refresh=False: keys[force_refresh]
+        mock_genai.Client.side_effect = lambda api_key: MagicMock(api_key=api_key)
+
+        old_client = get_gemini_client()
+        self.assertIs(get_gemini_client(), old_client)
+
+        rejected = Exception("API key not valid")
+        rejected.code = 401
+        def request(gemini):
+            if gemini.api_key == "old-key":
+                raise rejected
+            return "ok"
+
+        self.assertEqual(call_gemini(request), "ok")
+        mock_get_key.assert_called_with(True)
+        self.assertEqual(mock_genai.Client.call_count, 2)
+
+        # Errors other than a rejected key are not retried
+        with self.assertRaises(ValueError):
+            call_gemini(MagicMock(side_effect=ValueError("bad request")))
+
     @patch("query_processor.query_processor.SecretClient")
     def test_get_postgres_credentials(self, mock_secret_client):
         """Test getting PostgreSQL credentials from Azure Key Vault."""
@@ -102,6 +142,46 @@ class TestQueryProcessor(unittest.TestCase):
         self.assertEqual(credentials, mock_credentials)
         mock_client_instance.get_secret.assert_called_once_with("db-credentials")
 
+    @patch("query_processor.query_processor.SecretClient")
+    def test_get_postgres_credentials_cached(self, mock_secret_client):
+        """Test that PostgreSQL credentials are fetched from Key Vault once and then cached."""
+        mock_secret = MagicMock()
+        mock_secret.value = json.dumps({"host": "test-host"})
+        mock_client_instance = MagicMock()
+        mock_client_instance.get_secret.return_value = mock_secret
+        mock_secret_client.return_value = mock_client_instance
+
+        get_postgres_credentials()
+        get_postgres_credentials()
+        self.assertEqual(mock_client_instance.get_secret.call_count, 1)
+
+        # A forced refresh goes back to Key Vault
+        get_postgres_credentials(force_refresh=True)
+        self.assertEqual(mock_client_instance.get_secret.call_count, 2)
+
+    def test_secret_cache_expiry(self):
+        """Test that expired secrets are fetched again."""
+        cache = SecretCache(ttl=0, refresh_ahead=0)
+        fetch = MagicMock(side_effect=["first", "second"])
+
+        self.assertEqual(cache.get("secret", fetch), "first")
+        self.assertEqual(cache.get("secret", fetch), "second")
+        self.assertEqual(fetch.call_count, 2)
+
+    @patch("query_processor.query_processor.get_postgres_credentials")
+    @patch("query_processor.query_processor.get_postgres_connection")
+    def test_connect_postgres_refreshes_rejected_credentials(self, mock_get_conn, mock_get_creds):
+        """Test that rejected credentials are refreshed once before reconnecting."""
+        mock_conn = MagicMock()
+        mock_get_conn.side_effect = [Exception('password authentication failed for user "test-user"'), mock_conn]
+        mock_get_creds.side_effect = [{"password": "old"}, {"password": "new"}]
+
+        conn = connect_postgres()
+
+        self.assertEqual(conn, mock_conn)
+        mock_get_creds.assert_called_with(force_refresh=True)
+        mock_get_conn.assert_called_with({"password": "new"})
+
     @patch("query_processor.query_processor.psycopg2")
     def test_get_postgres_connection(self, mock_psycopg2):
         """Test getting a PostgreSQL connection."""
@@ -147,6 +227,79 @@ class TestQueryProcessor(unittest.TestCase):
         self.assertEqual(result, [0.1, 0.2, 0.3])
         mock_client.models.embed_content.assert_called_once()
 
+    @patch("query_processor.query_processor.client")
+    def test_embed_query_cache(self, mock_client):
+        """Test that repeated queries are served from the embedding cache."""
+        mock_embeddings = MagicMock()
+        mock_embeddings.embeddings = [MagicMock()]
+        mock_embeddings.embeddings[0].values = [0.1, 0.2, 0.3]
+        mock_client.models.embed_content.return_value = mock_embeddings
+
+        # Persistent tier misses on the first call
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+        mock_cursor.fetchone.return_value = None
+
+        first = embed_query("Repeated query", conn=mock_conn)
+        second = embed_query("Repeated query", conn=mock_conn)
+
+        self.assertEqual(first, [0.1, 0.2, 0.3])
+        self.assertEqual(second, [0.1, 0.2, 0.3])
+        mock_client.models.embed_content.assert_called_once()
+        # The computed embedding is written through to the persistent tier
+        insert_args = mock_cursor.execute.call_args_list[-1][0][1]
+        self.assertEqual(insert_args[0], embedding_cache_key("Repeated query"))
+
+    @patch("query_processor.query_processor.client")
+    def test_embed_query_cache_normalizes_text(self, mock_client):
+        """Test that repeats differing only in whitespace share a cache entry."""
+        mock_client.models.embed_content.return_value = MagicMock(embeddings=[MagicMock(values=[0.1, 0.2])])
+
+        with patch("query_processor.query_processor.EMBEDDING_CACHE_PERSISTENT", False):
+            first = embed_query("What is  RAG?")
+            second = embed_query(" What is RAG?\n")
+
+        self.assertEqual(first, second)
+        mock_client.models.embed_content.assert_called_once()
+        self.assertEqual(mock_client.models.embed_content.call_args[1]["contents"], "What is RAG?")
+        self.assertEqual(embedding_cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    @patch("query_processor.query_processor.time")
+    def test_embedding_cache_expires_and_logs_stats(self, mock_time):
+        """Test TTL expiry and periodic hit/miss logging of the embedding cache."""
+        mock_time.monotonic.return_value = 100.0
+        cache = EmbeddingLRUCache(max_size=10, ttl=60, stats_interval=2)
+        cache.put("key", [0.1])
+
+        with self.assertLogs(level="INFO") as logs:
+            self.assertEqual(cache.get("key"), [0.1])
+            mock_time.monotonic.return_value = 161.0
+            self.assertIsNone(cache.get("key"))
+
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 0})
+        self.assertIn("1 hits, 1 misses (50.0% hit rate)", logs.output[-1])
+
+    @patch("query_processor.query_processor.pooled_connection")
+    @patch("query_processor.query_processor.client")
+    def test_embed_query_without_persistent_tier(self, mock_client, mock_pooled_connection):
+        """Test that persistent=False never checks out a connection for the cache tier."""
+        mock_client.models.embed_content.return_value = MagicMock(embeddings=[MagicMock(values=[0.1, 0.2])])
+
+        self.assertEqual(embed_query("Uncached query", persistent=False), [0.1, 0.2])
+        mock_pooled_connection.assert_not_called()
+
+    @patch("query_processor.query_processor.client")
+    def test_embed_query_persistent_cache_hit(self, mock_client):
+        """Test that the persistent cache tier short-circuits the embedding call."""
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+        mock_cursor.fetchone.return_value = ([0.4, 0.5, 0.6],)
+
+        result = embed_query("Stored query", conn=mock_conn)
+
+        self.assertEqual(result, [0.4, 0.5, 0.6])
+        mock_client.models.embed_content.assert_not_called()
+
     @patch("query_processor.query_processor.embed_query")
     def test_embed_documents(self, mock_embed_query):
         """Test embedding multiple documents."""
@@ -168,18 +321,14 @@ class TestQueryProcessor(unittest.TestCase):
         mock_embed_query.assert_any_call("Document 1")
         mock_embed_query.assert_any_call("Document 2")
 
-    @patch("query_processor.query_processor.get_postgres_credentials")
-    @patch("query_processor.query_processor.get_postgres_connection")
-    def test_similarity_search(self, mock_get_conn, mock_get_creds):
+    @patch("query_processor.query_processor.pooled_connection")
+    def test_similarity_search(self, mock_pooled_connection):
         """Test similarity search using pgvector."""
-        # Mock the PostgreSQL connection
+        # Mock the pooled PostgreSQL connection
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_conn.cursor.return_value = mock_cursor
-        mock_get_conn.return_value = mock_conn
-        
-        # Mock credentials
-        mock_get_creds.return_value = {"host": "test-host"}
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
         
         # Mock the query results
         mock_cursor.fetchall.return_value = [
@@ -202,10 +351,402 @@ class TestQueryProcessor(unittest.TestCase):
         self.assertEqual(results[0]["file_name"], "file1.pdf")
         self.assertEqual(results[0]["similarity_score"], 0.95)
         
-        # Verify SQL query execution
-        mock_cursor.execute.assert_called_once()
-        # Verify query contains the user_id parameter
-        mock_cursor.execute.assert_called_with(unittest.mock.ANY, ("user-1", 2))
+        # Verify SQL query execution (search settings, prepare, then the search itself)
+        self.assertEqual(mock_cursor.execute.call_count, 3)
+        settings_call = mock_cursor.execute.call_args_list[0]
+        self.assertIn("set_config", settings_call[0][0])
+        self.assertEqual(settings_call[0][1], ["hnsw.ef_search", "64", "ivfflat.probes", "10"])
+        self.assertIn("PREPARE rag_similarity_search", mock_cursor.execute.call_args_list[1][0][0])
+        # Verify the query vector is bound once as a parameter
+        mock_cursor.execute.assert_called_with(
+            "EXECUTE rag_similarity_search (%s, %s, %s)", ("[0.1,0.2,0.3]", "user-1", 2)
+        )
+
+        # The statement is prepared only once per connection
+        similarity_search(query_embedding, user_id, limit=2)
+        prepares = [c for c in mock_cursor.execute.call_args_list if "PREPARE" in c[0][0]]
+        self.assertEqual(len(prepares), 1)
+
+    @patch("query_processor.query_processor.pooled_connection")
+    def test_similarity_search_exact(self, mock_pooled_connection):
+        """Test that exact search disables the approximate vector index."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_cursor.fetchall.return_value = []
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+
+        similarity_search([0.1, 0.2, 0.3], "user-1", search_quality="exact")
+
+        settings_call = mock_cursor.execute.call_args_list[0]
+        self.assertEqual(settings_call[0][1], ["enable_indexscan", "off"])
+
+    @patch("query_processor.query_processor.pooled_connection")
+    def test_similarity_search_hybrid(self, mock_pooled_connection):
+        """Test hybrid retrieval fuses vector and full-text candidates in one statement."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_cursor.fetchall.return_value = [
+            ("chunk-1", "doc-1", "user-1", "SKU-1234 specs", {"page": 1}, "file1.pdf", 0.41, 0.0164)
+        ]
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+
+        results = similarity_search([0.1, 0.2, 0.3], "user-1", limit=5,
+                                    query_text="SKU-1234", retrieval_mode="hybrid")
+
+        self.assertEqual(results[0]["chunk_id"], "chunk-1")
+        self.assertEqual(results[0]["similarity_score"], 0.41)
+        self.assertEqual(results[0]["fused_score"], 0.0164)
+        prepare_sql = mock_cursor.execute.call_args_list[1][0][0]
+        self.assertIn("PREPARE rag_hybrid_search", prepare_sql)
+        self.assertIn("websearch_to_tsquery", prepare_sql)
+        self.assertIn("1.0 / ($6 + rank)", prepare_sql)
+        mock_cursor.execute.assert_called_with(
+            "EXECUTE rag_hybrid_search (%s, %s, %s, %s, %s, %s)",
+            ("[0.1,0.2,0.3]", "user-1", "SKU-1234", 40, 5, 60)
+        )
+
+    @patch("query_processor.query_processor.pooled_connection")
+    def test_similarity_search_hybrid_falls_back_without_tsvector(self, mock_pooled_connection):
+        """Test that hybrid retrieval falls back to vector search before db_init adds content_tsv."""
+        missing_column = Exception('column c.content_tsv does not exist')
+        missing_column.pgcode = '42703'
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        def execute(sql, *args):
+            if "rag_hybrid_search" in sql:
+                raise missing_column
+
+        mock_cursor.execute.side_effect = execute
+        mock_cursor.fetchall.return_value = []
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+
+        similarity_search([0.1, 0.2, 0.3], "user-1", query_text="SKU-1234", retrieval_mode="hybrid")
+
+        mock_conn.rollback.assert_called_once()
+        mock_cursor.execute.assert_called_with(
+            "EXECUTE rag_similarity_search (%s, %s, %s)", ("[0.1,0.2,0.3]", "user-1", 5)
+        )
+
+    def test_search_result_parses_embedding(self):
+        """Test that rows from the *_embeddings statements carry a parsed embedding."""
+        result = search_result(("chunk-1", "doc-1", "user-1", "Content", {}, "a.pdf", 0.9, "[0.5,-0.25,1]"))
+
+        self.assertEqual(result["similarity_score"], 0.9)
+        self.assertEqual(result["embedding"].tolist(), [0.5, -0.25, 1.0])
+        self.assertNotIn("embedding", search_result(("chunk-1", "doc-1", "user-1", "Content", {}, "a.pdf", 0.9)))
+
+    def test_mmr_rerank_prefers_diverse_chunks(self):
+        """Test that MMR picks a less similar but new chunk over a near-duplicate."""
+        candidates = [
+            {"chunk_id": "best", "embedding": np.array([1.0, 0.0, 0.0])},
+            {"chunk_id": "duplicate", "embedding": np.array([0.99, 0.01, 0.0])},
+            {"chunk_id": "different", "embedding": np.array([0.7, 0.7, 0.0])},
+        ]
+
+        results = mmr_rerank([1.0, 0.0, 0.0], candidates, k=2, mmr_lambda=0.3)
+        self.assertEqual([r["chunk_id"] for r in results], ["best", "different"])
+        self.assertNotIn("embedding", results[0])
+
+        # With lambda 1 the ranking is by relevance only
+        results = mmr_rerank([1.0, 0.0, 0.0], candidates, k=2, mmr_lambda=1.0)
+        self.assertEqual([r["chunk_id"] for r in results], ["best", "duplicate"])
+
+    @patch("query_processor.query_processor.pooled_connection")
+    def test_retrieve_overfetches_candidates_for_mmr(self, mock_pooled_connection):
+        """Test that retrieve fetches extra candidates with embeddings and re-ranks them."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_cursor.fetchall.return_value = [
+            ("chunk-1", "doc-1", "user-1", "Content 1", {}, "a.pdf", 0.9, "[1,0]"),
+            ("chunk-2", "doc-1", "user-1", "Content 2", {}, "a.pdf", 0.8, "[0,1]")
+        ]
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+
+        results = retrieve([1.0, 0.0], "user-1", "What is RAG?", limit=2, retrieval_mode="vector", mmr_lambda=0.7)
+
+        self.assertEqual([r["chunk_id"] for r in results], ["chunk-1", "chunk-2"])
+        self.assertIn("PREPARE rag_similarity_search_embeddings", mock_cursor.execute.call_args_list[1][0][0])
+        mock_cursor.execute.assert_called_with(
+            "EXECUTE rag_similarity_search_embeddings (%s, %s, %s)", ("[1,0]", "user-1", 8)
+        )
+
+    @patch("query_processor.query_processor.pooled_connection")
+    def test_retrieve_hybrid_keeps_lexical_only_candidates(self, mock_pooled_connection):
+        """Test that hybrid re-ranking uses the fused score, so a full-text-only match survives."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        # The exact-term match is far from the query vector but first in the full-text list
+        mock_cursor.fetchall.return_value = [
+            ("vector-1", "doc-1", "user-1", "Content 1", {}, "a.pdf", 1.0, 1 / 61, "[1,0,0]"),
+            ("lexical", "doc-2", "user-1", "SKU-1234", {}, "b.pdf", 0.0, 1 / 61, "[0,0,1]"),
+            ("vector-2", "doc-1", "user-1", "Content 2", {}, "a.pdf", 0.99, 1 / 62, "[0.99,0.01,0]"),
+            ("vector-3", "doc-1", "user-1", "Content 3", {}, "a.pdf", 0.98, 1 / 63, "[0.98,0.02,0]")
+        ]
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+
+        results = retrieve([1.0, 0.0, 0.0], "user-1", "SKU-1234", limit=2, retrieval_mode="hybrid", mmr_lambda=0.9)
+
+        self.assertEqual([r["chunk_id"] for r in results], ["vector-1", "lexical"])
+        self.assertIn("PREPARE rag_hybrid_search_embeddings", mock_cursor.execute.call_args_list[1][0][0])
+
+    @patch("query_processor.query_processor.func")
+    def test_main_invalid_mmr_lambda(self, mock_func):
+        """Test that an out-of-range mmr_lambda is rejected."""
+        mock_req = MagicMock()
+        mock_req.get_json.return_value = {"query": "What is RAG?", "mmr_lambda": 1.5}
+
+        asyncio.run(main(mock_req))
+
+        self.assertEqual(mock_func.HttpResponse.call_args[1]["status_code"], 400)
+
+    @patch("query_processor.query_processor.client")
+    def test_embed_queries_batches_uncached_texts(self, mock_client):
+        """Test that distinct uncached queries are embedded in one batched call."""
+        embedding_cache.put(embedding_cache_key("cached"), [0.5, 0.5])
+        mock_client.models.embed_content.return_value = MagicMock(
+            embeddings=[MagicMock(values=[0.1, 0.2]), MagicMock(values=[0.3, 0.4])]
+        )
+
+        with patch("query_processor.query_processor.EMBEDDING_CACHE_PERSISTENT", False):
+            embeddings = embed_queries(["first", "cached", "second", "first"])
+
+        self.assertEqual(embeddings, [[0.1, 0.2], [0.5, 0.5], [0.3, 0.4], [0.1, 0.2]])
+        mock_client.models.embed_content.assert_called_once()
+        self.assertEqual(mock_client.models.embed_content.call_args[1]["contents"], ["first", "second"])
+
+    @patch("query_processor.query_processor.pooled_connection")
+    def test_batch_retrieve_uses_one_lateral_statement(self, mock_pooled_connection):
+        """Test that batch vector retrieval runs one LATERAL search and groups rows per query."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_cursor.fetchall.return_value = [
+            (1, "chunk-1", "doc-1", "user-1", "Content 1", {}, "a.pdf", 0.9),
+            (2, "chunk-2", "doc-2", "user-1", "Content 2", {}, "b.pdf", 0.8),
+            (2, "chunk-3", "doc-2", "user-1", "Content 3", {}, "b.pdf", 0.7)
+        ]
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+
+        results = batch_retrieve([[0.1, 0.2], [0.3, 0.4], [0.5, 0.6]], "user-1", ["q1", "q2", "q3"],
+                                 limit=2, retrieval_mode="vector", mmr_lambda=1.0)
+
+        self.assertEqual([[r["chunk_id"] for r in chunks] for chunks in results],
+                         [["chunk-1"], ["chunk-2", "chunk-3"], []])
+        prepare_sql = mock_cursor.execute.call_args_list[1][0][0]
+        self.assertIn("PREPARE rag_batch_similarity_search (text[], text, int)", prepare_sql)
+        self.assertIn("CROSS JOIN LATERAL", prepare_sql)
+        mock_cursor.execute.assert_called_with(
+            "EXECUTE rag_batch_similarity_search (%s, %s, %s)",
+            (["[0.1,0.2]", "[0.3,0.4]", "[0.5,0.6]"], "user-1", 2)
+        )
+        mock_pooled_connection.assert_called_once()
+
+    @patch("query_processor.query_processor.func")
+    @patch("query_processor.query_processor.generate_response")
+    @patch("query_processor.query_processor.batch_retrieve")
+    @patch("query_processor.query_processor.embed_queries")
+    def test_main_batch_queries(self, mock_embed, mock_retrieve, mock_generate, mock_func):
+        """Test that a batch request answers every query in order."""
+        mock_embed.return_value = [[0.1, 0.2], [0.3, 0.4]]
+        mock_retrieve.return_value = [[{"chunk_id": "chunk-1", "content": "A", "file_name": "a.pdf"}], []]
+        mock_generate.side_effect = lambda query, chunks: f"Answer to {query}"
+        mock_req = MagicMock()
+        mock_req.get_json.return_value = {"queries": ["What is RAG?", "What is MMR?"], "user_id": "user-1"}
+
+        asyncio.run(main(mock_req))
+
+        mock_embed.assert_called_once_with(["What is RAG?", "What is MMR?"])
+        call_args = mock_func.HttpResponse.call_args
+        self.assertEqual(call_args[1]["status_code"], 200)
+        body = json.loads(call_args[0][0])
+        self.assertEqual(body["count"], 2)
+        self.assertEqual([r["response"] for r in body["results"]], ["Answer to What is RAG?", "Answer to What is MMR?"])
+        self.assertEqual([r["count"] for r in body["results"]], [1, 0])
+
+        # Invalid batches are rejected
+        mock_req.get_json.return_value = {"queries": ["What is RAG?", ""]}
+        asyncio.run(main(mock_req))
+        self.assertEqual(mock_func.HttpResponse.call_args[1]["status_code"], 400)
+
+    @patch("query_processor.query_processor.EMBEDDING_CACHE_PERSISTENT", False)
+    @patch("query_processor.query_processor.retrieve")
+    @patch("query_processor.query_processor.release_connection")
+    @patch("query_processor.query_processor.checkout_connection")
+    @patch("query_processor.query_processor.embed_query")
+    def test_retrieve_async_overlaps_connection_and_embedding(self, mock_embed, mock_checkout, mock_release, mock_retrieve):
+        """Test that without the PostgreSQL tier the connection is checked out while embedding."""
+        embedding_started = threading.Event()
+        mock_conn = MagicMock()
+
+        def checkout():
+            # Only returns if embedding runs concurrently
+            if not embedding_started.wait(5):
+                raise TimeoutError("embedding did not start")
+            return mock_conn
+
+        def embed(text, persistent=None):
+            # The overlapped path must not check out a second connection for the cache tier
+            self.assertFalse(persistent)
+            embedding_started.set()
+            return [0.1, 0.2]
+
+        mock_checkout.side_effect = checkout
+        mock_embed.side_effect = embed
+        mock_retrieve.return_value = [{"chunk_id": "chunk-1"}]
+
+        query_embedding, chunks = asyncio.run(retrieve_async("What is RAG?", "user-1"))
+
+        self.assertEqual(query_embedding, [0.1, 0.2])
+        self.assertEqual(chunks, [{"chunk_id": "chunk-1"}])
+        self.assertEqual(mock_retrieve.call_args[1]["conn"], mock_conn)
+        mock_release.assert_called_once_with(mock_conn, discard=False)
+
+    @patch("query_processor.query_processor.EMBEDDING_CACHE_PERSISTENT", True)
+    @patch("query_processor.query_processor.pooled_connection")
+    @patch("query_processor.query_processor.call_gemini")
+    @patch("query_processor.query_processor.retrieve")
+    @patch("query_processor.query_processor.release_connection")
+    @patch("query_processor.query_processor.checkout_connection")
+    def test_retrieve_async_reads_persistent_cache_on_held_connection(
+        self, mock_checkout, mock_release, mock_retrieve, mock_call_gemini, mock_pooled_connection
+    ):
+        """Test that an in-process cache miss is served from PostgreSQL on the retrieval connection."""
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+        mock_cursor.fetchone.return_value = ([0.5, 0.25],)
+        mock_checkout.return_value = mock_conn
+        mock_retrieve.return_value = [{"chunk_id": "chunk-1"}]
+
+        query_embedding, chunks = asyncio.run(retrieve_async("What is RAG?", "user-1"))
+
+        self.assertEqual(query_embedding, [0.5, 0.25])
+        self.assertIn("FROM embedding_cache", mock_cursor.execute.call_args[0][0])
+        mock_call_gemini.assert_not_called()
+        mock_pooled_connection.assert_not_called()
+        self.assertEqual(mock_retrieve.call_args[1]["conn"], mock_conn)
+        mock_release.assert_called_once_with(mock_conn, discard=False)
+        # The embedding is now in the in-process cache
+        self.assertEqual(embedding_cache.get(embedding_cache_key("What is RAG?")), [0.5, 0.25])
+
+    def test_response_cache_matches_similar_queries(self):
+        """Test that a near-identical query over the same chunks hits the response cache."""
+        cache = SemanticResponseCache(max_size=10, ttl=60, similarity_threshold=0.95)
+        chunks = [{"chunk_id": "chunk-1"}, {"chunk_id": "chunk-2"}]
+        cache.put("user-1", [1.0, 0.0, 0.0], chunks, "cached answer")
+
+        # Similar embedding, same chunks in any order
+        self.assertEqual(cache.get("user-1", [0.99, 0.05, 0.0], list(reversed(chunks))), "cached answer")
+        # Dissimilar query, different chunk set, or other user
+        self.assertIsNone(cache.get("user-1", [0.0, 1.0, 0.0], chunks))
+        self.assertIsNone(cache.get("user-1", [1.0, 0.0, 0.0], [{"chunk_id": "chunk-3"}]))
+        self.assertIsNone(cache.get("user-2", [1.0, 0.0, 0.0], chunks))
+
+    @patch("query_processor.query_processor.time")
+    def test_response_cache_expires_and_evicts(self, mock_time):
+        """Test TTL expiry and size-bounded eviction of cached responses."""
+        mock_time.monotonic.return_value = 100.0
+        cache = SemanticResponseCache(max_size=2, ttl=60, similarity_threshold=0.95)
+        chunks = [{"chunk_id": "chunk-1"}]
+        cache.put("user-1", [1.0, 0.0], chunks, "first")
+        cache.put("user-2", [1.0, 0.0], chunks, "second")
+        cache.put("user-3", [1.0, 0.0], chunks, "third")
+
+        # The least recently used entry was evicted
+        self.assertIsNone(cache.get("user-1", [1.0, 0.0], chunks))
+        self.assertEqual(cache.get("user-2", [1.0, 0.0], chunks), "second")
+
+        mock_time.monotonic.return_value = 161.0
+        self.assertIsNone(cache.get("user-3", [1.0, 0.0], chunks))
+
+    @patch("query_processor.query_processor.func")
+    @patch("query_processor.query_processor.generate_response_async", new_callable=AsyncMock)
+    @patch("query_processor.query_processor.retrieve")
+    @patch("query_processor.query_processor.embed_query")
+    @patch("query_processor.query_processor.release_connection")
+    @patch("query_processor.query_processor.checkout_connection")
+    def test_main_serves_repeat_query_from_cache(self, mock_checkout, mock_release, mock_embed, mock_search, mock_generate, mock_func):
+        """Test that a repeated question skips generation."""
+        mock_embed.return_value = [0.1, 0.2, 0.3]
+        mock_search.return_value = [{"chunk_id": "chunk-1", "content": "Content", "file_name": "a.pdf"}]
+        mock_generate.return_value = "Answer"
+        mock_req = MagicMock()
+        mock_req.get_json.return_value = {"query": "What is RAG?", "user_id": "user-1"}
+
+        asyncio.run(main(mock_req))
+        asyncio.run(main(mock_req))
+
+        mock_generate.assert_called_once()
+        body = json.loads(mock_func.HttpResponse.call_args[0][0])
+        self.assertEqual(body["response"], "Answer")
+        self.assertTrue(body["cached"])
+
+    @patch("query_processor.query_processor.func")
+    def test_main_invalid_search_quality(self, mock_func):
+        """Test that an unknown search_quality is rejected."""
+        mock_req = MagicMock()
+        mock_req.get_json.return_value = {"query": "What is RAG?", "search_quality": "perfect"}
+
+        asyncio.run(main(mock_req))
+
+        call_args = mock_func.HttpResponse.call_args
+        self.assertEqual(call_args[1]["status_code"], 400)
+        self.assertIn("search_quality", json.loads(call_args[0][0])["message"])
+
+    def test_connection_pool_reuses_connections(self):
+        """Test that returned connections are reused by the pool."""
+        mock_conn = MagicMock()
+        mock_conn.closed = 0
+        mock_connect = MagicMock(return_value=mock_conn)
+        pool = PostgresConnectionPool(mock_connect, min_size=0, max_size=2, max_lifetime=60,
+                                      healthcheck_interval=60, timeout=1)
+
+        first = pool.getconn()
+        pool.putconn(first)
+        second = pool.getconn()
+
+        self.assertIs(first, second)
+        mock_connect.assert_called_once()
+        # Uncommitted work is rolled back when a connection is returned
+        mock_conn.rollback.assert_called_once()
+
+    def test_connection_pool_replaces_broken_connections(self):
+        """Test that closed or unhealthy connections are replaced on checkout."""
+        closed_conn = MagicMock()
+        closed_conn.closed = 0
+        unhealthy_conn = MagicMock()
+        unhealthy_conn.closed = 0
+        unhealthy_conn.cursor.return_value.__enter__.return_value.execute.side_effect = Exception("server closed")
+        fresh_conn = MagicMock()
+        fresh_conn.closed = 0
+        mock_connect = MagicMock(side_effect=[closed_conn, unhealthy_conn, fresh_conn])
+        pool = PostgresConnectionPool(mock_connect, min_size=2, max_size=2, max_lifetime=60,
+                                      healthcheck_interval=0, timeout=1)
+
+        # One connection dies while idle, the other fails its health check
+        closed_conn.closed = 1
+
+        conn = pool.getconn()
+
+        self.assertIs(conn, fresh_conn)
+        closed_conn.close.assert_called_once()
+        unhealthy_conn.close.assert_called_once()
+
+    def test_connection_pool_times_out_when_exhausted(self):
+        """Test that checkout fails once the pool is at its maximum size."""
+        mock_conn = MagicMock()
+        mock_conn.closed = 0
+        pool = PostgresConnectionPool(MagicMock(return_value=mock_conn), min_size=0, max_size=1,
+                                      max_lifetime=60, healthcheck_interval=60, timeout=0.01)
+
+        pool.getconn()
+
+        with self.assertRaises(TimeoutError):
+            pool.getconn()
 
     @patch("query_processor.query_processor.client")
     def test_generate_response(self, mock_client):
@@ -236,6 +777,54 @@ class TestQueryProcessor(unittest.TestCase):
         self.assertEqual(response, "This is the generated response.")
         mock_client.models.generate_content.assert_called_once()
         
+    def test_assemble_context_merges_and_deduplicates(self):
+        """Test that overlapping chunks are merged and near-duplicates dropped."""
+        source = "Alpha beta gamma delta. Epsilon zeta eta theta. Iota kappa lambda mu."
+        chunks = [
+            {"document_id": "doc-1", "file_name": "a.txt", "content": source[24:71],
+             "metadata": {"page": 0, "start_index": 24, "end_index": 71}},
+            {"document_id": "doc-2", "file_name": "a (copy).txt", "content": source[24:71],
+             "metadata": {"page": 0, "start_index": 24, "end_index": 71}},
+            {"document_id": "doc-1", "file_name": "a.txt", "content": source[0:47],
+             "metadata": {"page": 0, "start_index": 0, "end_index": 47}},
+            {"document_id": "doc-3", "file_name": "b.txt", "content": "Unrelated notes.", "metadata": {}}
+        ]
+
+        passages = assemble_context(chunks, token_budget=1000)
+
+        self.assertEqual(passages, [
+            {"file_name": "a.txt", "content": source},
+            {"file_name": "b.txt", "content": "Unrelated notes."}
+        ])
+
+    def test_assemble_context_keeps_csv_rows_apart(self):
+        """Test that chunks of different CSV rows are never spliced together."""
+        chunks = [
+            {"document_id": "doc-1", "file_name": "data.csv", "content": "name: Alice, city: Oslo",
+             "metadata": {"page": 0, "row": 0, "start_index": 0, "end_index": 23}},
+            {"document_id": "doc-1", "file_name": "data.csv", "content": "name: Bob, city: Lima",
+             "metadata": {"page": 0, "row": 1, "start_index": 0, "end_index": 21}}
+        ]
+
+        passages = assemble_context(chunks, token_budget=1000)
+
+        self.assertEqual(passages, [
+            {"file_name": "data.csv", "content": "name: Alice, city: Oslo"},
+            {"file_name": "data.csv", "content": "name: Bob, city: Lima"}
+        ])
+
+    def test_assemble_context_respects_token_budget(self):
+        """Test that passages are packed by relevance into the token budget."""
+        chunks = [
+            {"document_id": "doc-1", "file_name": "a.txt", "content": "a " * 200, "metadata": {}},
+            {"document_id": "doc-2", "file_name": "b.txt", "content": "b " * 200, "metadata": {}},
+            {"document_id": "doc-3", "file_name": "c.txt", "content": "short answer", "metadata": {}}
+        ]
+
+        passages = assemble_context(chunks, token_budget=110)
+
+        self.assertEqual([p["file_name"] for p in passages], ["a.txt", "c.txt"])
+
     def test_decimal_encoder(self):
         """Test the DecimalEncoder JSON encoder."""
         # Create an object with Decimal values
@@ -258,6 +847,43 @@ class TestQueryProcessor(unittest.TestCase):
         self.assertEqual(decoded_obj["text"], "test")
         self.assertEqual(decoded_obj["number"], 42)
 
+    def test_encode_json(self):
+        """Test compact JSON encoding with and without orjson."""
+        obj = {"score": Decimal("0.95"), "text": "test", "vector": np.array([0.5], dtype=np.float32)}
+
+        self.assertEqual(json.loads(encode_json(obj)), {"score": 0.95, "text": "test", "vector": [0.5]})
+        with patch("query_processor.query_processor.orjson", None):
+            encoded = encode_json({"score": Decimal("0.95"), "text": "test"})
+        self.assertEqual(encoded, '{"score":0.95,"text":"test"}')
+
+    def test_shape_results(self):
+        """Test that results keep citation fields plus the requested fields, with snippets capped."""
+        results = [{
+            "chunk_id": "chunk-1", "document_id": "doc-1", "user_id": "user-1", "content": "A long passage",
+            "metadata": {"page": 1}, "file_name": "a.pdf", "similarity_score": 0.9
+        }]
+
+        self.assertEqual(shape_results(results, include=[], snippet_length=0), [
+            {"chunk_id": "chunk-1", "document_id": "doc-1", "file_name": "a.pdf", "similarity_score": 0.9}
+        ])
+        shaped = shape_results(results, include=["content"], snippet_length=6)
+        self.assertEqual(shaped[0]["content"], "A long")
+        self.assertNotIn("metadata", shaped[0])
+        # The default returns every field
+        self.assertEqual(shape_results(results), results)
+
+    @patch("query_processor.query_processor.func")
+    def test_main_invalid_include(self, mock_func):
+        """Test that unknown include fields and bad snippet lengths are rejected."""
+        mock_req = MagicMock()
+        mock_req.get_json.return_value = {"query": "What is RAG?", "include": ["embedding"]}
+        asyncio.run(main(mock_req))
+        self.assertEqual(mock_func.HttpResponse.call_args[1]["status_code"], 400)
+
+        mock_req.get_json.return_value = {"query": "What is RAG?", "snippet_length": -1}
+        asyncio.run(main(mock_req))
+        self.assertEqual(mock_func.HttpResponse.call_args[1]["status_code"], 400)
+
     @patch("query_processor.query_processor.func")
     def test_main_healthcheck(self, mock_func):
         """Test the Azure Function for a health check."""
@@ -270,7 +896,7 @@ class TestQueryProcessor(unittest.TestCase):
         mock_func.HttpResponse.return_value = mock_http_response
         
         # Call the function
-        response = main(mock_req)
+        response = asyncio.run(main(mock_req))
         
         # Verify results
         self.assertEqual(response, mock_http_response)
@@ -293,7 +919,7 @@ class TestQueryProcessor(unittest.TestCase):
         mock_func.HttpResponse.return_value = mock_http_response
         
         # Call the function
-        response = main(mock_req)
+        response = asyncio.run(main(mock_req))
         
         # Verify results
         self.assertEqual(response, mock_http_response)
@@ -306,9 +932,11 @@ class TestQueryProcessor(unittest.TestCase):
 
     @patch("query_processor.query_processor.func")
     @patch("query_processor.query_processor.embed_query")
-    @patch("query_processor.query_processor.similarity_search")
-    @patch("query_processor.query_processor.generate_response")
-    def test_main_query_success(self, mock_generate, mock_search, mock_embed, mock_func):
+    @patch("query_processor.query_processor.retrieve")
+    @patch("query_processor.query_processor.generate_response_async", new_callable=AsyncMock)
+    @patch("query_processor.query_processor.release_connection")
+    @patch("query_processor.query_processor.checkout_connection")
+    def test_main_query_success(self, mock_checkout, mock_release, mock_generate, mock_search, mock_embed, mock_func):
         """Test the Azure Function for a successful query."""
         # Mock embedding
         mock_embed.return_value = [0.1, 0.2, 0.3]
@@ -342,7 +970,7 @@ class TestQueryProcessor(unittest.TestCase):
         mock_func.HttpResponse.return_value = mock_http_response
         
         # Call the function
-        response = main(mock_req)
+        response = asyncio.run(main(mock_req))
         
         # Verify results
         self.assertEqual(response, mock_http_response)
@@ -352,9 +980,13 @@ class TestQueryProcessor(unittest.TestCase):
         self.assertEqual(call_args[1]["status_code"], 200)
         
         # Verify function calls
-        mock_embed.assert_called_once_with("What is RAG?")
-        mock_search.assert_called_once_with([0.1, 0.2, 0.3], "user-1")
+        mock_embed.assert_called_once_with("What is RAG?", conn=mock_checkout.return_value)
+        mock_search.assert_called_once_with([0.1, 0.2, 0.3], "user-1", "What is RAG?", search_quality="balanced",
+                                            retrieval_mode="vector", mmr_lambda=0.7,
+                                            conn=mock_checkout.return_value)
         mock_generate.assert_called_once_with("What is RAG?", mock_chunks)
+        # The connection checked out for retrieval is returned to the pool
+        mock_release.assert_called_once_with(mock_checkout.return_value, discard=False)
 
 
 if __name__ == "__main__":
@@ -17,7 +17,7 @@ os.environ["DB_SECRET_URI"] = "https://test-kv.vault.azure.net/secrets/db-creden
 
 # Now import the module under test - mocks are already in place globally from conftest
 from upload_handler.upload_handler import (
-    main, get_postgres_credentials, get_postgres_connection, get_mime_type
+    main, get_postgres_credentials, get_postgres_connection, get_mime_type, secret_cache
 )
 
 class TestUploadHandler(unittest.TestCase):
@@ -50,6 +50,8 @@ class TestUploadHandler(unittest.TestCase):
         self.mock_database_client.get_container_client.return_value = self.mock_container_client_cosmos
         self.mock_cosmos_client.get_database_client.return_value = self.mock_database_client
         self.mock_cosmos.return_value = self.mock_cosmos_client
+        
+        secret_cache.clear()
 
     def tearDown(self):
         """Clean up test environment."""
@@ -190,9 +192,8 @@ class TestUploadHandler(unittest.TestCase):
     @patch("upload_handler.upload_handler.base64")
     @patch("upload_handler.upload_handler.uuid")
     @patch("upload_handler.upload_handler.datetime")
-    @patch("upload_handler.upload_handler.get_postgres_credentials")
-    @patch("upload_handler.upload_handler.get_postgres_connection")
-    def test_main_success(self, mock_get_conn, mock_get_creds, mock_datetime, 
+    @patch("upload_handler.upload_handler.pooled_connection")
+    def test_main_success(self, mock_pooled_connection, mock_datetime,
                           mock_uuid, mock_base64, mock_func):
         """Test the Azure Function for successful file upload."""
         # Mock base64 decode
@@ -209,10 +210,7 @@ class TestUploadHandler(unittest.TestCase):
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_conn.cursor.return_value = mock_cursor
-        mock_get_conn.return_value = mock_conn
-        
-        # Mock credentials
-        mock_get_creds.return_value = {"host": "test-host"}
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
         
         # Create a request with file data
         mock_req = MagicMock()
@@ -242,12 +240,48 @@ class TestUploadHandler(unittest.TestCase):
         # Verify blob upload
         self.mock_blob_client.upload_blob.assert_called_once()
         
-        # Verify PostgreSQL insertion
+        # Verify PostgreSQL insertion on a pooled connection
+        mock_pooled_connection.assert_called_once()
         mock_cursor.execute.assert_called_once()
+        mock_conn.commit.assert_called_once()
         
         # Verify Cosmos DB item creation
         self.mock_container_client_cosmos.create_item.assert_called_once()
 
 
+    @patch("upload_handler.upload_handler.func")
+    @patch("upload_handler.upload_handler.uuid")
+    @patch("upload_handler.upload_handler.pooled_connection")
+    def test_main_replacement_joins_logical_document(self, mock_pooled_connection, mock_uuid, mock_func):
+        """Test that an upload replacing a document records that document's logical key."""
+        mock_uuid.uuid4.return_value = "doc-3"
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_pooled_connection.return_value.__enter__.return_value = mock_conn
+        # doc-2 was itself a new version of doc-1
+        mock_cursor.fetchone.return_value = ("doc-1",)
+        
+        mock_req = MagicMock()
+        mock_req.get_json.return_value = {
+            "file_content": "ZmlsZSBjb250ZW50",
+            "file_name": "renamed.pdf",
+            "user_id": "test-user",
+            "replaces_document_id": "doc-2"
+        }
+        
+        main(mock_req)
+        
+        lookup_params = mock_cursor.execute.call_args_list[0][0][1]
+        self.assertEqual(lookup_params, ("doc-2", "test-user"))
+        insert_sql, insert_params = mock_cursor.execute.call_args_list[1][0]
+        self.assertIn("logical_key", insert_sql)
+        self.assertEqual(insert_params[:8], (
+            "doc-3", "test-user", "renamed.pdf", "application/pdf", "uploaded",
+            "test-container", "uploads/test-user/doc-3/renamed.pdf", "doc-1"
+        ))
+        item = self.mock_container_client_cosmos.create_item.call_args[1]["body"]
+        self.assertEqual(item["logical_key"], "doc-1")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -9,7 +9,11 @@ import logging
 import azure.functions as func
 import uuid
 import base64
+import time
+import threading
 import psycopg2
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 
 # Azure SDK imports
@@ -31,25 +35,107 @@ METADATA_CONTAINER = os.environ.get('METADATA_CONTAINER')
 STAGE = os.environ.get('STAGE')
 DB_SECRET_URI = os.environ.get('DB_SECRET_URI')
 
+# PostgreSQL connection pool
+POSTGRES_POOL_MIN_SIZE = int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 1))
+POSTGRES_POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10))
+POSTGRES_POOL_MAX_LIFETIME = int(os.environ.get('POSTGRES_POOL_MAX_LIFETIME', 1800))  # seconds
+POSTGRES_POOL_HEALTHCHECK_INTERVAL = int(os.environ.get('POSTGRES_POOL_HEALTHCHECK_INTERVAL', 30))  # seconds
+POSTGRES_POOL_TIMEOUT = float(os.environ.get('POSTGRES_POOL_TIMEOUT', 30))  # seconds
+
+# Secret cache
+SECRET_CACHE_TTL = int(os.environ.get('SECRET_CACHE_TTL', 900))  # seconds
+SECRET_CACHE_REFRESH_AHEAD = int(os.environ.get('SECRET_CACHE_REFRESH_AHEAD', 60))  # seconds
+
 # Initialize Azure clients
 credential = DefaultAzureCredential()
 
-def get_postgres_credentials():
+class SecretCache:
     """
-    Get PostgreSQL credentials from Azure Key Vault.
+    TTL cache for secrets with single-flight refresh.
+    
+    Concurrent callers that miss the cache wait for a single fetch. Entries
+    close to expiry are served while one background thread refreshes them.
     """
-    try:
-        # Parse URI to get Key Vault name and secret name
-        parts = DB_SECRET_URI.replace("https://", "").split('/')
-        key_vault_name = parts[0].split('.')[0]
-        secret_name = parts[-1]
-        
-        # Create a SecretClient
-        secret_client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
+
+    def __init__(self, ttl: float, refresh_ahead: float):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._entries = {}  # name -> (value, fetched_at)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _name_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _fetch(self, name: str, fetch):
+        value = fetch()
+        self._entries[name] = (value, time.monotonic())
+        return value
+
+    def _refresh_in_background(self, name: str, fetch, lock: threading.Lock):
+        try:
+            self._fetch(name, fetch)
+        except Exception as e:
+            logger.warning(f"Background refresh of secret {name} failed: {str(e)}")
+        finally:
+            lock.release()
+
+    def get(self, name: str, fetch, force_refresh: bool = False):
+        """
+        Get a secret value, calling fetch() when it is missing, expired or force_refresh is set.
+        """
+        requested_at = time.monotonic()
+        entry = self._entries.get(name)
+        if entry is not None and not force_refresh:
+            value, fetched_at = entry
+            age = requested_at - fetched_at
+            if age < self.ttl:
+                if age >= self.ttl - self.refresh_ahead:
+                    lock = self._name_lock(name)
+                    if lock.acquire(blocking=False):
+                        threading.Thread(
+                            target=self._refresh_in_background, args=(name, fetch, lock), daemon=True
+                        ).start()
+                return value
         
-        # Get the secret
-        secret = secret_client.get_secret(secret_name)
-        return json.loads(secret.value)
+        with self._name_lock(name):
+            # Another caller may have fetched the secret while we waited
+            entry = self._entries.get(name)
+            if entry is not None:
+                value, fetched_at = entry
+                fresh = time.monotonic() - fetched_at < self.ttl
+                if fresh and (not force_refresh or fetched_at >= requested_at):
+                    return value
+            return self._fetch(name, fetch)
+
+    def clear(self):
+        self._entries.clear()
+
+secret_cache = SecretCache(SECRET_CACHE_TTL, SECRET_CACHE_REFRESH_AHEAD)
+
+def fetch_secret_json(secret_uri):
+    """
+    Fetch a JSON secret from Azure Key Vault.
+    """
+    # Parse URI to get Key Vault name and secret name
+    parts = secret_uri.replace("https://", "").split('/')
+    key_vault_name = parts[0].split('.')[0]
+    secret_name = parts[-1]
+    
+    # Create a SecretClient
+    secret_client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
+    
+    # Get the secret
+    secret = secret_client.get_secret(secret_name)
+    return json.loads(secret.value)
+
+def get_postgres_credentials(force_refresh=False):
+    """
+    Get PostgreSQL credentials from Azure Key Vault (cached).
+    """
+    try:
+        return secret_cache.get(DB_SECRET_URI, lambda: fetch_secret_json(DB_SECRET_URI), force_refresh)
     except Exception as e:
         logger.error(f"Error getting PostgreSQL credentials: {str(e)}")
         raise e
@@ -67,6 +153,216 @@ def get_postgres_connection(credentials):
     )
     return conn
 
+def is_auth_error(error: Exception) -> bool:
+    """
+    Check whether a connection error means the credentials were rejected.
+    """
+    if getattr(error, 'pgcode', None) in ('28P01', '28000'):
+        return True
+    return 'password authentication failed' in str(error)
+
+def connect_postgres():
+    """
+    Open a new PostgreSQL connection, refreshing cached credentials once if they are rejected.
+    """
+    try:
+        return get_postgres_connection(get_postgres_credentials())
+    except Exception as e:
+        if not is_auth_error(e):
+            raise
+        logger.warning("PostgreSQL rejected cached credentials, refreshing from Key Vault")
+        return get_postgres_connection(get_postgres_credentials(force_refresh=True))
+
+class PostgresConnectionPool:
+    """
+    Thread-safe PostgreSQL connection pool reused across warm invocations.
+    
+    Connections are health checked on checkout when they have been idle for a
+    while, and replaced once they exceed their maximum lifetime or break.
+    """
+
+    def __init__(self, connect, min_size: int, max_size: int, max_lifetime: float,
+                 healthcheck_interval: float, timeout: float):
+        self._connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.healthcheck_interval = healthcheck_interval
+        self.timeout = timeout
+        self._idle = deque()  # (conn, last_used)
+        self._created_at = {}  # id(conn) -> creation time
+        self._size = 0
+        self._cond = threading.Condition()
+        
+        for _ in range(min(min_size, max_size)):
+            self._size += 1
+            try:
+                conn = self._open()
+            except Exception as e:
+                logger.warning(f"Error pre-opening pooled PostgreSQL connection: {str(e)}")
+                break
+            self._idle.append((conn, time.monotonic()))
+
+    def _open(self):
+        # The caller has already reserved a slot by incrementing _size
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_usable(self, conn, last_used: float) -> bool:
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if now - self._created_at.get(id(conn), now) > self.max_lifetime:
+            return False
+        if now - last_used > self.healthcheck_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"Pooled PostgreSQL connection failed health check: {str(e)}")
+                return False
+        return True
+
+    def getconn(self):
+        """
+        Check out a healthy connection, opening a new one if the pool has room.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"Timed out waiting for a PostgreSQL connection after {self.timeout}s")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    entry = None
+                    self._size += 1
+            
+            if entry is None:
+                return self._open()
+            
+            conn, last_used = entry
+            if self._is_usable(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, discard: bool = False):
+        """
+        Return a connection to the pool, rolling back any open transaction.
+        """
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """
+        Close all idle connections.
+        """
+        while True:
+            with self._cond:
+                if not self._idle:
+                    return
+                conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+def get_connection_pool() -> PostgresConnectionPool:
+    """
+    Get the process-wide PostgreSQL connection pool, creating it on first use.
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = PostgresConnectionPool(
+                    connect=connect_postgres,
+                    min_size=POSTGRES_POOL_MIN_SIZE,
+                    max_size=POSTGRES_POOL_MAX_SIZE,
+                    max_lifetime=POSTGRES_POOL_MAX_LIFETIME,
+                    healthcheck_interval=POSTGRES_POOL_HEALTHCHECK_INTERVAL,
+                    timeout=POSTGRES_POOL_TIMEOUT
+                )
+    return _connection_pool
+
+@contextmanager
+def pooled_connection():
+    """
+    Check out a pooled PostgreSQL connection for the duration of a with block.
+    
+    Uncommitted work is rolled back when the connection is returned. The
+    connection is returned even when the block is abandoned (for example a
+    generator holding it is closed), and is discarded if the block raised.
+    """
+    pool = get_connection_pool()
+    conn = pool.getconn()
+    failed = True
+    try:
+        yield conn
+        failed = False
+    finally:
+        pool.putconn(conn, discard=failed)
+
+def resolve_logical_key(cursor, user_id, document_id, replaces_document_id=None):
+    """
+    Determine the logical document an upload belongs to.
+    
+    An upload that replaces an earlier document of the same user joins that
+    document's logical key, so document_processor can diff the two versions;
+    any other upload starts a new logical document keyed by its own ID.
+    
+    Args:
+        cursor: PostgreSQL cursor
+        user_id (str): User ID
+        document_id (str): Document ID of the upload
+        replaces_document_id (str): Document ID of the version being replaced, if any
+        
+    Returns:
+        str: Logical key of the upload
+    """
+    if replaces_document_id:
+        cursor.execute("""
+        SELECT COALESCE(logical_key, document_id) FROM documents
+        WHERE document_id = %s AND user_id = %s
+        LIMIT 1
+        """, (replaces_document_id, user_id))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        logger.warning(f"Replaced document {replaces_document_id} not found, storing the upload as a new document")
+    return document_id
+
 def get_mime_type(file_name):
     """
     Determine MIME type from file extension.
@@ -123,6 +419,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         file_name = req_body.get('file_name', '')
         mime_type = req_body.get('mime_type', None)
         user_id = req_body.get('user_id', 'system')
+        replaces_document_id = req_body.get('replaces_document_id')
         
         if not file_content_base64 or not file_name:
             return func.HttpResponse(
@@ -160,32 +457,33 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         })
         
         # Store initial metadata in PostgreSQL
+        logical_key = replaces_document_id or document_id
         try:
-            # Get PostgreSQL credentials
-            credentials = get_postgres_credentials()
-            conn = get_postgres_connection(credentials)
-            cursor = conn.cursor()
-            
-            # Insert document record
-            cursor.execute("""
-            INSERT INTO documents (document_id, user_id, file_name, mime_type, status, bucket, key, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                document_id,
-                user_id,
-                file_name,
-                mime_type,
-                'uploaded',
-                DOCUMENTS_CONTAINER,
-                blob_path,
-                datetime.now(),
-                datetime.now()
-            ))
-            
-            # Commit the transaction
-            conn.commit()
-            cursor.close()
-            conn.close()
+            # Insert document record using a pooled PostgreSQL connection
+            with pooled_connection() as conn:
+                cursor = conn.cursor()
+                
+                # Record which logical document this upload is a version of
+                logical_key = resolve_logical_key(cursor, user_id, document_id, replaces_document_id)
+                
+                cursor.execute("""
+                INSERT INTO documents (document_id, user_id, file_name, mime_type, status, bucket, key, logical_key, created_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, (
+                    document_id,
+                    user_id,
+                    file_name,
+                    mime_type,
+                    'uploaded',
+                    DOCUMENTS_CONTAINER,
+                    blob_path,
+                    logical_key,
+                    datetime.now(),
+                    datetime.now()
+                ))
+                
+                # Commit the transaction
+                conn.commit()
             
         except Exception as e:
             logger.error(f"Error storing metadata in PostgreSQL: {str(e)}")
@@ -211,6 +509,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 'status': 'uploaded',
                 'container': DOCUMENTS_CONTAINER,
                 'path': blob_path,
+                'logical_key': logical_key,
                 'created_at': datetime.now().isoformat(),
                 'updated_at': datetime.now().isoformat()
             }